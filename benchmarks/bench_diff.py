@@ -0,0 +1,66 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark the LDAP user/Postgres role diff.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_diff
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+
+from benchmarks.common import default_config, synthetic_names, timed
+from pgldapsync.syncutils.diff import diff_login_roles
+
+
+def run(sizes, churn):
+    """Diff synthetic name sets of increasing size.
+
+    Args:
+        sizes (int[]): The number of names on each side
+        churn (float): The fraction of names present on one side only
+    """
+    config = default_config()
+
+    print("%10s %12s %12s %14s" % ('names', 'seconds', 'create+drop',
+                                   'ns/name'))
+
+    for size in sizes:
+        offset = int(size * churn)
+        names = synthetic_names(size + offset)
+        ldap_users = names[offset:]
+        pg_roles = names[:size]
+
+        elapsed, diff = timed(diff_login_roles, config, ldap_users, pg_roles,
+                              ldap_users[:size // 100])
+
+        print("%10d %12.3f %12d %14.1f" %
+              (size, elapsed, len(diff.create) + len(diff.drop),
+               elapsed * 1e9 / size))
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(description='Benchmark the role diff.')
+    parser.add_argument("--sizes", default='10000,100000,1000000',
+                        help="comma delimited list of name counts to test")
+    parser.add_argument("--churn", type=float, default=0.05,
+                        help="fraction of names that differ between sides")
+    args = parser.parse_args()
+
+    run([int(size) for size in args.sizes.split(',')], args.churn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark reading the users and admin users from a mock directory with
+the synchronous and asynchronous LDAP strategies. The mock server answers
+instantly, so a fixed latency is added to every search request to simulate
+the network and server; the mock server is assumed to handle concurrent
+requests on a connection in parallel, as real servers do.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_ldap_async --latency 0.02
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+import time
+
+from ldap3 import Connection, MOCK_ASYNC, MOCK_SYNC
+
+from benchmarks.common import default_config, mock_ldap_connection, timed
+from pgldapsync.syncutils.metrics import METRICS
+from pgldapsync.syncutils.sync import get_ldap_sync
+
+
+def latency_connection(conn, client_strategy, latency):
+    """Open another connection to a mock server, which waits before
+    returning the response to each search.
+
+    Args:
+        conn (ldap3.core.connection.Connection): A connection to the server
+        client_strategy (str): MOCK_SYNC or MOCK_ASYNC
+        latency (float): The delay before each response, in seconds
+    Returns:
+        ldap3.core.connection.Connection: A bound connection to the server
+    """
+    new_conn = Connection(conn.server, conn.user, conn.password,
+                          client_strategy=client_strategy)
+    new_conn.bind()
+
+    post_send_search = new_conn.post_send_search
+    ready = {}
+
+    def delayed_post_send_search(payload):
+        if new_conn.strategy.sync:
+            time.sleep(latency)
+            return post_send_search(payload)
+
+        # Responses to asynchronous requests are ready a fixed time after
+        # each request is sent
+        message_id = post_send_search(payload)
+        ready[message_id] = time.perf_counter() + latency
+        return message_id
+
+    get_response = new_conn.strategy.get_response
+
+    def delayed_get_response(message_id, *args, **kwargs):
+        delay = ready.pop(message_id, 0) - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        return get_response(message_id, *args, **kwargs)
+
+    new_conn.post_send_search = delayed_post_send_search
+    new_conn.strategy.get_response = delayed_get_response
+
+    return new_conn
+
+
+def run(args):
+    """Read the users and admin users with each strategy.
+
+    Args:
+        args (Namespace): The command line arguments
+    """
+    config = default_config()
+    conn = mock_ldap_connection(config, args.users)
+    config.set('ldap', 'page_size', str(args.page_size))
+    config.set('ldap', 'admin_base_dn', config.get('ldap', 'base_dn'))
+    config.set('ldap', 'admin_filter_string',
+               '(&(objectClass=inetOrgPerson)(!(uid>=user%07d)))' %
+               args.admins)
+
+    print("%10s %10s %10s %12s %12s" % ('strategy', 'users', 'admins',
+                                        'round_trips', 'seconds'))
+
+    for strategy, client_strategy in (('sync', MOCK_SYNC),
+                                      ('async', MOCK_ASYNC)):
+        config.set('ldap', 'strategy', strategy)
+        strategy_conn = latency_connection(conn, client_strategy,
+                                           args.latency)
+
+        METRICS.reset()
+        elapsed, ldap_sync = timed(get_ldap_sync, config, strategy_conn, True)
+
+        if len(ldap_sync.users) != args.users or \
+                len(ldap_sync.admin_users) != args.admins:
+            raise RuntimeError("Expected %d users and %d admins, found %d "
+                               "and %d" % (args.users, args.admins,
+                                           len(ldap_sync.users),
+                                           len(ldap_sync.admin_users)))
+
+        print("%10s %10d %10d %12d %12.3f" %
+              (strategy, len(ldap_sync.users), len(ldap_sync.admin_users),
+               METRICS.counters[('ldap_round_trips', '')], elapsed))
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the synchronous and asynchronous LDAP '
+                    'strategies.')
+    parser.add_argument("--users", type=int, default=20000,
+                        help="the number of users in the mock directory")
+    parser.add_argument("--admins", type=int, default=5000,
+                        help="the number of users that are admins")
+    parser.add_argument("--page-size", type=int, default=500,
+                        help="the LDAP search page size")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="the simulated latency of each search request, "
+                             "in seconds")
+    args = parser.parse_args()
+
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark the LDAP user search against an in-process mock server. With
+--cache, each search is run twice with the snapshot cache enabled, to
+compare the search that writes the snapshot with one that reads it.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_ldap_search
+    python3 -m benchmarks.bench_ldap_search --users 500000 --cache
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+import os
+import tempfile
+import tracemalloc
+
+from benchmarks.common import default_config, mock_ldap_connection, timed
+from pgldapsync.ldaputils.users import get_filtered_ldap_users
+
+
+def count_users(users):
+    """Consume a stream of user names.
+
+    Args:
+        users (iterable): The user names
+    Returns:
+        int: The number of names
+    """
+    count = 0
+    for _ in users:
+        count = count + 1
+
+    return count
+
+
+def run(count, page_sizes, cache_dir=None):
+    """Search a mock directory with different page sizes.
+
+    Args:
+        count (int): The number of users in the directory
+        page_sizes (int[]): The page sizes to test
+        cache_dir (str): A directory for the snapshot cache, if it is to be
+            tested
+    """
+    config = default_config()
+    conn = mock_ldap_connection(config, count)
+
+    print("%10s %10s %10s %12s %14s" % ('page_size', 'snapshot', 'users',
+                                        'seconds', 'peak_alloc_mb'))
+
+    for page_size in page_sizes:
+        config.set('ldap', 'page_size', str(page_size))
+
+        # Each page size gets its own snapshot
+        modes = ['none']
+        if cache_dir is not None:
+            snapshot_dir = os.path.join(cache_dir, str(page_size))
+            os.mkdir(snapshot_dir)
+            config.set('ldap', 'cache_dir', snapshot_dir)
+            modes = ['write', 'read']
+
+        for mode in modes:
+            tracemalloc.start()
+            elapsed, users = timed(
+                lambda: count_users(get_filtered_ldap_users(config, conn,
+                                                            False)))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            if users != count:
+                raise RuntimeError("Expected %d users, found %d" %
+                                   (count, users))
+
+            print("%10d %10s %10d %12.3f %14.1f" %
+                  (page_size, mode, users, elapsed, peak / 1048576.0))
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the LDAP user search.')
+    parser.add_argument("--users", type=int, default=100000,
+                        help="the number of users in the mock directory")
+    parser.add_argument("--page-sizes", default='0,1000',
+                        help="comma delimited list of page sizes to test")
+    parser.add_argument("--cache", action='store_true',
+                        help="test writing and reading search snapshots")
+    args = parser.parse_args()
+
+    page_sizes = [int(size) for size in args.page_sizes.split(',')]
+    if args.cache:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            run(args.users, page_sizes, cache_dir)
+    else:
+        run(args.users, page_sizes)
+
+
+if __name__ == '__main__':
+    main()
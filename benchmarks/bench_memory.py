@@ -0,0 +1,160 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark the peak memory used to diff the LDAP users with the Postgres
+roles, holding each side as a NameSet or as Python lists and sets, as
+pgldapsync did previously. The names on each side are streamed from
+generators, as they are from the LDAP search pages and the Postgres cursor.
+Each measurement is made in a new process, as the peak RSS of a process
+never goes down.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_memory
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks.common import default_config
+from pgldapsync.syncutils.diff import diff_login_roles, \
+    get_role_name_normaliser, normalise_users
+from pgldapsync.syncutils.names import NameSet
+
+
+def get_peak_rss():
+    """Get the peak resident set size of this process.
+
+    Returns:
+        int: The peak RSS in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def stream_names(start, count):
+    """Generate synthetic user names without holding them in a list.
+
+    Args:
+        start (int): The number of the first name
+        count (int): The number of names to generate
+    Yields:
+        str: The names
+    """
+    for i in range(start, start + count):
+        yield 'user%07d' % i
+
+
+def diff_lists(config, ldap_users, pg_roles):
+    """Diff the names as lists and sets, as pgldapsync did before NameSet.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_users (iterable): The LDAP user names
+        pg_roles (iterable): The Postgres role names
+    Returns:
+        tuple: The roles to create and drop, and the lists and sets built
+    """
+    wanted = normalise_users(get_role_name_normaliser(config), ldap_users)
+    wanted_index = frozenset(wanted)
+
+    pg_roles = list(pg_roles)
+    pg_index = frozenset(pg_roles)
+
+    create = [role for role in wanted if role not in pg_index]
+    drop = [role for role in pg_roles if role not in wanted_index]
+
+    return create, drop, (wanted, wanted_index, pg_roles, pg_index)
+
+
+def measure(representation, size, churn):
+    """Diff one set of names, and print the peak memory used as JSON.
+
+    Args:
+        representation (str): 'nameset' or 'list'
+        size (int): The number of names on each side
+        churn (float): The fraction of names present on one side only
+    """
+    config = default_config()
+    offset = int(size * churn)
+    baseline = get_peak_rss()
+
+    start = time.perf_counter()
+    if representation == 'nameset':
+        pg_roles = NameSet(stream_names(0, size))
+        diff = diff_login_roles(config, stream_names(offset, size), pg_roles)
+        changes = len(diff.create) + len(diff.drop)
+    else:
+        create, drop, _ = diff_lists(config, stream_names(offset, size),
+                                     stream_names(0, size))
+        changes = len(create) + len(drop)
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({'changes': changes, 'seconds': elapsed,
+                      'baseline': baseline,
+                      'peak': get_peak_rss()}))
+
+
+def run(sizes, churn):
+    """Measure each representation at each size, in a child process.
+
+    Args:
+        sizes (int[]): The number of names on each side
+        churn (float): The fraction of names present on one side only
+    """
+    print("%10s %10s %12s %12s %14s %12s" % ('names', 'structure',
+                                             'peak_mb', 'diff_mb',
+                                             'bytes/name', 'seconds'))
+
+    for size in sizes:
+        for representation in ('list', 'nameset'):
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.bench_memory',
+                 '--measure', representation, '--sizes', str(size),
+                 '--churn', str(churn)],
+                check=True, stdout=subprocess.PIPE).stdout
+            result = json.loads(output)
+            used = result['peak'] - result['baseline']
+
+            print("%10d %10s %12.1f %12.1f %14.1f %12.3f" %
+                  (size, representation, result['peak'] / 1048576.0,
+                   used / 1048576.0, used / (size * 2.0), result['seconds']))
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the memory used by the role diff.')
+    parser.add_argument("--sizes", default='100000,1000000',
+                        help="comma delimited list of name counts to test")
+    parser.add_argument("--churn", type=float, default=0.05,
+                        help="fraction of names that differ between sides")
+    parser.add_argument("--measure", choices=['list', 'nameset'],
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        measure(args.measure, int(args.sizes), args.churn)
+        return
+
+    run([int(size) for size in args.sizes.split(',')], args.churn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark the expansion of nested LDAP groups.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_nested_groups
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+
+from benchmarks.common import synthetic_names, timed
+from pgldapsync.ldaputils.groups import LdapGroup, expand_nested_groups
+
+
+def synthetic_groups(count, users_per_group, fanout):
+    """Generate a tree of nested groups, with a cycle back to the root from
+    every tenth leaf group.
+
+    Args:
+        count (int): The number of groups to generate
+        users_per_group (int): The number of direct user members of each
+            group
+        fanout (int): The number of child groups of each group
+    Returns:
+        dict: The LdapGroup for each group DN
+    """
+    dns = synthetic_names(count, 'cn=group')
+    users = synthetic_names(count * users_per_group)
+
+    groups = {}
+    for i, dn in enumerate(dns):
+        children = set(dns[i * fanout + 1:(i + 1) * fanout + 1])
+        if len(children) == 0 and i % 10 == 0:
+            children.add(dns[0])
+
+        groups[dn] = LdapGroup(dn, set(users[i * users_per_group:
+                                             (i + 1) * users_per_group]),
+                               children)
+
+    return groups
+
+
+def run(sizes, users_per_group, fanout):
+    """Expand synthetic group trees of increasing size.
+
+    Args:
+        sizes (int[]): The number of groups
+        users_per_group (int): The number of direct user members of each
+            group
+        fanout (int): The number of child groups of each group
+    """
+    print("%10s %12s %14s" % ('groups', 'seconds', 'us/group'))
+
+    for size in sizes:
+        groups = synthetic_groups(size, users_per_group, fanout)
+
+        elapsed, _ = timed(expand_nested_groups, groups)
+
+        print("%10d %12.3f %14.1f" % (size, elapsed, elapsed * 1e6 / size))
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark nested group expansion.')
+    parser.add_argument("--sizes", default='1000,10000,50000',
+                        help="comma delimited list of group counts to test")
+    parser.add_argument("--users-per-group", type=int, default=5,
+                        help="number of direct user members of each group")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="number of child groups of each group")
+    args = parser.parse_args()
+
+    run([int(size) for size in args.sizes.split(',')], args.users_per_group,
+        args.fanout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark role creation and removal against a local Postgres server.
+
+All work is done in transactions that are rolled back, so no roles are left
+behind. The connection must be as a user with the CREATEROLE privilege.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_role_ddl --connstr "dbname=postgres"
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+
+import psycopg2
+import psycopg2.extensions
+
+from benchmarks.common import synthetic_names, timed
+from pgldapsync.pgutils.batch import execute_role_statements
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """A cursor that counts the statements it sends to the server."""
+
+    # pylint: disable=too-few-public-methods
+
+    round_trips = 0
+
+    def execute(self, query, vars=None):
+        """Execute a query, counting the round-trip."""
+        # pylint: disable=redefined-builtin
+        CountingCursor.round_trips = CountingCursor.round_trips + 1
+        return super().execute(query, vars)
+
+
+def run_batch(conn, operations, batch_size):
+    """Execute a set of operations, and roll them back.
+
+    Args:
+        conn (connection): The Postgres connection object
+        operations (list): A list of (role, sql) tuples
+        batch_size (int): The batch size to use
+    Returns:
+        tuple: The elapsed time, round-trips and number of failures
+    """
+    CountingCursor.round_trips = 0
+
+    elapsed, failures = timed(execute_role_statements, conn, operations,
+                              batch_size)
+    conn.rollback()
+
+    return elapsed, CountingCursor.round_trips, len(failures)
+
+
+def run(connstr, count, batch_sizes):
+    """Create roles with different batch sizes.
+
+    Args:
+        connstr (str): The Postgres connection string
+        count (int): The number of roles to create
+        batch_sizes (int[]): The batch sizes to test
+    """
+    conn = psycopg2.connect(connstr, cursor_factory=CountingCursor)
+
+    operations = [(name, 'CREATE ROLE "%s" LOGIN;' % name)
+                  for name in synthetic_names(count, 'pgldapsync_bench_')]
+
+    print("%10s %10s %12s %10s" % ('batch_size', 'roles', 'seconds',
+                                   'trips'))
+
+    for batch_size in batch_sizes:
+        elapsed, trips, errors = run_batch(conn, operations, batch_size)
+        if errors > 0:
+            raise RuntimeError("%d roles failed to create" % errors)
+
+        print("%10d %10d %12.3f %10d" % (batch_size, count, elapsed, trips))
+
+    conn.close()
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark role creation in Postgres.')
+    parser.add_argument("--connstr", default='dbname=postgres',
+                        help="the Postgres connection string")
+    parser.add_argument("--roles", type=int, default=10000,
+                        help="the number of roles to create")
+    parser.add_argument("--batch-sizes", default='1,100,1000',
+                        help="comma delimited list of batch sizes to test")
+    args = parser.parse_args()
+
+    run(args.connstr, args.roles,
+        [int(size) for size in args.batch_sizes.split(',')])
+
+
+if __name__ == '__main__':
+    main()
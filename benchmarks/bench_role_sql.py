@@ -0,0 +1,109 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark rendering of the SQL used to create login roles, comparing the
+per-role config parsing functions with the compiled role policy. A Postgres
+connection is required for identifier quoting, but nothing is executed.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_role_sql --connstr "dbname=postgres"
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+
+import psycopg2
+
+from benchmarks.common import default_config, synthetic_names, timed
+from pgldapsync.pgutils.policy import RolePolicy
+from pgldapsync.pgutils.roles import get_guc_list, get_role_attributes, \
+    get_role_grants
+
+
+def render_with_config(config, roles):
+    """Render the SQL by reading the config for each role.
+
+    Args:
+        config (ConfigParser): The application configuration
+        roles (str[]): The role names
+    Returns:
+        str[]: The SQL for each role
+    """
+    return ['CREATE ROLE "%s" LOGIN %s;%s%s%s' %
+            (role, get_role_attributes(config, False),
+             get_role_grants(config, role),
+             get_role_grants(config, role, True),
+             get_guc_list(config, role))
+            for role in roles]
+
+
+def render_with_policy(config, conn, roles):
+    """Render the SQL using a compiled role policy.
+
+    Args:
+        config (ConfigParser): The application configuration
+        conn (connection): The Postgres connection object
+        roles (str[]): The role names
+    Returns:
+        str[]: The SQL for each role
+    """
+    policy = RolePolicy(config, conn)
+
+    return [policy.get_create_sql(role, False) for role in roles]
+
+
+def run(connstr, count):
+    """Render the SQL for a number of roles, both ways.
+
+    Args:
+        connstr (str): The Postgres connection string
+        count (int): The number of roles
+    """
+    config = default_config()
+    config.set('general', 'roles_to_grant', 'group1,group2')
+    config.set('general', 'roles_to_grant_with_admin', 'group3')
+    config.set('general', 'gucs_to_set',
+               "{'search_path': ['app, public', ''], "
+               "'work_mem': ['64MB', 'reporting']}")
+
+    conn = psycopg2.connect(connstr)
+    roles = synthetic_names(count)
+
+    print("%10s %10s %12s %14s" % ('method', 'roles', 'seconds', 'us/role'))
+
+    for method, func, args in (('config', render_with_config,
+                                (config, roles)),
+                               ('policy', render_with_policy,
+                                (config, conn, roles))):
+        elapsed, _ = timed(func, *args)
+        print("%10s %10d %12.3f %14.2f" % (method, count, elapsed,
+                                           elapsed * 1e6 / count))
+
+    conn.close()
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark role SQL rendering.')
+    parser.add_argument("--connstr", default='dbname=postgres',
+                        help="the Postgres connection string")
+    parser.add_argument("--roles", type=int, default=100000,
+                        help="the number of roles to render SQL for")
+    args = parser.parse_args()
+
+    run(args.connstr, args.roles)
+
+
+if __name__ == '__main__':
+    main()
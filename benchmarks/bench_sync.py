@@ -0,0 +1,229 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Benchmark a complete sync, from a synthetic mock LDAP directory to a
+throwaway Postgres cluster seeded with synthetic login roles. The time
+spent in each phase of the sync is reported, and the full metrics for each
+run can be written as JSON so that runs can be compared.
+
+By default, a temporary cluster is created with initdb and removed
+afterwards; it only listens on a Unix socket, so no network access is
+required. If --connstr is given, the server it connects to must be
+disposable: every role other than the connecting user is dropped before
+each run.
+
+Run from the top level of the source tree:
+
+    python3 -m benchmarks.bench_sync --users 100000 --output results.json
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import argparse
+import contextlib
+import io
+import statistics
+
+import psycopg2
+
+from benchmarks.common import default_config, mock_ldap_connection, \
+    throwaway_postgres, timed, write_results
+from pgldapsync.syncutils.metrics import METRICS
+from pgldapsync.syncutils.sync import sync_roles
+
+
+# Roles are dropped and created in chunks, each in its own transaction, as
+# every role changed in a transaction takes a lock until it ends.
+SEED_CHUNK_SIZE = 1000
+
+RESET_ROLES = """DO $$
+DECLARE
+    r record;
+BEGIN
+    FOR r IN SELECT rolname FROM pg_roles
+             WHERE rolname <> current_user AND rolname !~ '^pg_'
+             LIMIT {0} LOOP
+        EXECUTE format('DROP ROLE %I', r.rolname);
+    END LOOP;
+END;
+$$;"""
+
+SEED_ROLES = """DO $$
+BEGIN
+    FOR i IN {0} .. {1} LOOP
+        EXECUTE format('CREATE ROLE %I LOGIN', 'user' || lpad(i::text, 7, '0'));
+    END LOOP;
+END;
+$$;"""
+
+COUNT_ROLES = """SELECT count(*) FROM pg_roles
+WHERE rolname <> current_user AND rolname !~ '^pg_';"""
+
+
+def seed_roles(conn, count):
+    """Replace all the roles on the server with synthetic login roles,
+    named in the same way as the synthetic LDAP users.
+
+    Args:
+        conn (connection): The Postgres connection object
+        count (int): The number of roles to create
+    """
+    cur = conn.cursor()
+
+    while True:
+        cur.execute(COUNT_ROLES)
+        if cur.fetchone()[0] == 0:
+            break
+        cur.execute(RESET_ROLES.format(SEED_CHUNK_SIZE))
+        conn.commit()
+
+    for start in range(0, count, SEED_CHUNK_SIZE):
+        cur.execute(SEED_ROLES.format(
+            start, min(start + SEED_CHUNK_SIZE, count) - 1))
+        conn.commit()
+
+    cur.close()
+
+
+def run_sync(config, ldap_conn, pg_conn):
+    """Run a sync, discarding its output.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+        pg_conn (connection): The Postgres connection object
+    Returns:
+        dict: The elapsed time, and the metrics recorded
+    """
+    METRICS.reset()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        elapsed, completed = timed(sync_roles, config, ldap_conn,
+                                   {'postgres': pg_conn}, False)
+
+    if not completed:
+        raise RuntimeError("The sync failed")
+
+    return {'elapsed': elapsed, 'metrics': METRICS.to_dict(completed)}
+
+
+def run(args, connstr):
+    """Synchronise a synthetic directory a number of times.
+
+    Args:
+        args (Namespace): The command line arguments
+        connstr (str): The Postgres connection string
+    Returns:
+        list: The results of each run
+    """
+    config = default_config()
+    config.set('ldap', 'page_size', str(args.page_size))
+    config.set('postgres', 'batch_size', str(args.batch_size))
+    config.set('postgres', 'diff_engine', args.diff_engine)
+
+    # Offset the LDAP users from the Postgres roles, so that some roles are
+    # created and some dropped.
+    offset = int(args.users * args.churn)
+    ldap_conn = mock_ldap_connection(config, args.users + offset,
+                                     args.attribute_size, args.groups,
+                                     args.nesting)
+    config.set('ldap', 'filter_string',
+               '(&(objectClass=inetOrgPerson)(uid>=user%07d))' % offset)
+
+    pg_conn = psycopg2.connect(connstr)
+    cur = pg_conn.cursor()
+    cur.execute("SELECT current_user;")
+    config.set('postgres', 'ignore_login_roles', cur.fetchone()[0])
+    cur.close()
+
+    runs = []
+    for _ in range(args.repeat):
+        seed_roles(pg_conn, args.users if args.roles is None else args.roles)
+        runs.append(run_sync(config, ldap_conn, pg_conn))
+
+    pg_conn.close()
+
+    return runs
+
+
+def print_results(runs):
+    """Print the median time spent in each phase.
+
+    Args:
+        runs (list): The results of each run
+    """
+    phases = {}
+    for result in runs:
+        metrics = result['metrics']
+        for section in [metrics] + list(metrics['targets'].values()):
+            for phase, seconds in section['phases'].items():
+                phases.setdefault(phase, []).append(seconds)
+
+    print("%-20s %12s" % ('phase', 'seconds'))
+    for phase, values in sorted(phases.items()):
+        print("%-20s %12.3f" % (phase, statistics.median(values)))
+    print("%-20s %12.3f" % ('total', statistics.median(
+        [result['elapsed'] for result in runs])))
+
+
+def main():
+    """Benchmark entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark a complete sync.')
+    parser.add_argument("--users", type=int, default=10000,
+                        help="the number of users in the mock directory")
+    parser.add_argument("--roles", type=int,
+                        help="the number of login roles to seed Postgres "
+                             "with, the number of users if not set")
+    parser.add_argument("--churn", type=float, default=0.05,
+                        help="fraction of users that are not in Postgres")
+    parser.add_argument("--attribute-size", type=int, default=0,
+                        help="size of an additional attribute on each user")
+    parser.add_argument("--groups", type=int, default=0,
+                        help="the number of groups in the mock directory")
+    parser.add_argument("--nesting", type=int, default=0,
+                        help="the number of groups nested in each top "
+                             "level group")
+    parser.add_argument("--page-size", type=int, default=1000,
+                        help="the LDAP search page size")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="the number of roles changed per round-trip")
+    parser.add_argument("--diff-engine", choices=['client', 'server'],
+                        default='client',
+                        help="compare the users with the roles on the "
+                             "client or the server")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="the number of times to run the sync")
+    parser.add_argument("--connstr",
+                        help="the connection string for a disposable "
+                             "Postgres server, instead of a temporary one")
+    parser.add_argument("--pg-bin",
+                        help="the directory containing initdb and pg_ctl")
+    parser.add_argument("--output",
+                        help="a file to write the results to, as JSON")
+    args = parser.parse_args()
+
+    if args.connstr is not None:
+        runs = run(args, args.connstr)
+    else:
+        with throwaway_postgres(args.pg_bin) as connstr:
+            runs = run(args, connstr)
+
+    print_results(runs)
+
+    if args.output is not None:
+        parameters = {name: value for name, value in vars(args).items()
+                      if name not in ('connstr', 'pg_bin', 'output')}
+        write_results(args.output, 'sync', parameters, runs)
+
+
+if __name__ == '__main__':
+    main()
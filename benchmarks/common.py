@@ -0,0 +1,187 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Shared helpers for the pgldapsync benchmarks."""
+
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import configparser
+
+from ldap3 import Connection, MOCK_SYNC, OFFLINE_SLAPD_2_4, Server
+
+
+MOCK_BASE_DN = 'ou=people,dc=example,dc=com'
+MOCK_GROUP_BASE_DN = 'ou=groups,dc=example,dc=com'
+MOCK_BIND_DN = 'cn=admin,dc=example,dc=com'
+MOCK_BIND_PASSWORD = 'secret'
+
+
+def default_config():
+    """Get a config object populated with the application defaults.
+
+    Returns:
+        ConfigParser: The config object
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'pgldapsync', 'config_default.ini'))
+
+    return config
+
+
+def synthetic_names(count, prefix='user'):
+    """Generate a list of unique synthetic user names.
+
+    Args:
+        count (int): The number of names to generate
+        prefix (str): The prefix for each name
+    Returns:
+        str[]: The list of names
+    """
+    return ['%s%07d' % (prefix, i) for i in range(count)]
+
+
+def timed(func, *args, **kwargs):
+    """Run a function, and time it.
+
+    Args:
+        func (callable): The function to run
+    Returns:
+        tuple: The elapsed wall clock time in seconds, and the result
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+
+    return time.perf_counter() - start, result
+
+
+def mock_ldap_connection(config, count, attribute_size=0, groups=0,
+                         nesting=0):
+    """Create an in-process mock LDAP server populated with a synthetic
+    directory, and configure the application to search it. Users are
+    assigned to groups round-robin. Groups are nested in chains, so that
+    each group is a member of the previous group in its chain.
+
+    Args:
+        config (ConfigParser): The application configuration to update
+        count (int): The number of users to create
+        attribute_size (int): The size of an additional description
+            attribute for each user, in bytes
+        groups (int): The number of groups to create
+        nesting (int): The number of groups nested in each top level group
+    Returns:
+        ldap3.core.connection.Connection: A bound connection to the server
+    """
+    server = Server('mock_ldap', get_info=OFFLINE_SLAPD_2_4)
+    conn = Connection(server, MOCK_BIND_DN, MOCK_BIND_PASSWORD,
+                      client_strategy=MOCK_SYNC)
+
+    conn.strategy.add_entry(MOCK_BIND_DN, {'userPassword': MOCK_BIND_PASSWORD,
+                                           'sn': 'admin'})
+
+    members = {name: [] for name in synthetic_names(groups, 'group')}
+    group_names = list(members.keys())
+
+    for i, name in enumerate(synthetic_names(count)):
+        dn = 'uid=%s,%s' % (name, MOCK_BASE_DN)
+        attributes = {'uid': name,
+                      'objectClass': ['inetOrgPerson'],
+                      'cn': name,
+                      'sn': name}
+        if attribute_size > 0:
+            attributes['description'] = 'x' * attribute_size
+        conn.strategy.add_entry(dn, attributes)
+
+        if groups > 0:
+            members[group_names[i % groups]].append(dn)
+
+    for i, name in enumerate(group_names):
+        if nesting > 0 and i % (nesting + 1) != nesting and \
+                i + 1 < len(group_names):
+            members[group_names[i + 1]].append(
+                'cn=%s,%s' % (name, MOCK_GROUP_BASE_DN))
+
+    for name, dns in members.items():
+        conn.strategy.add_entry('cn=%s,%s' % (name, MOCK_GROUP_BASE_DN),
+                                {'cn': name,
+                                 'objectClass': ['groupOfNames'],
+                                 'member': dns or [MOCK_BIND_DN]})
+    conn.bind()
+
+    config.set('ldap', 'server_uri', 'ldap://mock_ldap')
+    config.set('ldap', 'base_dn', MOCK_BASE_DN)
+    config.set('ldap', 'filter_string', '(objectClass=inetOrgPerson)')
+    config.set('ldap', 'username_attribute', 'uid')
+
+    if groups > 0:
+        config.set('ldap', 'group_base_dn', MOCK_GROUP_BASE_DN)
+        config.set('ldap', 'group_filter_string', '(objectClass=groupOfNames)')
+        config.set('ldap', 'group_nested', 'true' if nesting > 0 else 'false')
+
+    return conn
+
+
+@contextlib.contextmanager
+def throwaway_postgres(bin_dir=None):
+    """Run a temporary Postgres cluster, listening only on a Unix socket in
+    a temporary directory, which is removed when the cluster is stopped.
+    Durability is disabled for speed.
+
+    Args:
+        bin_dir (str): The directory containing initdb and pg_ctl, or None
+            to search the PATH
+    Yields:
+        str: The connection string for the cluster
+    """
+    initdb = shutil.which('initdb', path=bin_dir)
+    pg_ctl = shutil.which('pg_ctl', path=bin_dir)
+    if initdb is None or pg_ctl is None:
+        raise RuntimeError("initdb and pg_ctl were not found, use --pg-bin "
+                           "or --connstr")
+
+    with tempfile.TemporaryDirectory(prefix='pgldapsync_bench_') as directory:
+        data = os.path.join(directory, 'data')
+        subprocess.run([initdb, '--no-sync', '-A', 'trust', '-U', 'postgres',
+                        '-D', data], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([pg_ctl, '-w', '-D', data,
+                        '-l', os.path.join(directory, 'postgres.log'),
+                        '-o', "-F -c listen_addresses='' -k %s" % directory,
+                        'start'], check=True, stdout=subprocess.DEVNULL)
+
+        try:
+            yield 'host=%s dbname=postgres user=postgres' % directory
+        finally:
+            subprocess.run([pg_ctl, '-w', '-D', data, '-m', 'immediate',
+                            'stop'], check=False, stdout=subprocess.DEVNULL)
+
+
+def write_results(file, benchmark, parameters, runs):
+    """Write benchmark results as JSON, so that runs can be compared.
+
+    Args:
+        file (str): The file to write
+        benchmark (str): The benchmark name
+        parameters (dict): The benchmark parameters
+        runs (list): The results of each run
+    """
+    with open(file, 'w', encoding='utf-8') as results:
+        json.dump({'benchmark': benchmark,
+                   'python': platform.python_version(),
+                   'timestamp': time.time(),
+                   'parameters': parameters,
+                   'runs': runs}, results, indent=2)
+        results.write('\n')
@@ -0,0 +1,267 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""LDAP search snapshot cache functions."""
+
+import gc
+import hashlib
+import marshal
+import os
+import sys
+import time
+
+from ldap3 import BASE
+from ldap3.core.exceptions import LDAPException
+from ldap3.core.results import RESULT_SUCCESS
+
+from ..syncutils.metrics import METRICS
+from .connection import get_search_response
+
+
+# The first line of a snapshot file. marshal's format may change between
+# Python versions, so snapshots written by another version are ignored.
+SNAPSHOT_MAGIC = b'pgldapsync snapshot 1 %d\n' % marshal.version
+
+
+def get_snapshot_file(config, search, attributes):
+    """Get the name of the snapshot file for a search. Snapshots are keyed
+    by the server, bind user, base DN, filter, scope and attributes.
+
+    Args:
+        config (ConfigParser): The application configuration
+        search (tuple): The base DN, filter and scope of the search
+        attributes (str[]): The attributes to fetch
+    Returns:
+        str: The snapshot file name, or None if the cache is disabled
+    """
+    cache_dir = config.get('ldap', 'cache_dir')
+    if cache_dir == '':
+        return None
+
+    digest = hashlib.sha256()
+    for value in [config.get('ldap', 'server_uri'),
+                  config.get('ldap', 'bind_username')] + list(search) + \
+            attributes:
+        digest.update(value.encode('utf-8'))
+        digest.update(b'\0')
+
+    return os.path.join(cache_dir, '%s.snapshot' % digest.hexdigest())
+
+
+def get_directory_version(conn, base_dn):
+    """Get a value that changes whenever the directory containing a base DN
+    is modified: the highestCommittedUSN of an Active Directory domain
+    controller, or the contextCSN of the naming context on servers that
+    support syncrepl, such as OpenLDAP.
+
+    Args:
+        conn (ldap3.core.connection.Connection): The LDAP connection object
+        base_dn (str): The base DN of the search
+    Returns:
+        str: The directory version, or None if it cannot be determined
+    """
+    def read_attributes(dn, attributes):
+        response, result = get_search_response(
+            conn, conn.search(dn, '(objectClass=*)', BASE,
+                              attributes=attributes))
+        if result is None or result['result'] != RESULT_SUCCESS:
+            return {}
+        for entry in response or []:
+            if entry['type'] == 'searchResEntry':
+                return entry['raw_attributes']
+        return {}
+
+    try:
+        with METRICS.phase('ldap_search'):
+            root_dse = read_attributes('', ['highestCommittedUSN',
+                                            'namingContexts'])
+            usn = root_dse.get('highestCommittedUSN')
+            if usn:
+                return 'usn:%s' % usn[0].decode('utf-8')
+
+            # Find the naming context holding the base DN
+            contexts = [context.decode('utf-8')
+                        for context in root_dse.get('namingContexts', [])
+                        if base_dn.lower().endswith(
+                            context.decode('utf-8').lower())]
+            if len(contexts) == 0:
+                return None
+
+            csns = read_attributes(max(contexts, key=len),
+                                   ['contextCSN']).get('contextCSN')
+            if not csns:
+                return None
+            return 'csn:%s' % ';'.join(sorted(csn.decode('utf-8')
+                                              for csn in csns))
+    except LDAPException:
+        return None
+
+
+def read_snapshot(file, version):
+    """Read a snapshot file.
+
+    Args:
+        file (str): The snapshot file
+        version (str): The directory version the snapshot must have been
+            taken at, or None if any version will do
+    Returns:
+        list: The entries, as returned by get_snapshot_row(), or None if
+            the snapshot can't be used
+    """
+    try:
+        with open(file, 'rb') as snapshot:
+            if snapshot.readline() != SNAPSHOT_MAGIC:
+                return None
+            data = snapshot.read()
+    except FileNotFoundError:
+        return None
+    except OSError as exception:
+        sys.stderr.write("Error reading LDAP snapshot file %s: %s\n" %
+                         (file, exception))
+        return None
+
+    # Unmarshalling creates a few containers per entry, none of which can
+    # be garbage, so don't let the collector repeatedly scan them.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        snapshot_version, rows = marshal.loads(data)
+    except (EOFError, ValueError, TypeError) as exception:
+        sys.stderr.write("Error reading LDAP snapshot file %s: %s\n" %
+                         (file, exception))
+        return None
+    finally:
+        if enabled:
+            gc.enable()
+
+    if version is not None and snapshot_version != version:
+        return None
+
+    return rows
+
+
+def get_snapshot_entries(rows, attributes):
+    """Convert the entries read from a snapshot to the form of ldap3 search
+    response entries. The raw attribute values are returned as the
+    attribute values too, as they are not formatted for the schema.
+
+    Args:
+        rows (list): The entries, as returned by get_snapshot_row()
+        attributes (str[]): The attributes in the snapshot
+    Yields:
+        dict: ldap3 search response entries
+    """
+    for dn, values in rows:
+        raw_attributes = dict(zip(attributes, values))
+        yield {'type': 'searchResEntry', 'dn': dn,
+               'raw_attributes': raw_attributes,
+               'attributes': raw_attributes}
+
+
+def get_snapshot_row(entry, attributes):
+    """Get the compact form of a search response entry to be written to a
+    snapshot, keeping only the raw values of the requested attributes.
+
+    Args:
+        entry (dict): The ldap3 search response entry
+        attributes (str[]): The attributes to keep
+    Returns:
+        tuple: The DN, and the list of values of each attribute
+    """
+    return entry['dn'], [list(entry['raw_attributes'].get(attribute, []))
+                         for attribute in attributes]
+
+
+def write_snapshot(file, version, rows):
+    """Write a snapshot file. The file is written to a temporary name and
+    renamed into place, so it is never left partially written and
+    concurrent runs can share it.
+
+    Args:
+        file (str): The snapshot file
+        version (str): The directory version when the search started, if
+            known
+        rows (list): The entries, as returned by get_snapshot_row()
+    """
+    temp_file = '%s.%d.tmp' % (file, os.getpid())
+
+    try:
+        descriptor = os.open(temp_file,
+                             os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(descriptor, 'wb') as snapshot:
+            snapshot.write(SNAPSHOT_MAGIC)
+            snapshot.write(marshal.dumps((version, rows)))
+        os.replace(temp_file, file)
+    except OSError as exception:
+        sys.stderr.write("Error writing LDAP snapshot file %s: %s\n" %
+                         (file, exception))
+
+
+def write_snapshot_entries(file, version, attributes, entries):
+    """Pass through the entries from a search, and write them to a snapshot
+    once they have all been read.
+
+    Args:
+        file (str): The snapshot file
+        version (str): The directory version when the search started, if
+            known
+        attributes (str[]): The attributes to keep
+        entries (iterable): ldap3 search response entries
+    Yields:
+        dict: ldap3 search response entries
+    """
+    rows = []
+    for entry in entries:
+        rows.append(get_snapshot_row(entry, attributes))
+        yield entry
+
+    write_snapshot(file, version, rows)
+
+
+def get_snapshot(config, conn, file, base_dn):
+    """Get the entries from a snapshot, if it is fresh enough. Snapshots
+    younger than the cache_ttl are used as they are. Older snapshots are
+    used if the directory version shows that nothing has changed since they
+    were taken, in which case they are refreshed for another cache_ttl.
+
+    Args:
+        config (ConfigParser): The application configuration
+        conn (ldap3.core.connection.Connection): The LDAP connection object
+        file (str): The snapshot file
+        base_dn (str): The base DN of the search
+    Returns:
+        tuple: The entries, as returned by get_snapshot_row(), or None if
+            the search must be run, and the current directory version, if
+            it was read
+    """
+    try:
+        age = time.time() - os.stat(file).st_mtime
+    except OSError:
+        return None, get_directory_version(conn, base_dn)
+
+    if age < config.getint('ldap', 'cache_ttl'):
+        with METRICS.phase('ldap_cache_read'):
+            rows = read_snapshot(file, None)
+        if rows is not None:
+            return rows, None
+
+    version = get_directory_version(conn, base_dn)
+    if version is None:
+        return None, None
+
+    with METRICS.phase('ldap_cache_read'):
+        rows = read_snapshot(file, version)
+    if rows is not None:
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+
+    return rows, version
@@ -16,9 +16,11 @@
 import ssl
 import sys
 
-from ldap3 import Connection, Server, Tls
-from ldap3.core.exceptions import LDAPBindError, LDAPSocketOpenError, \
-    LDAPStartTLSError
+from ldap3 import ASYNC, FIRST, SYNC, Connection, Server, ServerPool, Tls
+from ldap3.core.exceptions import LDAPBindError, \
+    LDAPServerPoolExhaustedError, LDAPSocketOpenError, LDAPStartTLSError
+
+from ..syncutils.metrics import METRICS
 
 
 try:
@@ -27,77 +29,117 @@ except ImportError:
     from urlparse import urlparse
 
 
-def connect_ldap_server(config):
-    """Setup the connection to the LDAP server.
+def get_tls_config(config):
+    """Get the TLS configuration for LDAP connections.
 
     Args:
         config (ConfigParser): The application configuration
 
     Returns:
-        ldap3.core.connection.Connection: The LDAP connection object
+        ldap3.Tls: The TLS configuration object
     """
-    # Parse the server URI
-    uri = urlparse(config.get('ldap', 'server_uri'))
+    ca_cert_file = None
+    if config.get('ldap', 'ca_cert_file') != '':
+        ca_cert_file = config.get('ldap', 'ca_cert_file')
 
-    # Create the TLS configuration object if required
-    tls = None
+    cert_file = None
+    if config.get('ldap', 'cert_file') != '':
+        cert_file = config.get('ldap', 'cert_file')
+
+    key_file = None
+    if config.get('ldap', 'key_file') != '':
+        key_file = config.get('ldap', 'key_file')
+
+    return Tls(
+        local_private_key_file=key_file,
+        local_certificate_file=cert_file,
+        validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1,
+        ca_certs_file=ca_cert_file)
 
-    if uri.scheme == 'ldaps' or config.getboolean('ldap', 'use_starttls'):
 
-        ca_cert_file = None
-        if config.get('ldap', 'ca_cert_file') != '':
-            ca_cert_file = config.get('ldap', 'ca_cert_file')
+def connect_ldap_server(config, index=0):
+    """Setup the connection to the LDAP server. If more than one server URI
+    is configured, each connection prefers a different server (chosen by
+    its index, round-robin), failing over to the others in turn.
 
-        cert_file = None
-        if config.get('ldap', 'cert_file') != '':
-            cert_file = config.get('ldap', 'cert_file')
+    Args:
+        config (ConfigParser): The application configuration
+        index (int): The number of the connection, when making several
+
+    Returns:
+        ldap3.core.connection.Connection: The LDAP connection object
+    """
+    # Parse the server URIs
+    uris = [urlparse(uri) for uri in config.get('ldap', 'server_uri').split()]
 
-        key_file = None
-        if config.get('ldap', 'key_file') != '':
-            key_file = config.get('ldap', 'key_file')
+    # Create the TLS configuration object if required
+    tls = None
 
-        tls = Tls(
-            local_private_key_file=key_file,
-            local_certificate_file=cert_file,
-            validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1,
-            ca_certs_file=ca_cert_file)
+    if any(uri.scheme == 'ldaps' for uri in uris) or \
+            config.getboolean('ldap', 'use_starttls'):
+        tls = get_tls_config(config)
 
     # Debug
     if config.getboolean('ldap', 'debug'):
         sys.stderr.write("TLS/SSL configuration:   %s\n" % tls)
 
-    # Create the server object
-    server = Server(uri.hostname,
-                    port=uri.port,
-                    tls=tls,
-                    use_ssl=uri.scheme == 'ldaps')
+    # Create the server object. ldap3's round-robin pools start from a
+    # random server for each connection, so the servers are rotated instead
+    # to spread the connections evenly.
+    servers = [Server(uri.hostname,
+                      port=uri.port,
+                      tls=tls,
+                      use_ssl=uri.scheme == 'ldaps')
+               for uri in uris]
+    if len(servers) == 1:
+        server = servers[0]
+    else:
+        index = index % len(servers)
+        server = ServerPool(servers[index:] + servers[:index], FIRST,
+                            active=1)
 
     # Debug
     if config.getboolean('ldap', 'debug'):
         sys.stderr.write("LDAP server config:      %s\n" % server)
 
-    # Create the connection
-    conn = None
+    # Get the I/O strategy
+    strategy = {'sync': SYNC, 'async': ASYNC}.get(
+        config.get('ldap', 'strategy').lower())
+    if strategy is None:
+        sys.stderr.write("Invalid LDAP strategy: %s\n" %
+                         config.get('ldap', 'strategy'))
+        return None
+
+    # Create the connection. Connecting and binding are done separately so
+    # they can be timed separately.
+    credentials = {}
+    if config.get('ldap', 'bind_username') != '':
+        credentials = {'user': config.get('ldap', 'bind_username'),
+                       'password': config.get('ldap', 'bind_password')}
+    conn = Connection(server, client_strategy=strategy, collect_usage=True,
+                      **credentials)
+
     try:
-        if config.get('ldap', 'bind_username') == '':
-            conn = Connection(server, auto_bind=True)
-        else:
-            conn = Connection(server,
-                              config.get('ldap', 'bind_username'),
-                              config.get('ldap', 'bind_password'),
-                              auto_bind=True)
-    except LDAPSocketOpenError as exception:
+        with METRICS.phase('ldap_connect'):
+            conn.open()
+        with METRICS.phase('ldap_bind'):
+            if not conn.bind():
+                raise LDAPBindError(conn.last_error)
+    except (LDAPSocketOpenError, LDAPServerPoolExhaustedError) as exception:
         sys.stderr.write("Error connecting to the LDAP server: %s\n" %
                          exception)
+        conn = None
     except LDAPBindError as exception:
         sys.stderr.write("Error binding to the LDAP server: %s\n" % exception)
+        conn = None
 
     # Debug
     if config.getboolean('ldap', 'debug'):
         sys.stderr.write("Initial LDAP connection: %s\n" % conn)
 
     # Enable TLS if STARTTLS is configured
-    if uri.scheme != 'ldaps' and config.getboolean('ldap', 'use_starttls'):
+    if conn is not None and not conn.server.ssl and \
+            config.getboolean('ldap', 'use_starttls'):
         try:
             conn.start_tls()
         except LDAPStartTLSError as exception:
@@ -109,3 +151,21 @@ def connect_ldap_server(config):
         sys.stderr.write("Final LDAP connection:   %s\n" % conn)
 
     return conn
+
+
+def get_search_response(conn, request):
+    """Get the response to a search. With a synchronous strategy, this is
+    the response to the last search made on the connection; with an
+    asynchronous strategy, this waits for the response to the given
+    request.
+
+    Args:
+        conn (ldap3.core.connection.Connection): The LDAP connection object
+        request (int): The return value of conn.search()
+    Returns:
+        tuple: The ldap3 search response entries, and the result
+    """
+    if conn.strategy.sync:
+        return conn.response, conn.result
+
+    return conn.get_response(request)
@@ -0,0 +1,262 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""LDAP group functions."""
+
+import collections
+import sys
+
+from .users import get_entry_value, search_ldap_directory
+
+
+LdapGroup = collections.namedtuple('LdapGroup', ['name', 'users', 'groups'])
+LdapGroup.__doc__ = """A group found by the group search.
+
+    name (str): The group name
+    users (set): The user names of the group members
+    groups (set): The lower case DNs of members that may be nested groups
+"""
+
+
+class UserDnIndex:
+    """Maps the DNs of users seen in search results to their user names, so
+    that group members can be resolved without further searches."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        """Create an empty index."""
+        self.attributes = []
+        self.users = {}
+
+    def observe(self, entry, user):
+        """Add a search response entry to the index.
+
+        Args:
+            entry (dict): The ldap3 search response entry
+            user (str): The user name from the entry
+        """
+        if user is not None:
+            self.users[entry['dn'].lower()] = user
+
+
+def groups_enabled(config):
+    """Is the group search configured?
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        bool: True if the group base DN and filter are configured
+    """
+    return config.get('ldap', 'group_base_dn') != '' and \
+        config.get('ldap', 'group_filter_string') != ''
+
+
+def group_filters_enabled(config):
+    """Are users or admin users selected by group membership?
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        bool: True if user_group_dn or admin_group_dn is configured
+    """
+    return config.get('ldap', 'user_group_dn') != '' or \
+        config.get('ldap', 'admin_group_dn') != ''
+
+
+def get_entry_values(entry, attribute):
+    """Get all the values of an attribute from a search response entry.
+
+    Args:
+        entry (dict): The ldap3 search response entry
+        attribute (str): The attribute name
+    Returns:
+        list: The attribute values
+    """
+    values = entry['attributes'].get(attribute)
+
+    if values is None:
+        return []
+    if not isinstance(values, list):
+        values = [values]
+
+    return [value.decode('utf-8') if isinstance(value, bytes) else value
+            for value in values]
+
+
+def expand_nested_groups(groups):
+    """Expand the members of nested groups, so each group includes the users
+    of every group nested within it, at any depth. Each group is visited
+    once, and the users found are memoised so that groups nested in more
+    than one parent are only expanded once. Cycles are detected by finding
+    the strongly connected components of the group graph (Tarjan's
+    algorithm); all the groups in a cycle have the same members.
+
+    Args:
+        groups (dict): The LdapGroup for each lower case group DN
+    Returns:
+        dict: The frozenset of user names for each lower case group DN
+    """
+    closure = {}
+    index = {}
+    lowlink = {}
+    reached = {}
+    stack = []
+
+    def enter(dn):
+        index[dn] = lowlink[dn] = len(index)
+        reached[dn] = set(groups[dn].users)
+        stack.append(dn)
+
+    def leave(dn):
+        # If this group is the root of a strongly connected component, every
+        # group in the component has the same members.
+        if lowlink[dn] == index[dn]:
+            component = []
+            while True:
+                member = stack.pop()
+                component.append(member)
+                if member == dn:
+                    break
+
+            users = set()
+            for member in component:
+                users.update(reached.pop(member))
+            users = frozenset(users)
+            for member in component:
+                closure[member] = users
+
+    def visit(root):
+        # The groups are walked depth first with an explicit stack, rather
+        # than recursively, so deep nesting can't exceed the recursion
+        # limit. Each frame holds a group, and an iterator over the groups
+        # nested within it that have yet to be followed.
+        enter(root)
+        frames = [(root, iter(groups[root].groups))]
+
+        while len(frames) > 0:
+            dn, children = frames[-1]
+
+            for child in children:
+                if child not in groups:
+                    continue
+
+                if child not in index:
+                    enter(child)
+                    frames.append((child, iter(groups[child].groups)))
+                    break
+
+                if child not in closure:
+                    # The child is on the stack, so we've found a cycle
+                    lowlink[dn] = min(lowlink[dn], index[child])
+                else:
+                    reached[dn].update(closure[child])
+            else:
+                frames.pop()
+                leave(dn)
+
+                if len(frames) > 0:
+                    parent = frames[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[dn])
+                    if dn in closure:
+                        reached[parent].update(closure[dn])
+
+    for dn in groups:
+        if dn not in index:
+            visit(dn)
+
+    return closure
+
+
+def get_ldap_groups(config, conn, user_dns):
+    """Get the groups and their member users from the LDAP server. Members
+    may be DNs (e.g. member or uniqueMember) which are resolved using the
+    DNs of the users found in the user search, or user names (e.g.
+    memberUid). If group_nested is enabled, members that are groups found
+    by the same search are expanded, otherwise members that are not users
+    are ignored. All groups are read in a single search, and nesting is
+    resolved locally.
+
+    Args:
+        config (ConfigParser): The application configuration
+        conn (ldap3.core.connection.Connection): The LDAP connection object
+        user_dns (UserDnIndex): The DNs of the users
+    Returns:
+        dict: The LdapGroup for each lower case group DN
+    """
+    name_attribute = config.get('ldap', 'group_name_attribute')
+    member_attribute = config.get('ldap', 'group_member_attribute')
+    users = frozenset(user_dns.users.values())
+
+    search = (config.get('ldap', 'group_base_dn'),
+              config.get('ldap', 'group_filter_string'),
+              config.get('ldap', 'group_search_scope'))
+
+    groups = {}
+    for entry in search_ldap_directory(config, conn, search,
+                                       [name_attribute, member_attribute],
+                                       True):
+        name = get_entry_value(entry, name_attribute)
+        if name is None:
+            continue
+
+        group = LdapGroup(name, set(), set())
+        for member in get_entry_values(entry, member_attribute):
+            user = user_dns.users.get(member.lower())
+            if user is not None:
+                group.users.add(user)
+            elif member in users:
+                group.users.add(member)
+            else:
+                group.groups.add(member.lower())
+
+        groups[entry['dn'].lower()] = group
+
+    if config.getboolean('ldap', 'group_nested'):
+        closure = expand_nested_groups(groups)
+        groups = {dn: group._replace(users=closure[dn])
+                  for dn, group in groups.items()}
+
+    return groups
+
+
+def get_group_members(groups):
+    """Get the member user names of each group, by group name.
+
+    Args:
+        groups (dict): The LdapGroup for each lower case group DN
+    Returns:
+        dict: The set of member user names for each group name
+    """
+    members = {}
+    for group in groups.values():
+        members.setdefault(group.name, set()).update(group.users)
+
+    return members
+
+
+def get_group_filter(groups, dn):
+    """Get the users that are members of a group, for selecting users by
+    group membership.
+
+    Args:
+        groups (dict): The LdapGroup for each lower case group DN
+        dn (str): The DN of the group
+    Returns:
+        frozenset: The member user names, or None if the group was not
+            found by the group search
+    """
+    group = groups.get(dn.lower())
+    if group is None:
+        sys.stderr.write("Error: the group %s was not found by the group "
+                         "search.\n" % dn)
+        return None
+
+    return frozenset(group.users)
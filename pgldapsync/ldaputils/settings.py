@@ -0,0 +1,161 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""LDAP user setting functions."""
+
+import ast
+import collections
+import sys
+
+from ..pgutils.policy import GUC_NAME_PATTERN
+
+
+UserSettings = collections.namedtuple('UserSettings', ['connection_limit',
+                                                       'settings'])
+UserSettings.__doc__ = """The role settings taken from the attributes of an
+    LDAP user.
+
+    connection_limit (int): The connection limit, or None if not set
+    settings (frozenset): (database, name, value) tuples for each setting,
+        where database is empty if the setting applies to all databases
+"""
+
+
+def get_setting_attributes(config):
+    """Parse and validate the setting_attributes option.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        list: A list of (name, attribute, database, values) tuples, where
+            database is empty if the setting applies to all databases, and
+            values maps attribute values to setting values, or is None if
+            the attribute value is used as it is
+    """
+    try:
+        mapping = ast.literal_eval(config.get('ldap', 'setting_attributes'))
+    except (SyntaxError, ValueError) as exception:
+        sys.stderr.write("Error parsing setting_attributes: %s\n" % exception)
+        sys.exit(1)
+
+    if not isinstance(mapping, dict):
+        sys.stderr.write("Error parsing setting_attributes: not a "
+                         "dictionary\n")
+        sys.exit(1)
+
+    settings = []
+    for name, setting in mapping.items():
+        if not GUC_NAME_PATTERN.match(str(name)) or \
+                not isinstance(setting, (list, tuple)) or \
+                len(setting) not in (2, 3) or \
+                (len(setting) == 3 and not isinstance(setting[2], dict)):
+            sys.stderr.write("Error parsing setting_attributes: invalid "
+                             "setting for %s\n" % name)
+            sys.exit(1)
+
+        values = None
+        if len(setting) == 3:
+            values = {str(key): str(value)
+                      for key, value in setting[2].items()}
+
+        settings.append((name.lower(), str(setting[0]), str(setting[1]),
+                         values))
+
+    return settings
+
+
+def user_settings_enabled(config):
+    """Are any role settings taken from LDAP attributes?
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        bool: True if setting_attributes or connection_limit_attribute is
+            configured
+    """
+    return len(get_setting_attributes(config)) > 0 or \
+        config.get('ldap', 'connection_limit_attribute') != ''
+
+
+class UserSettingsIndex:
+    """Collects the role settings for each user from the attributes of the
+    search results, so they are read by the same search as the user names.
+    Many users usually share the same settings, so each distinct set of
+    settings is only held once."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, config):
+        """Create an empty index.
+
+        Args:
+            config (ConfigParser): The application configuration
+        """
+        self.settings = get_setting_attributes(config)
+        self.limit_attribute = config.get('ldap',
+                                          'connection_limit_attribute')
+
+        self.attributes = sorted(set(
+            [attribute for _, attribute, _, _ in self.settings] +
+            ([self.limit_attribute] if self.limit_attribute != '' else [])))
+        self.users = {}
+        self.distinct = {}
+
+    @staticmethod
+    def _value(entry, attribute):
+        """Get the first value of an attribute.
+
+        Args:
+            entry (dict): The ldap3 search response entry
+            attribute (str): The attribute name
+        Returns:
+            str: The value, or None if it is not present
+        """
+        values = entry['raw_attributes'].get(attribute)
+        if not values:
+            return None
+
+        return values[0].decode('utf-8')
+
+    def observe(self, entry, user):
+        """Record the settings of a user from a search response entry.
+
+        Args:
+            entry (dict): The ldap3 search response entry
+            user (str): The user name from the entry
+        """
+        if user is None:
+            return
+
+        settings = set()
+        for name, attribute, database, values in self.settings:
+            value = self._value(entry, attribute)
+            if value is not None and values is not None:
+                value = values.get(value)
+            if value is not None:
+                settings.add((database, name, value))
+
+        limit = None
+        if self.limit_attribute != '':
+            value = self._value(entry, self.limit_attribute)
+            if value is not None:
+                try:
+                    limit = int(value)
+                except ValueError:
+                    sys.stderr.write("Invalid connection limit for user %s: "
+                                     "%s\n" % (user, value))
+
+        if limit is None and len(settings) == 0:
+            self.users.pop(user, None)
+            return
+
+        user_settings = UserSettings(limit, frozenset(settings))
+        self.users[user] = self.distinct.setdefault(user_settings,
+                                                    user_settings)
@@ -10,73 +10,563 @@
 
 """LDAP user functions."""
 
+import concurrent.futures
+import itertools
+import queue
 import sys
+import threading
 
 from ldap3.core.exceptions import LDAPInvalidFilterError, \
     LDAPInvalidScopeError, LDAPAttributeError
+from ldap3.core.results import RESULT_SUCCESS
+from ldap3.utils.conv import escape_filter_chars
 
+from ..syncutils.metrics import METRICS
+from ..syncutils.throttle import get_rate_limiter
+from .cache import get_snapshot, get_snapshot_entries, get_snapshot_file, \
+    write_snapshot_entries
+from .connection import connect_ldap_server, get_search_response
 
-def get_ldap_users(config, conn, admin):
-    """Get a list of users from the LDAP server.
+
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+# The number of entries passed at a time from a concurrent search to the
+# thread reading the results
+PARTITION_BATCH_SIZE = 100
+
+
+def get_config_lines(config, option):
+    """Get an [ldap] setting that may have a value on each line, such as a
+    list of DNs (which can't be comma delimited).
+
+    Args:
+        config (ConfigParser): The application configuration
+        option (str): The option name
+    Returns:
+        str[]: The non-empty lines
+    """
+    return [line.strip() for line in config.get('ldap', option).splitlines()
+            if line.strip() != '']
+
+
+def get_entry_value(entry, attribute):
+    """Get the first value of an attribute from a search response entry.
+
+    Args:
+        entry (dict): The ldap3 search response entry
+        attribute (str): The attribute name
+    Returns:
+        str: The attribute value, or None if it is not present
+    """
+    value = entry['attributes'].get(attribute)
+
+    if isinstance(value, list):
+        if len(value) == 0:
+            return None
+        value = value[0]
+
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+
+    if value is None or value == '':
+        return None
+
+    return value
+
+
+def get_paged_cookie(result):
+    """Get the Simple Paged Results cookie from a search result.
+
+    Args:
+        result (dict): The ldap3 search result
+    Returns:
+        bytes: The cookie, or None if there are no more pages
+    """
+    try:
+        return result['controls'][PAGED_RESULTS_OID]['value']['cookie']
+    except (KeyError, TypeError):
+        return None
+
+
+def search_ldap_directory(config, conn, search, attributes, cached=False):
+    """Search the LDAP directory, or read the results from a snapshot taken
+    by an earlier search if the cache is enabled and the snapshot is fresh.
+    Snapshots are written when the results are read from the server. The
+    search is started straight away, so with an asynchronous connection
+    strategy, several searches may be in progress at once.
 
     Args:
         config (ConfigParser): The application configuration
         conn (ldap3.core.connection.Connection): The LDAP connection object
-        admin (bool): Return users in the admin group?
+        search (tuple): The base DN, filter and scope of the search
+        attributes (str[]): The attributes to fetch
+        cached (bool): May the results be cached? Searches whose filters
+            change between runs should not be.
     Returns:
-        str[]: A list of user names
+        iterator: ldap3 search response entries
     """
-    users = []
+    file = get_snapshot_file(config, search, attributes) if cached else None
+    if file is None:
+        return PagedSearch(config, conn, search, attributes)
+
+    rows, version = get_snapshot(config, conn, file, search[0])
+    if rows is not None:
+        METRICS.count('ldap_cache_hits')
+        METRICS.count('ldap_entries', len(rows))
+        return get_snapshot_entries(rows, attributes)
+
+    METRICS.count('ldap_cache_misses')
+    return write_snapshot_entries(file, version, attributes,
+                                  PagedSearch(config, conn, search,
+                                              attributes))
+
+
+class PagedSearch:
+    """A search of the LDAP directory, requesting results one page at a time
+    using the Simple Paged Results control if a page_size is configured.
+    The request for each page is sent before the entries in the previous
+    page are returned, so with an asynchronous connection strategy,
+    processing them overlaps with receiving the next page."""
+
+    def __init__(self, config, conn, search, attributes):
+        """Start a search.
+
+        Args:
+            config (ConfigParser): The application configuration
+            conn (ldap3.core.connection.Connection): The LDAP connection
+            search (tuple): The base DN, filter and scope of the search
+            attributes (str[]): The attributes to fetch
+        """
+        self.conn = conn
+        self.search = search
+        self.attributes = attributes
+        self.page_size = config.getint('ldap', 'page_size')
+        self.limiter = get_rate_limiter('ldap_pages')
+        self.pending = None
+        self.send(None)
+
+    def send(self, cookie):
+        """Send the request for a page of results. With a synchronous
+        strategy, the response is kept, as it is replaced by the next
+        search on the connection.
+
+        Args:
+            cookie (bytes): The cookie from the previous page, if any
+        """
+        base_dn, search_filter, scope = self.search
+
+        if self.limiter is not None:
+            waited = self.limiter.acquire()
+            if waited > 0:
+                METRICS.count('ldap_throttle_wait_seconds', waited)
+
+        try:
+            with METRICS.phase('ldap_search'):
+                request = self.conn.search(
+                    base_dn,
+                    search_filter,
+                    scope,
+                    attributes=self.attributes,
+                    paged_size=self.page_size if self.page_size > 0
+                    else None,
+                    paged_cookie=cookie)
+        except LDAPInvalidScopeError as exception:
+            sys.stderr.write("Error searching the LDAP directory: %s\n" %
+                             exception)
+            sys.exit(1)
+        except LDAPAttributeError as exception:
+            sys.stderr.write("Error searching the LDAP directory: %s\n" %
+                             exception)
+            sys.exit(1)
+        except LDAPInvalidFilterError as exception:
+            sys.stderr.write("Error searching the LDAP directory: %s\n" %
+                             exception)
+            sys.exit(1)
+
+        if self.conn.strategy.sync:
+            self.pending = get_search_response(self.conn, request)
+        else:
+            self.pending = request
+
+    def receive(self):
+        """Wait for the page of results last requested, and request the
+        next page if there is one.
+
+        Returns:
+            list: ldap3 search response entries
+        """
+        if self.conn.strategy.sync:
+            response, result = self.pending
+        else:
+            with METRICS.phase('ldap_search'):
+                response, result = get_search_response(self.conn,
+                                                       self.pending)
+        self.pending = None
+
+        # Don't silently return partial results, e.g. if a server side size
+        # limit is hit.
+        if result['result'] != RESULT_SUCCESS:
+            sys.stderr.write("Error searching the LDAP directory: %s %s\n" %
+                             (result['description'], result['message']))
+            sys.exit(1)
+
+        entries = [entry for entry in response
+                   if entry['type'] == 'searchResEntry']
+        METRICS.count('ldap_round_trips')
+        METRICS.count('ldap_entries', len(entries))
+
+        cookie = get_paged_cookie(result)
+        if cookie:
+            self.send(cookie)
+
+        return entries
+
+    def __iter__(self):
+        """Get the entries found by the search.
+
+        Yields:
+            dict: ldap3 search response entries
+        """
+        while self.pending is not None:
+            yield from self.receive()
+
+
+def get_unique_entries(entries):
+    """Remove duplicates from search response entries, e.g. those found by
+    more than one search.
+
+    Args:
+        entries (iterable): ldap3 search response entries
+    Yields:
+        dict: ldap3 search response entries
+    """
+    seen = set()
+    for entry in entries:
+        dn = entry['dn'].lower()
+        if dn not in seen:
+            seen.add(dn)
+            yield entry
+
+
+class PartitionSearcher:
+    """Runs searches in worker threads, each using a connection from a
+    shared pool, and passes the entries found back to a single reader."""
+
+    def __init__(self, config, conns, attributes, cached):
+        """Create a searcher.
+
+        Args:
+            config (ConfigParser): The application configuration
+            conns (list): The LDAP connections to search with
+            attributes (str[]): The attributes to fetch
+            cached (bool): May the results be cached?
+        """
+        self.config = config
+        self.attributes = attributes
+        self.cached = cached
+        self.conns = queue.Queue()
+        for conn in conns:
+            self.conns.put(conn)
+        self.results = queue.Queue()
+        self.stop = threading.Event()
+
+    def search(self, search):
+        """Run a search, passing the entries back in batches. Once it is
+        complete, None is passed back with any exception raised.
+
+        Args:
+            search (tuple): The base DN, filter and scope of the search
+        """
+        conn = self.conns.get()
+        error = None
+        try:
+            batch = []
+            for entry in search_ldap_directory(self.config, conn, search,
+                                               self.attributes,
+                                               self.cached):
+                if self.stop.is_set():
+                    return
+                batch.append(entry)
+                if len(batch) == PARTITION_BATCH_SIZE:
+                    self.results.put((batch, None))
+                    batch = []
+            self.results.put((batch, None))
+        except BaseException as exception:  # pylint: disable=broad-except
+            # Including SystemExit, if an error has been reported
+            error = exception
+        finally:
+            self.conns.put(conn)
+            self.results.put((None, error))
+
+    def read(self, count):
+        """Read the entries passed back by the searches. If a search fails,
+        its exception is raised.
+
+        Args:
+            count (int): The number of searches
+        Yields:
+            dict: ldap3 search response entries
+        """
+        while count > 0:
+            with METRICS.phase('ldap_search_wait'):
+                batch, error = self.results.get()
+
+            if batch is None:
+                if error is not None:
+                    raise error
+                count = count - 1
+                continue
 
+            yield from batch
+
+
+def search_ldap_partitions(config, conn, searches, attributes, cached=False):
+    """Run several searches, for example of different base DNs or filter
+    partitions. With an asynchronous connection strategy, the searches are
+    all started at once on the connection. Otherwise, they are run
+    concurrently over up to search_connections connections. Entries found
+    by more than one search are only returned once.
+
+    Args:
+        config (ConfigParser): The application configuration
+        conn (ldap3.core.connection.Connection): The LDAP connection object
+        searches (list): The base DN, filter and scope of each search
+        attributes (str[]): The attributes to fetch
+        cached (bool): May the results be cached?
+    Returns:
+        iterator: ldap3 search response entries
+    """
+    if len(searches) == 1:
+        return search_ldap_directory(config, conn, searches[0], attributes,
+                                     cached)
+
+    if not conn.strategy.sync:
+        return get_unique_entries(interleave_entries(
+            [search_ldap_directory(config, conn, search, attributes, cached)
+             for search in searches], config.getint('ldap', 'page_size')))
+
+    return get_unique_entries(search_ldap_concurrently(config, conn, searches,
+                                                       attributes, cached))
+
+
+def interleave_entries(iterators, count):
+    """Read the entries from several searches in turn, a page at a time, so
+    that as each page is read, the request for the next page of that
+    search is sent and all the searches stay in progress.
+
+    Args:
+        iterators (list): The ldap3 search response entries from each search
+        count (int): The number of entries to read from each search in turn,
+            or 0 to read each search in full
+    Yields:
+        dict: ldap3 search response entries
+    """
+    iterators = list(iterators)
+    while len(iterators) > 0:
+        for iterator in list(iterators):
+            batch = list(itertools.islice(iterator, count or None))
+            if len(batch) == 0:
+                iterators.remove(iterator)
+            yield from batch
+
+
+def search_ldap_concurrently(config, conn, searches, attributes, cached):
+    """Run several searches concurrently over up to search_connections
+    connections, returning the entries as they arrive. Additional
+    connections are made as required, and closed when the searches are
+    complete.
+
+    Args:
+        config (ConfigParser): The application configuration
+        conn (ldap3.core.connection.Connection): The LDAP connection object
+        searches (list): The base DN, filter and scope of each search
+        attributes (str[]): The attributes to fetch
+        cached (bool): May the results be cached?
+    Yields:
+        dict: ldap3 search response entries
+    """
+    count = max(min(config.getint('ldap', 'search_connections'),
+                    len(searches)), 1)
+
+    conns = [conn]
+    try:
+        for index in range(1, count):
+            extra_conn = connect_ldap_server(config, index)
+            if extra_conn is None:
+                sys.exit(1)
+            conns.append(extra_conn)
+
+        searcher = PartitionSearcher(config, conns, attributes, cached)
+        with concurrent.futures.ThreadPoolExecutor(count) as executor:
+            try:
+                for search in searches:
+                    executor.submit(searcher.search, search)
+
+                yield from searcher.read(len(searches))
+            finally:
+                searcher.stop.set()
+    finally:
+        for extra_conn in conns[1:]:
+            extra_conn.unbind()
+
+
+class ChangeTracker:
+    """Tracks the highest value of a change attribute, such as
+    modifyTimestamp or uSNChanged, seen in search results. This may be
+    used as the starting point for a later incremental search."""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, attribute, watermark=None):
+        """Create a tracker.
+
+        Args:
+            attribute (str): The change attribute name
+            watermark (str): The highest value already seen, if any
+        """
+        self.attribute = attribute
+        self.attributes = [attribute]
+        self.watermark = watermark
+
+    @staticmethod
+    def _key(value):
+        """Get a sort key for a change attribute value. USNs are compared
+        numerically, and generalized times by their digits.
+
+        Args:
+            value (str): The change attribute value
+        Returns:
+            tuple: The sort key
+        """
+        if value.isdigit():
+            return int(value), value
+
+        return value.rstrip('Z').replace(',', '.'), value
+
+    def observe(self, entry, user):
+        """Update the watermark from a search response entry.
+
+        Args:
+            entry (dict): The ldap3 search response entry
+            user (str): The user name from the entry
+        """
+        # pylint: disable=unused-argument
+        values = entry['raw_attributes'].get(self.attribute)
+        if not values:
+            return
+
+        value = values[0].decode('utf-8')
+        if self.watermark is None or \
+                self._key(value) > self._key(self.watermark):
+            self.watermark = value
+
+
+def get_change_filter(search_filter, attribute, since):
+    """Restrict a search filter to entries changed since a watermark.
+
+    Args:
+        search_filter (str): The search filter
+        attribute (str): The change attribute name
+        since (str): The watermark value, or None for all entries
+    Returns:
+        str: The search filter
+    """
+    if since is None:
+        return search_filter
+
+    return '(&%s(%s>=%s))' % (search_filter, attribute,
+                              escape_filter_chars(since))
+
+
+def get_ldap_users(config, conn, admin, since=None, observers=None):
+    """Get the users from the LDAP server. Results are streamed a page at a
+    time, so memory usage does not grow with the size of the directory,
+    other than to remove duplicates if more than one base DN or partition
+    is searched.
+
+    Args:
+        config (ConfigParser): The application configuration
+        conn (ldap3.core.connection.Connection): The LDAP connection object
+        admin (bool): Return users in the admin group?
+        since (str): Only return users changed since this change attribute
+            value, if specified
+        observers (list): Objects to be passed each search result entry,
+            such as a ChangeTracker. Each must have an attributes list of
+            additional attributes to fetch, and an observe(entry, user)
+            method.
+    Returns:
+        generator: The user names. The searches are started straight away.
+    """
     if admin:
-        base_dn = config.get('ldap', 'admin_base_dn')
+        base_dns = get_config_lines(config, 'admin_base_dn')
         search_filter = config.get('ldap', 'admin_filter_string')
+        partitions = []
     else:
-        base_dn = config.get('ldap', 'base_dn')
+        base_dns = get_config_lines(config, 'base_dn')
         search_filter = config.get('ldap', 'filter_string')
+        partitions = get_config_lines(config, 'search_partitions')
 
-    try:
-        conn.search(base_dn,
-                    search_filter,
-                    config.get('ldap', 'search_scope'),
-                    attributes=[config.get('ldap', 'username_attribute')]
-                          )
-    except LDAPInvalidScopeError as exception:
-        sys.stderr.write("Error searching the LDAP directory: %s\n" % exception)
-        sys.exit(1)
-    except LDAPAttributeError as exception:
-        sys.stderr.write("Error searching the LDAP directory: %s\n" % exception)
-        sys.exit(1)
-    except LDAPInvalidFilterError as exception:
-        sys.stderr.write("Error searching the LDAP directory: %s\n" % exception)
-        sys.exit(1)
+    attribute = config.get('ldap', 'username_attribute')
+    attributes = [attribute]
+
+    search_filter = get_change_filter(search_filter,
+                                      config.get('ldap', 'change_attribute'),
+                                      since)
+    observers = observers or []
+    for observer in observers:
+        attributes.extend(observer.attributes)
+
+    # Search each base DN, split into partitions if configured
+    searches = [(base_dn,
+                 '(&%s%s)' % (search_filter, partition)
+                 if partition is not None else search_filter,
+                 config.get('ldap', 'search_scope'))
+                for base_dn in base_dns
+                for partition in partitions or [None]]
+
+    return get_entry_users(search_ldap_partitions(config, conn, searches,
+                                                  attributes, since is None),
+                           attribute, observers)
 
-    for entry in conn.entries:
-        users.append(entry[config.get('ldap', 'username_attribute')].value)
 
-    return users
+def get_entry_users(entries, attribute, observers):
+    """Get the user names from search response entries, passing each entry
+    to the observers.
 
+    Args:
+        entries (iterable): ldap3 search response entries
+        attribute (str): The user name attribute
+        observers (list): Objects to be passed each entry, as for
+            get_ldap_users()
+    Yields:
+        str: User names
+    """
+    for entry in entries:
+        user = get_entry_value(entry, attribute)
+
+        for observer in observers:
+            observer.observe(entry, user)
+
+        if user is not None:
+            yield user
 
-def get_filtered_ldap_users(config, conn, admin):
-    """Get a filtered list of users from the LDAP server, having removed users
-    to be ignored.
+
+def get_filtered_ldap_users(config, conn, admin, since=None, observers=None):
+    """Get the users from the LDAP server, having removed users to be
+    ignored.
 
     Args:
         config (ConfigParser): The application configuration
         conn (ldap3.core.connection.Connection): The LDAP connection object
         admin (bool): Return users in the admin group?
+        since (str): Only return users changed since this change attribute
+            value, if specified
+        observers (list): Objects to be passed each search result entry, as
+            for get_ldap_users()
     Returns:
-        str[]: A filtered list of user names
+        generator: The filtered user names
     """
-    users = get_ldap_users(config, conn, admin)
-    if users is None:
-        return None
-
-    # Remove ignored users
-    for user in config.get('ldap', 'ignore_users').split(','):
-        try:
-            users.remove(user)
-        except ValueError:
-            pass
+    users = get_ldap_users(config, conn, admin, since, observers)
+    ignored = frozenset(config.get('ldap', 'ignore_users').split(','))
 
-    return users
+    return (user for user in users if user not in ignored)
@@ -0,0 +1,175 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Batched Postgres statement execution functions."""
+
+import sys
+import time
+
+import psycopg2
+
+from ..syncutils.metrics import METRICS
+
+
+# Executes each SQL string in its own exception block (and therefore its own
+# subtransaction), so a failure only affects the role it belongs to. The
+# failed roles are returned along with their error messages.
+BATCH_FUNCTION = """CREATE OR REPLACE FUNCTION pg_temp.pgldapsync_execute(
+    roles text[], statements text[])
+RETURNS TABLE (failed_role text, error_message text)
+LANGUAGE plpgsql AS $$
+BEGIN
+    FOR i IN 1 .. coalesce(array_length(statements, 1), 0) LOOP
+        BEGIN
+            EXECUTE statements[i];
+        EXCEPTION WHEN OTHERS THEN
+            failed_role := roles[i];
+            error_message := SQLERRM;
+            RETURN NEXT;
+        END;
+    END LOOP;
+END;
+$$;"""
+
+# Creates the function unless it already exists in this session, so it is
+# only written to the catalog once per connection (or again, if the
+# transaction that created it was rolled back).
+BATCH_FUNCTION_SETUP = """DO $do$
+BEGIN
+    IF to_regprocedure(
+            'pg_temp.pgldapsync_execute(text[], text[])') IS NULL THEN
+        EXECUTE $fn$""" + BATCH_FUNCTION + """$fn$;
+    END IF;
+END;
+$do$;"""
+
+BATCH_QUERY = "SELECT failed_role, error_message " \
+              "FROM pg_temp.pgldapsync_execute(%s::text[], %s::text[]);"
+
+# Counts the sessions waiting for locks. The activity statistics are only
+# read once in a transaction unless the snapshot is cleared.
+LOCK_WAITERS_QUERY = "SELECT pg_stat_clear_snapshot(); " \
+                     "SELECT count(*) FROM pg_stat_activity " \
+                     "WHERE wait_event_type = 'Lock';"
+
+
+def execute_role_statements_singly(cur, operations, throttle=None):
+    """Execute the SQL for each role in a separate round-trip, using a
+    savepoint to isolate failures.
+
+    Args:
+        cur (cursor): The Postgres cursor object
+        operations (list): A list of (role, sql) tuples
+        throttle (BatchThrottle): Limits the rate of statements, if set
+    Returns:
+        list: A list of (role, error) tuples for the operations that failed
+    """
+    failures = []
+
+    for role, sql in operations:
+        if throttle is not None:
+            throttle.wait(1)
+
+        started = time.perf_counter()
+        try:
+            # We can't use a real parameterised query here as we're
+            # working with an object, not data.
+            cur.execute('SAVEPOINT op; %s RELEASE SAVEPOINT op;' % sql)
+        except psycopg2.Error as exception:
+            failures.append((role, str(exception).strip()))
+            cur.execute('ROLLBACK TO SAVEPOINT op; RELEASE SAVEPOINT op;')
+        METRICS.observe('pg_round_trip_seconds',
+                        time.perf_counter() - started)
+        METRICS.count('pg_round_trips')
+        METRICS.count('pg_statements')
+
+    return failures
+
+
+def execute_role_statements(conn, operations, batch_size, throttle=None):
+    """Execute the SQL for a number of roles, sending up to batch_size
+    roles to the server in each round-trip. The SQL for each role is
+    executed in its own subtransaction, so an error only fails that role.
+
+    Args:
+        conn (connection): The Postgres connection object
+        operations (list): A list of (role, sql) tuples
+        batch_size (int): The maximum number of roles per round-trip. If
+            less than 2, each role is executed separately.
+        throttle (BatchThrottle): Limits the rate of statements and adapts
+            the batch size to the load on the server, if set
+    Returns:
+        list: A list of (role, error) tuples for the operations that failed
+    """
+    cur = conn.cursor()
+
+    if batch_size > 1:
+        # Creating the function requires the TEMP privilege on the database
+        # and PL/pgSQL, so fall back to single statements if that fails.
+        try:
+            cur.execute('SAVEPOINT bf; %s RELEASE SAVEPOINT bf;' %
+                        BATCH_FUNCTION_SETUP)
+        except psycopg2.Error as exception:
+            sys.stderr.write("Unable to create the batch execution function, "
+                             "falling back to single statements: %s\n" %
+                             str(exception).strip())
+            cur.execute('ROLLBACK TO SAVEPOINT bf; RELEASE SAVEPOINT bf;')
+            batch_size = 1
+
+    if batch_size < 2:
+        failures = execute_role_statements_singly(cur, operations, throttle)
+        cur.close()
+        return failures
+
+    # Check that the lock waits can be counted, if the batch size is to be
+    # adapted to them, and ignore them if not.
+    if throttle is not None and throttle.lock_waiters > 0:
+        try:
+            cur.execute('SAVEPOINT lw; %s RELEASE SAVEPOINT lw;' %
+                        LOCK_WAITERS_QUERY)
+        except psycopg2.Error as exception:
+            sys.stderr.write("Unable to count the sessions waiting for "
+                             "locks, ignoring them: %s\n" %
+                             str(exception).strip())
+            cur.execute('ROLLBACK TO SAVEPOINT lw; RELEASE SAVEPOINT lw;')
+            throttle.lock_waiters = 0
+
+    failures = []
+    start = 0
+
+    while start < len(operations):
+        size = batch_size
+        if throttle is not None:
+            size = min(batch_size, throttle.batch_size)
+        batch = operations[start:start + size]
+        start = start + len(batch)
+
+        if throttle is not None:
+            throttle.wait(len(batch))
+
+        started = time.perf_counter()
+        cur.execute(BATCH_QUERY, ([role for role, _ in batch],
+                                  [sql for _, sql in batch]))
+        failures.extend(cur.fetchall())
+        elapsed = time.perf_counter() - started
+        METRICS.observe('pg_round_trip_seconds', elapsed)
+        METRICS.count('pg_round_trips')
+        METRICS.count('pg_statements', len(batch))
+
+        if throttle is not None:
+            waiters = 0
+            if throttle.lock_waiters > 0:
+                cur.execute(LOCK_WAITERS_QUERY)
+                waiters = cur.fetchone()[0]
+            throttle.observe(elapsed, waiters)
+
+    cur.close()
+
+    return failures
@@ -13,6 +13,7 @@
 import sys
 
 import psycopg2
+from psycopg2.extensions import make_dsn
 
 
 def connect_pg_server(pg_connstr):
@@ -32,3 +33,16 @@ def connect_pg_server(pg_connstr):
         return None
 
     return conn
+
+
+def get_database_connstr(pg_connstr, database):
+    """Get the connection string for another database on a Postgres server.
+
+    Args:
+        pg_connstr (str): The Postgres connection string
+        database (str): The database name
+
+    Returns:
+        str: The connection string
+    """
+    return make_dsn(pg_connstr, dbname=database)
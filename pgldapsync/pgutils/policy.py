@@ -0,0 +1,527 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Postgres role policy functions."""
+
+import ast
+import re
+import sys
+
+import psycopg2
+from psycopg2 import sql
+
+from .roles import PgRoleAttributes, get_role_attributes
+
+
+# GUC names can't be quoted as identifiers, so they are validated instead.
+GUC_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_$]*'
+                              r'(\.[A-Za-z_][A-Za-z0-9_$]*)?$')
+
+# Settings that take a list of identifiers. Postgres quotes each element of
+# these as an identifier when storing a role's settings, e.g. 'app,"$user"'
+# is stored as 'app, "$user"'.
+IDENTIFIER_LIST_GUCS = ('search_path', 'temp_tablespaces',
+                        'local_preload_libraries', 'session_preload_libraries',
+                        'shared_preload_libraries')
+
+# Matches an identifier in a list, quoted or not, and the comma or end of
+# string that follows it.
+IDENTIFIER_LIST_PATTERN = re.compile(
+    r'\s*(?:"((?:[^"]|"")*)"|([^\s,"][^\s,]*))\s*(,|\Z)')
+
+IDENTIFIER_LIST_QUERY = "SELECT string_agg(quote_ident(e), ', ' ORDER BY n) " \
+                        "FROM unnest(%s::text[]) WITH ORDINALITY AS u(e, n);"
+
+# The ways in which the objects owned by, and privileges held by, login roles
+# may be dealt with before the roles are dropped.
+DROP_OWNED_POLICIES = ('none', 'skip', 'reassign', 'drop')
+
+# The keywords to enable and disable each boolean role attribute, in the
+# order of the PgRoleAttributes fields.
+ROLE_OPTIONS = (('SUPERUSER', 'NOSUPERUSER'),
+                ('CREATEDB', 'NOCREATEDB'),
+                ('CREATEROLE', 'NOCREATEROLE'),
+                ('INHERIT', 'NOINHERIT'),
+                ('BYPASSRLS', 'NOBYPASSRLS'))
+
+
+def get_role_list(config, option):
+    """Get a list of role names from a comma delimited config option,
+    ignoring any empty entries.
+
+    Args:
+        config (ConfigParser): The application configuration
+        option (str): The [general] option to read
+    Returns:
+        str[]: The role names
+    """
+    return [role.strip() for role in config.get('general', option).split(',')
+            if role.strip() != '']
+
+
+def get_gucs(config):
+    """Parse and validate the gucs_to_set option.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        list: A list of (name, value, database) tuples, where database is
+            empty if the setting applies to all databases
+    """
+    try:
+        gucs = ast.literal_eval(config.get('general', 'gucs_to_set'))
+    except (SyntaxError, ValueError) as exception:
+        sys.stderr.write("Error parsing gucs_to_set: %s\n" % exception)
+        sys.exit(1)
+
+    if not isinstance(gucs, dict):
+        sys.stderr.write("Error parsing gucs_to_set: not a dictionary\n")
+        sys.exit(1)
+
+    settings = []
+    for name, setting in gucs.items():
+        if not GUC_NAME_PATTERN.match(str(name)) or \
+                not isinstance(setting, (list, tuple)) or len(setting) != 2:
+            sys.stderr.write("Error parsing gucs_to_set: invalid setting "
+                             "for %s\n" % name)
+            sys.exit(1)
+
+        settings.append((name, str(setting[0]), str(setting[1])))
+
+    return settings
+
+
+def split_identifier_list(value):
+    """Split a comma delimited list of identifiers, in the same way as
+    Postgres does for settings such as search_path. Unquoted identifiers are
+    folded to lower case, and quoted ones have their quotes removed.
+
+    Args:
+        value (str): The list
+    Returns:
+        str[]: The identifiers, or None if the list is invalid or empty
+    """
+    if value.strip() == '':
+        return None
+
+    identifiers = []
+    position = 0
+    while True:
+        match = IDENTIFIER_LIST_PATTERN.match(value, position)
+        if match is None:
+            return None
+
+        if match.group(1) is not None:
+            identifiers.append(match.group(1).replace('""', '"'))
+        else:
+            identifiers.append(match.group(2).lower())
+
+        if match.group(3) == '':
+            return identifiers
+        position = match.end()
+
+
+class RolePolicy:
+    """The SQL required to create and drop login roles, compiled once from
+    the configuration. Each statement is stored as a list of fragments to be
+    joined with the quoted role name, so rendering the SQL for a role only
+    requires the name to be quoted."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, config, conn):
+        """Compile the role policy.
+
+        Args:
+            config (ConfigParser): The application configuration
+            conn (connection): The Postgres connection object, used for
+                quoting
+        """
+        self.conn = conn
+
+        self.drop_owned = config.get('general', 'drop_owned_policy').lower()
+        if self.drop_owned not in DROP_OWNED_POLICIES:
+            sys.stderr.write("Invalid drop_owned_policy value: %s\n" %
+                             self.drop_owned)
+            sys.exit(1)
+
+        heir = config.get('general', 'drop_owned_heir')
+        if self.drop_owned == 'reassign' and heir == '':
+            sys.stderr.write("A drop_owned_heir must be configured to use "
+                             "drop_owned_policy = reassign.\n")
+            sys.exit(1)
+        self.drop_owned_heir = self.quote(heir) if heir != '' else None
+
+        grants = ', '.join(self.quote(role) for role in
+                           get_role_list(config, 'roles_to_grant'))
+        admin_grants = ', '.join(self.quote(role) for role in
+                                 get_role_list(config,
+                                               'roles_to_grant_with_admin'))
+
+        statements = []
+        if grants != '':
+            statements.append(['GRANT %s TO ' % grants, ';'])
+        if admin_grants != '':
+            statements.append(['GRANT %s TO ' % admin_grants,
+                               ' WITH ADMIN OPTION;'])
+
+        self.normalised = {}
+        self.setting_statements = {}
+        for name, value, database in get_gucs(config):
+            value = self.normalise_setting(name, value)
+            fragments = self.get_setting_fragments(database, name, value)
+            statements.append(fragments)
+            self.setting_statements[(database, name.lower(), value)] = \
+                fragments
+
+        # Mark the roles that are created as managed by pgldapsync, if a
+        # marker is configured
+        self.mark_statements = []
+        if config.get('postgres', 'managed_role_group') != '':
+            self.mark_statements.append(
+                ['GRANT %s TO ' %
+                 self.quote(config.get('postgres', 'managed_role_group')),
+                 ';'])
+        if config.get('postgres', 'managed_role_comment') != '':
+            self.mark_statements.append(
+                ['COMMENT ON ROLE ', ' IS %s;' %
+                 sql.Literal(config.get('postgres', 'managed_role_comment'))
+                 .as_string(conn)])
+
+        self.create_statements = {}
+        self.attributes = {}
+        for admin in (False, True):
+            self.create_statements[admin] = \
+                [['CREATE ROLE ', ' LOGIN %s;' %
+                  get_role_attributes(config, admin)]] + \
+                self.mark_statements + statements
+
+            self.attributes[admin] = PgRoleAttributes(
+                config.getboolean('general', 'role_attribute_superuser') or
+                admin,
+                config.getboolean('general', 'role_attribute_createdb'),
+                config.getboolean('general', 'role_attribute_createrole'),
+                not config.getboolean('general', 'role_attribute_noinherit'),
+                config.getboolean('general', 'role_attribute_bypassrls'),
+                config.getint('general', 'role_attribute_connection_limit'),
+                frozenset(self.setting_statements.keys()))
+
+    def quote(self, name):
+        """Quote an identifier.
+
+        Args:
+            name (str): The identifier
+        Returns:
+            str: The quoted identifier
+        """
+        return sql.Identifier(name).as_string(self.conn)
+
+    def normalise_setting(self, name, value):
+        """Get a setting value in the form Postgres stores it in, so it can
+        be compared with the current settings of roles. The elements of
+        identifier lists are quoted by the server, as it would quote them,
+        and other values are stored as they are.
+
+        Args:
+            name (str): The setting name
+            value (str): The setting value
+        Returns:
+            str: The value as stored by Postgres
+        """
+        if name.lower() not in IDENTIFIER_LIST_GUCS:
+            return value
+
+        normalised = self.normalised.get((name.lower(), value))
+        if normalised is not None:
+            return normalised
+
+        identifiers = split_identifier_list(value)
+        if identifiers is None:
+            identifiers = [value]
+
+        cur = self.conn.cursor()
+        try:
+            cur.execute(IDENTIFIER_LIST_QUERY, (identifiers, ))
+            normalised = cur.fetchone()[0]
+        except psycopg2.Error as exception:
+            sys.stderr.write("Error normalising the value of %s: %s\n" %
+                             (name, exception))
+            sys.exit(1)
+        cur.close()
+
+        self.normalised[(name.lower(), value)] = normalised
+
+        return normalised
+
+    def normalise_settings(self, settings):
+        """Normalise the values of a set of settings.
+
+        Args:
+            settings (frozenset): (database, name, value) tuples
+        Returns:
+            frozenset: (database, name, value) tuples, with the values as
+                stored by Postgres
+        """
+        return frozenset((database, name,
+                          self.normalise_setting(name, value))
+                         for database, name, value in settings)
+
+    def get_setting_fragments(self, database, name, value):
+        """Get the fragments of the SQL statement that sets a setting for a
+        role, to be joined with the quoted role name.
+
+        Args:
+            database (str): The database the setting applies to, or empty
+                for all databases
+            name (str): The (validated) setting name
+            value (str): The setting value, as normalised
+        Returns:
+            str[]: The fragments
+        """
+        identifiers = None
+        if name.lower() in IDENTIFIER_LIST_GUCS:
+            identifiers = split_identifier_list(value)
+
+        # Identifier lists are given as one literal for each identifier, so
+        # that the server quotes each one separately.
+        if identifiers is not None:
+            literal = ', '.join(sql.Literal(identifier).as_string(self.conn)
+                                for identifier in identifiers)
+        else:
+            literal = sql.Literal(value).as_string(self.conn)
+        if database != '':
+            return ['ALTER ROLE ', ' IN DATABASE %s SET %s TO %s;' %
+                    (self.quote(database), name, literal)]
+
+        return ['ALTER ROLE ', ' SET %s TO %s;' % (name, literal)]
+
+    def get_setting_sql(self, quoted, setting):
+        """Get the SQL statement that sets a setting for a role.
+
+        Args:
+            quoted (str): The quoted role name
+            setting (tuple): The database, name and value of the setting
+        Returns:
+            str: The SQL statement
+        """
+        fragments = self.setting_statements.get(setting)
+        if fragments is None:
+            fragments = self.get_setting_fragments(*setting)
+
+        return quoted.join(fragments)
+
+    def get_wanted_attributes(self, admin, overrides=None):
+        """Get the attributes and settings a login role should have,
+        taking into account any settings taken from its LDAP user, which
+        replace configured settings of the same name.
+
+        Args:
+            admin (bool): Should the role be a superuser?
+            overrides (UserSettings): The settings from the LDAP user, if any
+        Returns:
+            PgRoleAttributes: The attributes and settings
+        """
+        wanted = self.attributes[admin]
+        if overrides is None:
+            return wanted
+
+        replaced = set(setting[:2] for setting in overrides.settings)
+        settings = frozenset(setting for setting in wanted.settings
+                             if setting[:2] not in replaced)
+
+        return wanted._replace(
+            connection_limit=wanted.connection_limit
+            if overrides.connection_limit is None
+            else overrides.connection_limit,
+            settings=settings.union(
+                self.normalise_settings(overrides.settings)))
+
+    def get_create_statements(self, role, admin):
+        """Get the SQL statements required to create a login role.
+
+        Args:
+            role (str): The role name
+            admin (bool): Should the role be a superuser?
+        Returns:
+            str[]: The SQL statements
+        """
+        quoted = self.quote(role)
+
+        return [quoted.join(fragments)
+                for fragments in self.create_statements[admin]]
+
+    def get_create_sql(self, role, admin, overrides=None):
+        """Get the SQL required to create a login role.
+
+        Args:
+            role (str): The role name
+            admin (bool): Should the role be a superuser?
+            overrides (UserSettings): The settings from the LDAP user, if any
+        Returns:
+            str: The SQL statements, one per line
+        """
+        statements = self.get_create_statements(role, admin)
+        if overrides is not None:
+            statements.extend(self.get_override_statements(
+                role, self.attributes[admin], overrides))
+
+        return '\n'.join(statements)
+
+    def get_alter_sql(self, role, current, admin, overrides=None):
+        """Get the SQL required to bring the attributes and settings of an
+        existing login role into line with the policy. Only the attributes
+        and settings that differ are changed; settings that are not
+        configured are left alone.
+
+        Args:
+            role (str): The role name
+            current (PgRoleAttributes): The current attributes of the role
+            admin (bool): Should the role be a superuser?
+            overrides (UserSettings): The settings from the LDAP user, if any
+        Returns:
+            str: The SQL statements, one per line, or None if no changes
+                are required
+        """
+        wanted = self.get_wanted_attributes(admin, overrides)
+
+        options = [ROLE_OPTIONS[index][0 if wanted[index] else 1]
+                   for index in range(len(ROLE_OPTIONS))
+                   if bool(current[index]) != wanted[index]]
+        if current.connection_limit != wanted.connection_limit:
+            options.append('CONNECTION LIMIT %d' % wanted.connection_limit)
+
+        settings = sorted(wanted.settings.difference(current.settings))
+        if len(options) == 0 and len(settings) == 0:
+            return None
+
+        quoted = self.quote(role)
+
+        statements = []
+        if len(options) > 0:
+            statements.append('ALTER ROLE %s %s;' % (quoted,
+                                                     ' '.join(options)))
+        for setting in settings:
+            statements.append(self.get_setting_sql(quoted, setting))
+
+        return '\n'.join(statements)
+
+    def get_override_statements(self, role, current, overrides):
+        """Get the SQL statements required to apply the settings taken from
+        an LDAP user to its login role, where they differ from the current
+        settings.
+
+        Args:
+            role (str): The role name
+            current (PgRoleAttributes): The current attributes of the role
+            overrides (UserSettings): The settings from the LDAP user
+        Returns:
+            str[]: The SQL statements
+        """
+        quoted = self.quote(role)
+        statements = []
+
+        if overrides.connection_limit is not None and \
+                overrides.connection_limit != current.connection_limit:
+            statements.append('ALTER ROLE %s CONNECTION LIMIT %d;' %
+                              (quoted, overrides.connection_limit))
+
+        for setting in sorted(self.normalise_settings(
+                overrides.settings).difference(current.settings)):
+            statements.append(self.get_setting_sql(quoted, setting))
+
+        return statements
+
+    def get_override_sql(self, role, current, overrides):
+        """Get the SQL required to apply the settings taken from an LDAP
+        user to its existing login role. Other attributes and settings are
+        left alone.
+
+        Args:
+            role (str): The role name
+            current (PgRoleAttributes): The current attributes of the role
+            overrides (UserSettings): The settings from the LDAP user
+        Returns:
+            str: The SQL statements, one per line, or None if no changes
+                are required
+        """
+        statements = self.get_override_statements(role, current, overrides)
+        if len(statements) == 0:
+            return None
+
+        return '\n'.join(statements)
+
+    def get_mark_sql(self, role):
+        """Get the SQL required to mark an existing login role as managed by
+        pgldapsync.
+
+        Args:
+            role (str): The role name
+        Returns:
+            str: The SQL statements, one per line
+        """
+        quoted = self.quote(role)
+
+        return '\n'.join(quoted.join(fragments)
+                         for fragments in self.mark_statements)
+
+    def get_drop_sql(self, role):
+        """Get the SQL required to drop a login role.
+
+        Args:
+            role (str): The role name
+        Returns:
+            str: The SQL statement
+        """
+        return 'DROP ROLE %s;' % self.quote(role)
+
+    def get_drop_owned_sql(self, roles):
+        """Get the SQL required in a database to reassign or drop the objects
+        owned by a number of roles, and revoke their privileges, according
+        to the drop_owned_policy, so that the roles can be dropped.
+
+        Args:
+            roles (str[]): The role names
+        Returns:
+            str: The SQL statements, one per line
+        """
+        quoted = ', '.join(self.quote(role) for role in roles)
+
+        if self.drop_owned == 'reassign':
+            return 'REASSIGN OWNED BY %s TO %s;\nDROP OWNED BY %s;' % \
+                (quoted, self.drop_owned_heir, quoted)
+
+        return 'DROP OWNED BY %s;' % quoted
+
+    def get_create_group_sql(self, group):
+        """Get the SQL required to create a group role.
+
+        Args:
+            group (str): The group role name
+        Returns:
+            str: The SQL statement
+        """
+        return 'CREATE ROLE %s NOLOGIN;' % self.quote(group)
+
+    def get_membership_sql(self, group, members, grant):
+        """Get the SQL required to grant a group role to, or revoke it from,
+        a number of roles.
+
+        Args:
+            group (str): The group role name
+            members (str[]): The member role names
+            grant (bool): Grant the membership if True, otherwise revoke it
+        Returns:
+            str: The SQL statement
+        """
+        return '%s %s %s %s;' % ('GRANT' if grant else 'REVOKE',
+                                 self.quote(group),
+                                 'TO' if grant else 'FROM',
+                                 ', '.join(self.quote(member)
+                                           for member in members))
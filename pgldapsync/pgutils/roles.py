@@ -10,62 +10,257 @@
 
 """Postgres role functions."""
 
+import collections
 import sys
 
 import ast
 import psycopg2
 
+from ..syncutils.names import NameSet
 
-def get_pg_login_roles(conn):
-    """Get a list of login roles from the Postgres server.
+
+PgRoleAttributes = collections.namedtuple('PgRoleAttributes',
+                                          ['superuser', 'createdb',
+                                           'createrole', 'inherit',
+                                           'bypassrls', 'connection_limit',
+                                           'settings'])
+PgRoleAttributes.__doc__ = """The attributes and settings of a login role.
+
+    superuser, createdb, createrole, inherit, bypassrls (bool): The role
+        attributes
+    connection_limit (int): The connection limit, -1 for no limit
+    settings (frozenset): (database, name, value) tuples for each setting,
+        where database is empty if the setting applies to all databases
+"""
+
+# Fetches the attributes of each role, and its settings as an array of
+# [database, name=value] pairs, in a single query.
+ROLE_ATTRIBUTES_QUERY = """SELECT r.rolname, r.rolsuper, r.rolcreatedb,
+    r.rolcreaterole, r.rolinherit, r.rolbypassrls, r.rolconnlimit,
+    ARRAY(SELECT ARRAY[coalesce(d.datname, ''), c]
+          FROM pg_db_role_setting s
+          LEFT JOIN pg_database d ON d.oid = s.setdatabase
+          CROSS JOIN unnest(s.setconfig) c
+          WHERE s.setrole = r.oid)
+FROM pg_roles r WHERE r.rolcanlogin"""
+
+LOGIN_ROLES_QUERY = "SELECT r.rolname FROM pg_roles r WHERE r.rolcanlogin"
+
+# The number of rows fetched at a time from the server side cursor used to
+# read the login roles.
+ROLE_FETCH_SIZE = 10000
+
+
+def get_role_settings(settings):
+    """Parse the settings of a role.
+
+    Args:
+        settings (list): [database, name=value] pairs
+    Returns:
+        frozenset: (database, name, value) tuples
+    """
+    parsed = set()
+
+    for database, setting in settings:
+        name, _, value = setting.partition('=')
+        parsed.add((database, name.lower(), value))
+
+    return frozenset(parsed)
+
+
+def managed_role_markers_enabled(config):
+    """Are the login roles managed by pgldapsync marked, with a group role
+    membership or comment?
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        bool: True if a marker is configured
+    """
+    return config.get('postgres', 'managed_role_group') != '' or \
+        config.get('postgres', 'managed_role_comment') != ''
+
+
+def get_login_role_filter(config, markers=True):
+    """Get the SQL conditions that select the login roles to synchronise,
+    so that ignored roles, and roles not marked as managed by pgldapsync,
+    are never read from the server.
+
+    Args:
+        config (ConfigParser): The application configuration
+        markers (bool): Only select roles with the configured markers?
+    Returns:
+        tuple: The conditions to add to the WHERE clause of a query on
+            pg_roles (aliased as r), and a list of their parameters
+    """
+    conditions = ''
+    params = []
+
+    ignore = [role for role in
+              config.get('postgres', 'ignore_login_roles').split(',')
+              if role != '']
+    if len(ignore) > 0:
+        conditions = conditions + " AND r.rolname <> ALL(%s::text[])"
+        params.append(ignore)
+
+    prefixes = [prefix for prefix in
+                config.get('postgres',
+                           'ignore_login_role_prefixes').split(',')
+                if prefix != '']
+    if len(prefixes) > 0:
+        conditions = conditions + " AND r.rolname NOT LIKE ALL(%s::text[])"
+        params.append([prefix.replace('\\', '\\\\').replace('%', '\\%')
+                       .replace('_', '\\_') + '%' for prefix in prefixes])
+
+    if config.get('postgres', 'ignore_login_role_regex') != '':
+        conditions = conditions + " AND r.rolname !~ %s"
+        params.append(config.get('postgres', 'ignore_login_role_regex'))
+
+    if markers and config.get('postgres', 'managed_role_group') != '':
+        conditions = conditions + \
+            " AND r.oid IN (SELECT am.member FROM pg_auth_members am " \
+            "JOIN pg_roles g ON g.oid = am.roleid WHERE g.rolname = %s)"
+        params.append(config.get('postgres', 'managed_role_group'))
+
+    if markers and config.get('postgres', 'managed_role_comment') != '':
+        conditions = conditions + \
+            " AND EXISTS (SELECT 1 FROM pg_shdescription d " \
+            "WHERE d.objoid = r.oid " \
+            "AND d.classoid = 'pg_authid'::regclass AND d.description = %s)"
+        params.append(config.get('postgres', 'managed_role_comment'))
+
+    return conditions, params
+
+
+def get_pg_login_roles(conn, names=None, attributes=False,
+                       role_filter=('', [])):
+    """Get the login roles from the Postgres server. The roles are streamed
+    from a server side cursor, so only a batch of rows is held at a time.
 
     Args:
         conn (connection): The Postgres connection object
+        names (str[]): Only return roles in this list, if specified
+        attributes (bool): Also get the attributes and settings of each
+            role?
+        role_filter (tuple): Additional SQL conditions and their
+            parameters, as returned by get_login_role_filter()
     Returns:
-        str[]: A list of user names
+        NameSet: The user names, or if attributes is True, a dict of the
+            PgRoleAttributes for each user name
     """
-    cur = conn.cursor()
+    query = ROLE_ATTRIBUTES_QUERY if attributes else LOGIN_ROLES_QUERY
+    conditions, params = role_filter
+    params = list(params)
+
+    if names is not None:
+        conditions = conditions + " AND r.rolname = ANY(%s::text[])"
+        params.append(list(names))
+
+    cur = conn.cursor('pgldapsync_login_roles')
+    cur.itersize = ROLE_FETCH_SIZE
 
     try:
-        cur.execute("SELECT rolname FROM pg_authid WHERE rolcanlogin;")
-        rows = cur.fetchall()
+        cur.execute(query + conditions + ";", params)
+
+        if attributes:
+            roles = {row[0]: PgRoleAttributes(row[1], row[2], row[3], row[4],
+                                              row[5], row[6],
+                                              get_role_settings(row[7]))
+                     for row in cur}
+        else:
+            roles = NameSet(row[0] for row in cur)
     except psycopg2.Error as exception:
         sys.stderr.write("Error retrieving Postgres login roles: %s\n" %
                          exception)
         return None
 
-    roles = []
-
-    for row in rows:
-        roles.append(row[0])
-
     cur.close()
 
     return roles
 
 
-def get_filtered_pg_login_roles(config, conn):
-    """Get a filtered list of login roles from the Postgres server, having
-    removed users to be ignored.
+def get_filtered_pg_login_roles(config, conn, names=None, attributes=False):
+    """Get the login roles from the Postgres server, leaving out those to be
+    ignored and, if a marker is configured, those not managed by pgldapsync.
 
     Args:
         config (ConfigParser): The application configuration
         conn (connection): The Postgres connection object
+        names (str[]): Only return roles in this list, if specified
+        attributes (bool): Also get the attributes and settings of each
+            role?
+    Returns:
+        NameSet: The filtered login roles, or if attributes is True, a
+            dict of the PgRoleAttributes for each login role
+    """
+    return get_pg_login_roles(conn, names, attributes,
+                              get_login_role_filter(config))
+
+
+def get_pg_roles(conn, names):
+    """Get the roles that exist on the Postgres server, of those specified.
+
+    Args:
+        conn (connection): The Postgres connection object
+        names (str[]): The role names
     Returns:
-        str[]: A filtered list of login roles
+        set: The role names that exist, or None on error
     """
-    roles = get_pg_login_roles(conn)
-    if roles is None:
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT rolname FROM pg_roles "
+                    "WHERE rolname = ANY(%s::text[]);", (list(names),))
+        existing = set(row[0] for row in cur.fetchall())
+    except psycopg2.Error as exception:
+        sys.stderr.write("Error retrieving Postgres roles: %s\n" % exception)
         return None
 
-    # Remove ignored roles
-    for role in config.get('postgres', 'ignore_login_roles').split(','):
-        try:
-            roles.remove(role)
-        except ValueError:
-            pass
+    cur.close()
 
-    return roles
+    return existing
+
+
+def get_pg_role_dependencies(conn, roles):
+    """Find the databases in which the specified roles own objects or hold
+    privileges, with a single query of the shared dependency catalog.
+    Dependencies of shared objects, such as databases and tablespaces, are
+    reported against the current database.
+
+    Args:
+        conn (connection): The Postgres connection object
+        roles (str[]): The role names
+    Returns:
+        dict: The sorted list of dependent role names for each database
+            name, or None on error
+    """
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT DISTINCT coalesce(d.datname, current_database()), "
+                    "r.rolname "
+                    "FROM pg_shdepend s "
+                    "JOIN pg_roles r ON r.oid = s.refobjid "
+                    "LEFT JOIN pg_database d ON d.oid = s.dbid "
+                    "WHERE s.refclassid = 'pg_authid'::regclass "
+                    "AND s.deptype <> 'p' "
+                    "AND r.rolname = ANY(%s::text[]);", (list(roles),))
+        rows = cur.fetchall()
+    except psycopg2.Error as exception:
+        sys.stderr.write("Error retrieving Postgres role dependencies: %s\n" %
+                         exception)
+        return None
+
+    cur.close()
+
+    dependencies = {}
+    for database, role in rows:
+        dependencies.setdefault(database, []).append(role)
+
+    for members in dependencies.values():
+        members.sort()
+
+    return dependencies
 
 
 def get_role_attributes(config, admin):
@@ -134,6 +329,8 @@ def get_role_grants(config, role, with_admin=False):
         roles_to_grant = config.get('general', 'roles_to_grant').split(',')
 
     for role_to_grant in roles_to_grant:
+        if role_to_grant == '':
+            continue
         roles = roles + '"' + role_to_grant + '", '
 
     if roles.endswith(', '):
@@ -183,13 +380,9 @@ def get_create_login_roles(ldap_users, pg_roles):
     Returns:
         str[]: A list of roles that exist in LDAP but not Postgres
     """
-    roles = []
+    pg_index = set(pg_roles)
 
-    for user in ldap_users:
-        if user not in pg_roles:
-            roles.append(user)
-
-    return roles
+    return [user for user in ldap_users if user not in pg_index]
 
 
 def get_drop_login_roles(ldap_users, pg_roles):
@@ -202,10 +395,40 @@ def get_drop_login_roles(ldap_users, pg_roles):
     Returns:
         str[]: A list of roles that exist in Postgres but not LDAP
     """
-    roles = []
+    ldap_index = set(ldap_users)
 
-    for role in pg_roles:
-        if role not in ldap_users:
-            roles.append(role)
+    return [role for role in pg_roles if role not in ldap_index]
 
-    return roles
+
+def get_pg_group_memberships(conn, groups):
+    """Get the existing group roles and their members from the Postgres
+    server, for the specified groups.
+
+    Args:
+        conn (connection): The Postgres connection object
+        groups (str[]): The group role names
+    Returns:
+        tuple: The set of group roles that exist, and a set of
+            (group, member) tuples, or None on error
+    """
+    cur = conn.cursor()
+
+    try:
+        cur.execute("SELECT rolname FROM pg_roles "
+                    "WHERE rolname = ANY(%s::text[]);", (list(groups),))
+        existing = set(row[0] for row in cur.fetchall())
+
+        cur.execute("SELECT g.rolname, m.rolname "
+                    "FROM pg_auth_members am "
+                    "JOIN pg_roles g ON g.oid = am.roleid "
+                    "JOIN pg_roles m ON m.oid = am.member "
+                    "WHERE g.rolname = ANY(%s::text[]);", (list(groups),))
+        memberships = set((row[0], row[1]) for row in cur.fetchall())
+    except psycopg2.Error as exception:
+        sys.stderr.write("Error retrieving Postgres group memberships: %s\n" %
+                         exception)
+        return None
+
+    cur.close()
+
+    return existing, memberships
@@ -0,0 +1,215 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Postgres server side diff functions."""
+
+import itertools
+import sys
+
+import psycopg2
+
+from .roles import PgRoleAttributes, ROLE_ATTRIBUTES_QUERY, \
+    get_login_role_filter, get_role_settings
+
+
+# The LDAP role names are copied into the first table, with a flag for the
+# admin users. The second holds one row for each role name that should
+# exist, and whether it should be a superuser. Both are dropped when the
+# transaction ends.
+STAGING_TABLES = """CREATE TEMP TABLE pgldapsync_ldap_names (
+    rolname text NOT NULL,
+    admin boolean NOT NULL
+) ON COMMIT DROP;"""
+
+STAGING_COPY = "COPY pgldapsync_ldap_names (rolname, admin) FROM STDIN;"
+
+STAGING_USERS = """CREATE TEMP TABLE pgldapsync_ldap_users ON COMMIT DROP AS
+    SELECT rolname, bool_or(admin) AS admin
+    FROM pgldapsync_ldap_names
+    GROUP BY rolname
+    HAVING bool_or(NOT admin);
+CREATE UNIQUE INDEX ON pgldapsync_ldap_users (rolname);
+ANALYZE pgldapsync_ldap_users;"""
+
+# Role names are sorted in code point order, as Python sorts them.
+CREATE_QUERY = """SELECT u.rolname, u.admin FROM pgldapsync_ldap_users u
+WHERE NOT EXISTS (SELECT 1 FROM pg_roles r
+                  WHERE r.rolcanlogin AND r.rolname = u.rolname{0})
+ORDER BY u.rolname COLLATE "C";"""
+
+DROP_QUERY = """SELECT r.rolname FROM pg_roles r WHERE r.rolcanlogin{0}
+AND NOT EXISTS (SELECT 1 FROM pgldapsync_ldap_users u
+                WHERE u.rolname = r.rolname)
+ORDER BY r.rolname COLLATE "C";"""
+
+# Selects the roles whose attributes differ from those wanted, or which are
+# missing any of the wanted settings.
+DRIFT_CONDITIONS = """ AND (r.rolsuper <> (%s OR u.admin)
+    OR r.rolcreatedb <> %s OR r.rolcreaterole <> %s OR r.rolinherit <> %s
+    OR r.rolbypassrls <> %s OR r.rolconnlimit <> %s
+    OR EXISTS (SELECT 1 FROM unnest(%s::text[], %s::text[], %s::text[])
+                   AS w(datname, name, value)
+               WHERE NOT EXISTS (
+                   SELECT 1 FROM pg_db_role_setting s
+                   LEFT JOIN pg_database d ON d.oid = s.setdatabase
+                   CROSS JOIN unnest(s.setconfig) c
+                   WHERE s.setrole = r.oid
+                   AND coalesce(d.datname, '') = w.datname
+                   AND lower(split_part(c, '=', 1)) = w.name
+                   AND substr(c, strpos(c, '=') + 1) = w.value)))"""
+
+DRIFT_QUERY = ROLE_ATTRIBUTES_QUERY.replace(
+    '\nFROM pg_roles r WHERE',
+    ', u.admin\nFROM pg_roles r '
+    'JOIN pgldapsync_ldap_users u ON u.rolname = r.rolname\nWHERE')
+
+
+def escape_copy_value(value):
+    """Escape a value for COPY text format.
+
+    Args:
+        value (str): The value
+    Returns:
+        str: The escaped value
+    """
+    return value.replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('\r', '\\r').replace('\t', '\\t')
+
+
+class CopyStream:  # pylint: disable=too-few-public-methods
+    """A file-like object that formats rows for COPY FROM STDIN as they are
+    read, so the rows can be streamed from an iterator without being held
+    in memory."""
+
+    def __init__(self, rows):
+        """Initialise the stream.
+
+        Args:
+            rows (iterable): Tuples of str values
+        """
+        self.rows = iter(rows)
+        self.pending = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        """Read formatted rows.
+
+        Args:
+            size (int): The maximum number of characters to return, or -1
+                to read all the rows
+        Returns:
+            str: The rows, or an empty string once all have been read
+        """
+        chunks = [self.pending]
+        length = len(self.pending)
+
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+
+            line = '\t'.join(escape_copy_value(value) for value in row) + '\n'
+            chunks.append(line)
+            length = length + len(line)
+            self.count = self.count + 1
+
+        data = ''.join(chunks)
+        if size < 0:
+            self.pending = ''
+            return data
+
+        self.pending = data[size:]
+        return data[:size]
+
+
+def stage_ldap_users(conn, users, admins):
+    """Copy the normalised LDAP role names into temporary tables on the
+    Postgres server, so they can be compared with the login roles there.
+    The names are streamed to the server, and duplicates are removed by the
+    server.
+
+    Args:
+        conn (connection): The Postgres connection object
+        users (iterable): The normalised LDAP role names
+        admins (iterable): The normalised role names of admin users
+    Returns:
+        int: The number of names copied, or None on error
+    """
+    stream = CopyStream(itertools.chain(((user, 'f') for user in users),
+                                        ((admin, 't') for admin in admins)))
+    cur = conn.cursor()
+
+    try:
+        cur.execute(STAGING_TABLES)
+        cur.copy_expert(STAGING_COPY, stream)
+        cur.execute(STAGING_USERS)
+    except psycopg2.Error as exception:
+        sys.stderr.write("Error copying the LDAP users to the Postgres "
+                         "server: %s\n" % exception)
+        return None
+
+    cur.close()
+
+    return stream.count
+
+
+def diff_staged_login_roles(config, conn, wanted=None):
+    """Compare the LDAP role names copied to the Postgres server with the
+    filtered login roles, with set based queries run by the server. Only
+    the differences are returned.
+
+    Args:
+        config (ConfigParser): The application configuration
+        conn (connection): The Postgres connection object
+        wanted (PgRoleAttributes): The attributes and settings login roles
+            should have, if they are to be reconciled, for users who are not
+            admin users
+    Returns:
+        tuple: The sorted lists of roles to create and drop, the set of
+            admin roles to create or reconcile, and a dict of the
+            PgRoleAttributes of each role that should be reconciled, or
+            None on error
+    """
+    conditions, params = get_login_role_filter(config)
+    cur = conn.cursor()
+
+    try:
+        cur.execute(CREATE_QUERY.format(conditions), params)
+        rows = cur.fetchall()
+        create = [rolname for rolname, _ in rows]
+        admins = set(rolname for rolname, admin in rows if admin)
+
+        cur.execute(DROP_QUERY.format(conditions), params)
+        drop = [row[0] for row in cur.fetchall()]
+
+        drift = {}
+        if wanted is not None:
+            settings = sorted(wanted.settings)
+            cur.execute(DRIFT_QUERY + conditions + DRIFT_CONDITIONS + ";",
+                        params + [wanted.superuser, wanted.createdb,
+                                  wanted.createrole, wanted.inherit,
+                                  wanted.bypassrls, wanted.connection_limit,
+                                  [setting[0] for setting in settings],
+                                  [setting[1] for setting in settings],
+                                  [setting[2] for setting in settings]])
+            for row in cur.fetchall():
+                drift[row[0]] = PgRoleAttributes(row[1], row[2], row[3],
+                                                 row[4], row[5], row[6],
+                                                 get_role_settings(row[7]))
+                if row[8]:
+                    admins.add(row[0])
+    except psycopg2.Error as exception:
+        sys.stderr.write("Error comparing the LDAP users with the Postgres "
+                         "login roles: %s\n" % exception)
+        return None
+
+    cur.close()
+
+    return create, drop, admins, drift
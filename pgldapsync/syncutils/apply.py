@@ -0,0 +1,486 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Plan application functions."""
+
+import collections
+import time
+
+import psycopg2
+
+from ..pgutils.batch import execute_role_statements
+from ..pgutils.connection import connect_pg_server, get_database_connstr
+from ..pgutils.policy import RolePolicy
+from .journal import get_journal_progress, get_plan_digest, \
+    get_target_digest, journal_enabled, record_journal_progress
+from .metrics import METRICS
+from .throttle import BatchThrottle, throttling_enabled
+
+
+SyncResult = collections.namedtuple('SyncResult', ['added', 'dropped',
+                                                   'add_errors',
+                                                   'drop_errors', 'errors'])
+SyncResult.__doc__ = """The counts of operations/errors for a sync target,
+    and the error messages for any roles that could not be created or
+    dropped."""
+
+# The kinds of change in a plan, in the order they are made, and the
+# messages used to report failures.
+PLAN_ACTIONS = ('create', 'mark', 'alter', 'drop_owned', 'drop',
+                'create_group', 'revoke', 'grant')
+ACTION_ERRORS = {
+    'create': "Error creating role %s: %s",
+    'mark': "Error marking role %s as managed: %s",
+    'alter': "Error altering role %s: %s",
+    'drop_owned': "Error handling objects owned by dropped roles in "
+                  "database %s: %s",
+    'drop': "Error dropping role %s: %s",
+    'create_group': "Error creating group role %s: %s",
+    'revoke': "Error revoking group role %s: %s",
+    'grant': "Error granting group role %s: %s"
+}
+
+TargetPlan = collections.namedtuple('TargetPlan', ['steps', 'names',
+                                                   'groups'])
+TargetPlan.__doc__ = """The changes required to synchronise a Postgres target.
+
+    steps (dict): A list of (role, sql, members) tuples for each action,
+        where members lists the roles affected by a group membership change
+    names (str[]): The login roles that were compared, if only some were
+        (during an incremental sync), otherwise None
+    groups (str[]): The group roles whose memberships were compared, or None
+        if group memberships are not being synchronised
+"""
+
+
+def print_target_plan(plan, output, database):
+    """Print the SQL for a plan, so it can be manually executed if required.
+    Statements for other databases are printed first, with psql commands
+    to connect to each database in turn.
+
+    Args:
+        plan (TargetPlan): The changes to make
+        output (file): Where to write the SQL
+        database (str): The database the plan was made on
+    """
+    if not any(len(plan.steps[action]) > 0 for action in PLAN_ACTIONS):
+        print_no_changes(plan, output)
+        return
+
+    remote = [(name, role_sql) for name, role_sql, _ in
+              plan.steps['drop_owned'] if name != database]
+    for name, role_sql in remote:
+        print("\\connect '%s'" % name.replace("'", "''"), file=output)
+        print(role_sql, file=output)
+    if len(remote) > 0:
+        print("\\connect '%s'" % database.replace("'", "''"), file=output)
+
+    print("BEGIN;", file=output)
+    for action in PLAN_ACTIONS:
+        for name, role_sql, _ in plan.steps[action]:
+            if action != 'drop_owned' or name == database:
+                print(role_sql, file=output)
+    print("COMMIT;", file=output)
+
+
+def execute_drop_owned(config, pg_conn, operations, batch_size,
+                       throttle=None):
+    """Execute the SQL dealing with the objects owned by roles that are to
+    be dropped. The SQL for the current database is run in the current
+    transaction. The SQL for other databases is run and committed on a
+    separate connection to each database, so it takes effect before the
+    roles are dropped.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        pg_conn (connection): The Postgres connection object
+        operations (list): A list of (database, sql, roles) tuples
+        batch_size (int): The maximum number of statements per round-trip
+        throttle (BatchThrottle): Limits the rate of statements, if set
+    Returns:
+        dict: The error for each database that failed
+    """
+    database = pg_conn.info.dbname
+
+    failures = dict(execute_role_statements(
+        pg_conn, [(name, role_sql) for name, role_sql, _ in operations
+                  if name == database], batch_size, throttle))
+
+    for name, role_sql, _ in operations:
+        if name == database:
+            continue
+
+        if throttle is not None:
+            throttle.wait(1)
+
+        conn = connect_pg_server(get_database_connstr(
+            config.get('postgres', 'server_connstr'), name))
+        if conn is None:
+            failures[name] = 'unable to connect to the database'
+            continue
+
+        try:
+            cur = conn.cursor()
+            cur.execute(role_sql)
+            conn.commit()
+            cur.close()
+        except psycopg2.Error as exception:
+            failures[name] = str(exception).strip()
+        finally:
+            conn.close()
+
+        METRICS.count('pg_round_trips')
+        METRICS.count('pg_statements')
+
+    return failures
+
+
+def print_no_changes(plan, output):
+    """Report that a plan has nothing to do.
+
+    Args:
+        plan (TargetPlan): The changes to make
+        output (file): Where to write the message
+    """
+    print("No login roles or group memberships were changed."
+          if plan.groups is not None else
+          "No login roles were added or dropped.", file=output)
+
+
+class PlanTransaction:
+    """The transaction in which a plan is applied. By default, all the
+    changes are made in a single transaction. If commits are chunked, it is
+    committed after every commit_size operations, or once commit_interval
+    seconds have passed, and the progress is recorded in the journal so an
+    interrupted run can be resumed."""
+
+    def __init__(self, config, plan, pg_conn):
+        """Read the progress of an interrupted run of the plan, if any.
+
+        Args:
+            config (ConfigParser): The configuration for the target
+            plan (TargetPlan): The changes to make
+            pg_conn (connection): The Postgres connection object
+        """
+        self.config = config
+        self.cur = pg_conn.cursor()
+
+        # Roles that couldn't be created, by this run or an interrupted
+        # one, aren't granted group roles.
+        completed = {}
+        self.failed_roles = set()
+        self.journal = None
+        if self.chunked() and journal_enabled(config):
+            self.journal = (get_target_digest(pg_conn),
+                            get_plan_digest(pg_conn, plan))
+            completed, self.failed_roles = get_journal_progress(
+                config, self.journal[1])
+        self.completed = {action: completed.get(action, 0)
+                          for action in PLAN_ACTIONS}
+
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+    def chunked(self):
+        """Are commits chunked?
+
+        Returns:
+            bool: True if commit_size or commit_interval is set
+        """
+        return self.config.getint('postgres', 'commit_size') > 0 or \
+            self.config.getfloat('postgres', 'commit_interval') > 0
+
+    def begin(self, output):
+        """Begin the transaction.
+
+        Args:
+            output (file): Where to report progress being resumed
+        """
+        resumed = sum(self.completed.values())
+        if resumed > 0:
+            print("Resuming an interrupted sync, skipping %d operations "
+                  "that were completed." % resumed, file=output)
+
+        with METRICS.phase('pg_apply'):
+            self.cur.execute("BEGIN;")
+        self.committed_at = time.monotonic()
+
+    def chunks(self, action, steps):
+        """Get the operations for an action that haven't been completed, in
+        chunks. Each chunk must be executed before the next is requested,
+        which commits it if it's time to.
+
+        Args:
+            action (str): The action
+            steps (list): The plan's (role, sql, members) tuples for the
+                action
+        Yields:
+            list: A chunk of (role, sql, members) tuples
+        """
+        commit_size = self.config.getint('postgres', 'commit_size')
+        chunk_size = None
+        if self.chunked():
+            chunk_size = commit_size if commit_size > 0 else \
+                max(self.config.getint('postgres', 'batch_size'), 1)
+
+        while self.completed[action] < len(steps):
+            start = self.completed[action]
+            chunk = steps[start:start + chunk_size
+                          if chunk_size is not None else None]
+            self.completed[action] = start + len(chunk)
+            self.uncommitted = self.uncommitted + len(chunk)
+
+            yield chunk
+
+            self.commit_chunk()
+
+    def commit_chunk(self):
+        """Commit the operations executed so far, and begin a new
+        transaction, if it's time to."""
+        commit_size = self.config.getint('postgres', 'commit_size')
+        commit_interval = self.config.getfloat('postgres', 'commit_interval')
+        commit_every = commit_size if commit_size > 0 else float('inf')
+        commit_after = commit_interval if commit_interval > 0 \
+            else float('inf')
+        if self.uncommitted < commit_every and \
+                time.monotonic() - self.committed_at < commit_after:
+            return
+
+        with METRICS.phase('pg_apply'):
+            self.cur.execute("COMMIT;")
+            self.cur.execute("BEGIN;")
+        METRICS.count('pg_commits')
+
+        if self.journal is not None:
+            record_journal_progress(self.config, self.journal[0],
+                                    self.journal[1], self.completed,
+                                    self.failed_roles)
+        self.uncommitted = 0
+        self.committed_at = time.monotonic()
+
+    def commit(self):
+        """Commit the transaction, once the plan has been applied."""
+        with METRICS.phase('pg_apply'):
+            self.cur.execute("COMMIT;")
+            self.cur.close()
+        METRICS.count('pg_commits')
+
+        if self.journal is not None:
+            record_journal_progress(self.config, self.journal[0],
+                                    self.journal[1], None)
+
+
+def get_grant_operations(policy, operations, failed_roles):
+    """Remove the roles that couldn't be created from the members to be
+    granted group roles.
+
+    Args:
+        policy (RolePolicy): The role policy
+        operations (list): (group, sql, members) tuples for the grants
+        failed_roles (set): The roles that couldn't be created
+    Returns:
+        list: (group, sql, members) tuples for the grants to make
+    """
+    if len(failed_roles) == 0:
+        return operations
+
+    return [(group, policy.get_membership_sql(group, members, True), members)
+            for group, members in
+            ((group, [member for member in members
+                      if member not in failed_roles])
+             for group, _, members in operations)
+            if len(members) > 0]
+
+
+def execute_operations(config, pg_conn, action, operations, throttle):
+    """Execute the SQL for some of the operations in a plan in batches. The
+    SQL for each role is run in its own subtransaction, so we fail only a
+    single role rather than all of them if there's an error.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        pg_conn (connection): The Postgres connection object
+        action (str): The action
+        operations (list): (role, sql, members) tuples for the action
+        throttle (BatchThrottle): Limits the rate of statements, if set
+    Returns:
+        dict: The error for each role (or database) that failed
+    """
+    batch_size = config.getint('postgres', 'batch_size')
+
+    if action == 'drop_owned':
+        return execute_drop_owned(config, pg_conn, operations, batch_size,
+                                  throttle)
+
+    return dict(execute_role_statements(
+        pg_conn, [(role, role_sql) for role, role_sql, _ in operations],
+        batch_size, throttle))
+
+
+def print_plan_summary(plan, applied, failed, throttle, output):
+    """Print the summary of the work completed applying a plan.
+
+    Args:
+        plan (TargetPlan): The changes made
+        applied (dict): The number of operations applied for each action
+        failed (dict): The number of operations that failed for each action
+        throttle (BatchThrottle): Limits the rate of statements, if set
+        output (file): Where to write the summary
+    """
+    membership_errors = failed['create_group'] + failed['revoke'] + \
+        failed['grant']
+
+    print("Login roles added to Postgres:     %d" % applied['create'],
+          file=output)
+    print("Login roles dropped from Postgres: %d" % applied['drop'],
+          file=output)
+    if failed['create'] > 0:
+        print("Errors adding login roles:         %d" % failed['create'],
+              file=output)
+    if failed['drop'] > 0:
+        print("Errors dropping login roles:       %d" % failed['drop'],
+              file=output)
+    if len(plan.steps['mark']) > 0:
+        print("Login roles marked as managed:     %d" % applied['mark'],
+              file=output)
+    if failed['mark'] > 0:
+        print("Errors marking login roles:        %d" % failed['mark'],
+              file=output)
+    if len(plan.steps['drop_owned']) > 0:
+        print("Owned objects handled for roles:   %d" %
+              applied['drop_owned'], file=output)
+    if failed['drop_owned'] > 0:
+        print("Errors handling owned objects:     %d" %
+              failed['drop_owned'], file=output)
+    if len(plan.steps['alter']) > 0:
+        print("Login roles altered in Postgres:   %d" % applied['alter'],
+              file=output)
+    if failed['alter'] > 0:
+        print("Errors altering login roles:       %d" % failed['alter'],
+              file=output)
+    if plan.groups is not None:
+        print("Group roles added to Postgres:     %d" %
+              applied['create_group'], file=output)
+        print("Group memberships granted:         %d" % applied['grant'],
+              file=output)
+        print("Group memberships revoked:         %d" % applied['revoke'],
+              file=output)
+    if membership_errors > 0:
+        print("Errors changing group roles:       %d" % membership_errors,
+              file=output)
+    if throttle is not None:
+        print("Statements per second:             %.1f" %
+              throttle.limiter.get_rate(), file=output)
+        print("Final batch size:                  %d" % throttle.batch_size,
+              file=output)
+        print("Batch size back-offs:              %d" % throttle.backoffs,
+              file=output)
+
+
+def count_plan_metrics(plan, applied, failed, throttle):
+    """Record the metrics for the work completed applying a plan.
+
+    Args:
+        plan (TargetPlan): The changes made
+        applied (dict): The number of operations applied for each action
+        failed (dict): The number of operations that failed for each action
+        throttle (BatchThrottle): Limits the rate of statements, if set
+    """
+    membership_errors = failed['create_group'] + failed['revoke'] + \
+        failed['grant']
+
+    METRICS.count('login_roles_added', applied['create'])
+    METRICS.count('login_roles_dropped', applied['drop'])
+    METRICS.count('login_role_add_errors', failed['create'])
+    METRICS.count('login_role_drop_errors', failed['drop'])
+    if len(plan.steps['mark']) > 0:
+        METRICS.count('login_roles_marked', applied['mark'])
+        METRICS.count('login_role_mark_errors', failed['mark'])
+    if len(plan.steps['drop_owned']) > 0:
+        METRICS.count('owned_objects_handled', applied['drop_owned'])
+        METRICS.count('owned_object_errors', failed['drop_owned'])
+    if len(plan.steps['alter']) > 0:
+        METRICS.count('login_roles_altered', applied['alter'])
+        METRICS.count('login_role_alter_errors', failed['alter'])
+    if throttle is not None:
+        METRICS.count('pg_final_batch_size', throttle.batch_size)
+    if plan.groups is not None:
+        METRICS.count('group_roles_added', applied['create_group'])
+        METRICS.count('group_memberships_granted', applied['grant'])
+        METRICS.count('group_memberships_revoked', applied['revoke'])
+        METRICS.count('group_role_errors', membership_errors)
+
+
+def apply_target_plan(config, plan, pg_conn, output):
+    """Make the changes in a plan on a Postgres server.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        plan (TargetPlan): The changes to make
+        pg_conn (connection): The Postgres connection object
+        output (file): Where to write the summary
+    Returns:
+        SyncResult: The counts of operations/errors
+    """
+    # Initialise the counters for operations/errors
+    applied = {action: 0 for action in PLAN_ACTIONS}
+    failed = {action: 0 for action in PLAN_ACTIONS}
+    errors = []
+
+    if not any(len(plan.steps[action]) > 0 for action in PLAN_ACTIONS):
+        print_no_changes(plan, output)
+
+        # Don't leave the transaction opened by the role queries idle, as
+        # the connection may be reused for the next sync.
+        pg_conn.rollback()
+
+        return SyncResult(0, 0, 0, 0, errors)
+
+    policy = RolePolicy(config, pg_conn)
+
+    # Limit the rate of statements and adapt the batch size to the load on
+    # the server, if required
+    throttle = None
+    if throttling_enabled(config):
+        throttle = BatchThrottle(config)
+
+    transaction = PlanTransaction(config, plan, pg_conn)
+    transaction.begin(output)
+
+    for action in PLAN_ACTIONS:
+        for operations in transaction.chunks(action, plan.steps[action]):
+
+            # Don't grant group roles to roles that couldn't be created
+            if action == 'grant':
+                operations = get_grant_operations(policy, operations,
+                                                  transaction.failed_roles)
+
+            with METRICS.phase('pg_apply'):
+                failures = execute_operations(config, pg_conn, action,
+                                              operations, throttle)
+
+            for role, _, members in operations:
+                if role in failures:
+                    errors.append(ACTION_ERRORS[action] %
+                                  (role, failures[role]))
+                    failed[action] = failed[action] + 1
+                    if action == 'create':
+                        transaction.failed_roles.add(role)
+                else:
+                    applied[action] = applied[action] + max(len(members), 1)
+
+    transaction.commit()
+
+    print_plan_summary(plan, applied, failed, throttle, output)
+    pg_conn.rollback()
+    count_plan_metrics(plan, applied, failed, throttle)
+
+    return SyncResult(applied['create'], applied['drop'], failed['create'],
+                      failed['drop'], errors)
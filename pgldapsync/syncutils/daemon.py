@@ -0,0 +1,177 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Daemon mode functions."""
+
+import random
+import signal
+import sys
+import threading
+import time
+
+import psycopg2
+from ldap3.core.exceptions import LDAPException
+
+from ..ldaputils.connection import connect_ldap_server
+from .metrics import METRICS, write_metrics
+from .sync import sync_roles
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def acquire_lock(config):
+    """Take an exclusive lock on the configured lock file, to ensure that
+    only one sync can run at a time, even across processes.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        file: The open lock file, which must be kept open to hold the lock,
+            or None if no lock file is configured
+    """
+    lock_file = config.get('general', 'lock_file')
+    if lock_file == '':
+        return None
+
+    if fcntl is None:
+        sys.stderr.write("File locking is not supported on this platform, "
+                         "ignoring lock_file.\n")
+        return None
+
+    try:
+        # pylint: disable=consider-using-with
+        lock = open(lock_file, 'a', encoding='utf-8')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as exception:
+        sys.stderr.write("Error locking %s, is another sync running? %s\n" %
+                         (lock_file, exception))
+        sys.exit(1)
+
+    return lock
+
+
+def close_connections(ldap_conn, pg_conns):
+    """Close the LDAP and Postgres connections, ignoring any errors.
+
+    Args:
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+        pg_conns (dict): The Postgres connections, keyed by target name
+    """
+    if ldap_conn is not None:
+        try:
+            ldap_conn.unbind()
+        except LDAPException:
+            pass
+
+    for pg_conn in pg_conns.values():
+        try:
+            pg_conn.close()
+        except psycopg2.Error:
+            pass
+    pg_conns.clear()
+
+
+def run_sync_cycle(config, ldap_conn, pg_conns, dry_run):
+    """Run a single sync, (re)connecting to the servers first if required.
+    Connections are dropped if an error suggests they are no longer usable,
+    so they will be recreated in the next cycle.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+            to reuse, or None
+        pg_conns (dict): The Postgres connections to reuse, keyed by target
+            name. Updated as connections are made or dropped.
+        dry_run (bool): Print the SQL to stdout rather than executing it
+    Returns:
+        ldap3.core.connection.Connection: The LDAP connection to use for
+            the next cycle
+    """
+    METRICS.reset()
+    completed = False
+
+    if ldap_conn is not None and ldap_conn.closed:
+        ldap_conn = None
+    if ldap_conn is None:
+        ldap_conn = connect_ldap_server(config)
+        if ldap_conn is not None and not ldap_conn.bound:
+            close_connections(ldap_conn, {})
+            ldap_conn = None
+
+    if ldap_conn is None:
+        sys.stderr.write("Skipping sync as the LDAP server is unavailable.\n")
+        write_metrics(config, completed)
+        return None
+
+    try:
+        completed = sync_roles(config, ldap_conn, pg_conns, dry_run)
+        if not completed:
+            sys.stderr.write("Sync failed for one or more Postgres "
+                             "targets.\n")
+    except SystemExit:
+        # Errors have already been reported.
+        sys.stderr.write("Sync failed.\n")
+    except LDAPException as exception:
+        sys.stderr.write("Error communicating with the LDAP server: %s\n" %
+                         exception)
+        close_connections(ldap_conn, {})
+        ldap_conn = None
+
+    write_metrics(config, completed)
+    sys.stdout.flush()
+
+    return ldap_conn
+
+
+def run_daemon(config, dry_run):
+    """Run syncs continuously, every sync_interval seconds plus a random
+    delay of up to sync_jitter seconds. The LDAP and Postgres connections
+    are kept open between syncs. A sync that takes longer than the interval
+    delays the next one, so syncs never overlap.
+
+    Args:
+        config (ConfigParser): The application configuration
+        dry_run (bool): Print the SQL to stdout rather than executing it
+    """
+    interval = config.getint('general', 'sync_interval')
+    jitter = config.getint('general', 'sync_jitter')
+
+    lock = acquire_lock(config)
+
+    # Stop cleanly when asked to, waiting for any sync in progress to finish
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        # pylint: disable=unused-argument
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    ldap_conn = None
+    pg_conns = {}
+
+    while not stop.is_set():
+        started = time.monotonic()
+        print("Starting sync at %s" % time.strftime('%Y-%m-%d %H:%M:%S'))
+
+        ldap_conn = run_sync_cycle(config, ldap_conn, pg_conns, dry_run)
+
+        delay = interval + random.uniform(0, max(jitter, 0)) - \
+            (time.monotonic() - started)
+        stop.wait(max(delay, 0))
+
+    close_connections(ldap_conn, pg_conns)
+
+    if lock is not None:
+        lock.close()
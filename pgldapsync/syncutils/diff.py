@@ -0,0 +1,192 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Role diffing functions."""
+
+import collections
+import re
+import sys
+
+from .names import NameSet
+
+
+RoleDiff = collections.namedtuple('RoleDiff', ['create', 'drop', 'admins'])
+RoleDiff.__doc__ = """The result of comparing LDAP users with Postgres roles.
+
+    create (str[]): Roles that exist in LDAP but not Postgres, in order
+    drop (str[]): Roles that exist in Postgres but not LDAP, in order
+    admins (NameSet): Roles that should be created as, or be, superusers
+"""
+
+
+def get_role_name_normaliser(config):
+    """Get a function that maps an LDAP user name to a Postgres role name,
+    according to the role_name_* settings.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        callable: A function taking and returning a str
+    """
+    case = config.get('general', 'role_name_case').lower()
+    if case not in ('preserve', 'lower', 'upper'):
+        sys.stderr.write("Invalid role_name_case value: %s\n" % case)
+        sys.exit(1)
+
+    pattern = None
+    if config.get('general', 'role_name_regex') != '':
+        try:
+            pattern = re.compile(config.get('general', 'role_name_regex'))
+        except re.error as exception:
+            sys.stderr.write("Invalid role_name_regex value: %s\n" % exception)
+            sys.exit(1)
+    replacement = config.get('general', 'role_name_replacement')
+
+    def normalise(name):
+        if pattern is not None:
+            name = pattern.sub(replacement, name)
+
+        if case == 'lower':
+            name = name.lower()
+        elif case == 'upper':
+            name = name.upper()
+
+        return name
+
+    return normalise
+
+
+def normalise_users(normaliser, users):
+    """Normalise a list of LDAP user names, removing any duplicates that
+    arise. The order of first appearance is preserved.
+
+    Args:
+        normaliser (callable): The role name normaliser
+        users (iterable): The LDAP user names
+    Returns:
+        str[]: The normalised role names
+    """
+    seen = set()
+    names = []
+
+    for user in users:
+        name = normaliser(user)
+        if name != '' and name not in seen:
+            seen.add(name)
+            names.append(name)
+
+    return names
+
+
+def get_role_names(normaliser, users):
+    """Normalise LDAP user names into a compact set of role names. The
+    names are read once, so they may be streamed from the LDAP server.
+
+    Args:
+        normaliser (callable): The role name normaliser
+        users (iterable): The LDAP user names
+    Returns:
+        NameSet: The normalised role names
+    """
+    return NameSet(name for name in map(normaliser, users) if name != '')
+
+
+def diff_role_names(wanted, pg_roles, admins):
+    """Compare normalised role names from LDAP with the Postgres login
+    roles. Both sides are held as sorted name sets and merged, so the cost
+    is linear in the number of names and only the differences are built as
+    lists.
+
+    Args:
+        wanted (iterable): The normalised LDAP role names, ideally as a
+            NameSet
+        pg_roles (iterable): The (filtered) login roles in Postgres,
+            ideally as a NameSet
+        admins (NameSet): The normalised role names of admin users
+    Returns:
+        RoleDiff: The roles to create and drop, and the admin roles
+    """
+    if not isinstance(wanted, NameSet):
+        wanted = NameSet(wanted)
+    if not isinstance(pg_roles, NameSet):
+        pg_roles = NameSet(pg_roles)
+
+    create = list(wanted.difference(pg_roles))
+    drop = list(pg_roles.difference(wanted))
+
+    return RoleDiff(create, drop, admins)
+
+
+def diff_login_roles(config, ldap_users, pg_roles, ldap_admin_users=None):
+    """Compare the LDAP users with the Postgres login roles.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_users (iterable): The (filtered) users in LDAP
+        pg_roles (iterable): The (filtered) login roles in Postgres,
+            ideally as a NameSet
+        ldap_admin_users (iterable): The LDAP users that should be superusers
+    Returns:
+        RoleDiff: The roles to create and drop, and the admin roles
+    """
+    normaliser = get_role_name_normaliser(config)
+
+    wanted = get_role_names(normaliser, ldap_users)
+    admins = get_role_names(normaliser, ldap_admin_users or [])
+
+    return diff_role_names(wanted, pg_roles, admins)
+
+
+MembershipDiff = collections.namedtuple('MembershipDiff',
+                                        ['groups', 'create', 'grant',
+                                         'revoke'])
+MembershipDiff.__doc__ = """The result of comparing LDAP group membership with
+    Postgres group roles.
+
+    groups (str[]): The sorted names of all the group roles compared
+    create (str[]): Group roles that need to be created
+    grant (dict): The sorted member roles to grant each group role to
+    revoke (dict): The sorted member roles to revoke each group role from
+"""
+
+
+def diff_memberships(wanted, pg_groups, pg_memberships, managed):
+    """Compare LDAP group memberships with Postgres group role memberships.
+    Only memberships of roles synchronised from LDAP are revoked; other
+    members of the group roles are left alone.
+
+    Args:
+        wanted (dict): The set of normalised member role names for each
+            normalised group role name
+        pg_groups (set): The group roles that exist in Postgres
+        pg_memberships (set): (group, member) tuples in Postgres
+        managed (container): The login roles synchronised from LDAP
+    Returns:
+        MembershipDiff: The group roles to create, and memberships to change
+    """
+    grant = {}
+    revoke = {}
+
+    for group, member in pg_memberships:
+        if member in managed and group in wanted and \
+                member not in wanted[group]:
+            revoke.setdefault(group, []).append(member)
+
+    for group, members in wanted.items():
+        for member in members:
+            if (group, member) not in pg_memberships:
+                grant.setdefault(group, []).append(member)
+
+    for members in list(grant.values()) + list(revoke.values()):
+        members.sort()
+
+    create = sorted(group for group in wanted if group not in pg_groups)
+
+    return MembershipDiff(sorted(wanted), create, grant, revoke)
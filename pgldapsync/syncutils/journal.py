@@ -0,0 +1,176 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Sync journal functions."""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+
+
+# Targets are synchronised concurrently, but share the journal file.
+JOURNAL_LOCK = threading.Lock()
+
+
+def journal_enabled(config):
+    """Is the progress of chunked commits recorded in a journal?
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        bool: True if a journal_file is configured
+    """
+    return config.get('general', 'journal_file') != ''
+
+
+def get_target_digest(conn):
+    """Get a digest identifying a Postgres target, so that the journal
+    doesn't record its connection string, which may include a password.
+
+    Args:
+        conn (connection): The Postgres connection object for the target
+    Returns:
+        str: The digest
+    """
+    return hashlib.sha256(conn.dsn.encode('utf-8')).hexdigest()
+
+
+def get_plan_digest(conn, plan):
+    """Get a digest identifying a plan for a Postgres target, so that its
+    progress can be found in the journal.
+
+    Args:
+        conn (connection): The Postgres connection object for the target
+        plan (TargetPlan): The plan
+    Returns:
+        str: The digest
+    """
+    digest = hashlib.sha256()
+    digest.update(conn.dsn.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(json.dumps(sorted(plan.steps.items())).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def read_journal(config):
+    """Read the sync journal file.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        dict: The progress of each interrupted plan, by plan digest
+    """
+    journal_file = config.get('general', 'journal_file')
+    if journal_file == '':
+        return {}
+
+    try:
+        with open(journal_file, 'r', encoding='utf-8') as file:
+            journal = json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as exception:
+        sys.stderr.write("Error reading the sync journal file (%s): %s\n" %
+                         (journal_file, exception))
+        return {}
+
+    if not isinstance(journal, dict):
+        return {}
+
+    return journal
+
+
+def write_journal(config, journal):
+    """Write the sync journal file. The file is written to a temporary name
+    and renamed into place, so it is never left partially written. The file
+    is removed once there is nothing left to resume.
+
+    Args:
+        config (ConfigParser): The application configuration
+        journal (dict): The progress of each interrupted plan, by plan
+            digest
+    """
+    journal_file = config.get('general', 'journal_file')
+    temp_file = '%s.%d.tmp' % (journal_file, os.getpid())
+
+    try:
+        if len(journal) == 0:
+            if os.path.exists(journal_file):
+                os.remove(journal_file)
+            return
+
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump(journal, file, indent=4, sort_keys=True)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, journal_file)
+    except OSError as exception:
+        sys.stderr.write("Error writing the sync journal file (%s): %s\n" %
+                         (journal_file, exception))
+
+
+def get_journal_progress(config, digest):
+    """Get the progress recorded for a plan by an earlier, interrupted run.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        digest (str): The plan digest
+    Returns:
+        tuple: A dict of the number of operations completed for each
+            action, and the set of roles that couldn't be created
+    """
+    with JOURNAL_LOCK:
+        progress = read_journal(config).get(digest)
+
+    if not isinstance(progress, dict) or \
+            not isinstance(progress.get('completed'), dict):
+        return {}, set()
+
+    return progress['completed'], set(progress.get('failed_roles', []))
+
+
+def record_journal_progress(config, target, digest, completed,
+                            failed_roles=()):
+    """Record the progress made applying a plan, once it is committed.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        target (str): The target digest
+        digest (str): The plan digest
+        completed (dict): The number of operations completed for each
+            action, or None if the plan has been completely applied
+        failed_roles (iterable): The roles that couldn't be created, so
+            that a resumed run doesn't grant group roles to them
+    """
+    if not journal_enabled(config):
+        return
+
+    with JOURNAL_LOCK:
+        journal = read_journal(config)
+        if completed is None:
+            # A normal sync re-plans rather than resuming, and a plan file
+            # can't be applied once another plan has changed the roles, so
+            # any other progress recorded for the target is now stale.
+            stale = [key for key, progress in journal.items()
+                     if key == digest or (isinstance(progress, dict) and
+                                          progress.get('target') == target)]
+            if len(stale) == 0:
+                return
+            for key in stale:
+                journal.pop(key)
+        else:
+            journal[digest] = {'target': target,
+                               'completed': dict(completed),
+                               'failed_roles': sorted(failed_roles)}
+
+        write_journal(config, journal)
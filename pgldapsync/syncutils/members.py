@@ -0,0 +1,81 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Group membership synchronisation functions."""
+
+import sys
+
+from ..pgutils.roles import get_pg_group_memberships
+from .metrics import METRICS
+from .diff import diff_memberships, get_role_name_normaliser
+
+
+def get_membership_diff(config, groups, pg_conn, managed):
+    """Compare the LDAP group memberships with the Postgres group roles.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        groups (dict): The set of member user names for each LDAP group
+        pg_conn (connection): The Postgres connection object
+        managed (container): The login roles synchronised from LDAP
+    Returns:
+        MembershipDiff: The group roles to create, and memberships to change
+    """
+    normaliser = get_role_name_normaliser(config)
+
+    wanted = {}
+    for group, users in groups.items():
+        name = normaliser(group)
+        if name == '':
+            continue
+
+        members = wanted.setdefault(name, set())
+        for user in users:
+            member = normaliser(user)
+            if member in managed:
+                members.add(member)
+
+    with METRICS.phase('pg_fetch_groups'):
+        result = get_pg_group_memberships(pg_conn, wanted.keys())
+    if result is None:
+        sys.exit(1)
+
+    return diff_memberships(wanted, result[0], result[1], managed)
+
+
+def get_membership_operations(policy, membership_diff, existing):
+    """Get the SQL required to apply a membership diff, as a list of
+    operations for each of group creation, revocation and granting. Each
+    operation changes a single group role. Grants are only made to roles
+    that exist.
+
+    Args:
+        policy (RolePolicy): The role policy
+        membership_diff (MembershipDiff): The memberships to change
+        existing (container): The login roles that exist
+    Returns:
+        tuple: Lists of (group, sql, members) tuples for the groups to
+            create, the memberships to revoke and those to grant
+    """
+    create = [(group, policy.get_create_group_sql(group), [])
+              for group in membership_diff.create]
+
+    revoke = [(group, policy.get_membership_sql(group, members, False),
+               members)
+              for group, members in sorted(membership_diff.revoke.items())]
+
+    grant = []
+    for group, members in sorted(membership_diff.grant.items()):
+        members = [member for member in members if member in existing]
+        if len(members) > 0:
+            grant.append((group, policy.get_membership_sql(group, members,
+                                                           True), members))
+
+    return create, revoke, grant
@@ -0,0 +1,308 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Sync metrics and timing functions."""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+METRIC_PREFIX = 'pgldapsync_'
+
+
+class Metrics:
+    """Phase timings, counters and latency histograms collected during a
+    sync. Each value is recorded against the Postgres target being
+    synchronised by the current thread, if any. Phase timings exclude the
+    time spent in any phases nested within them, so for example the time
+    spent streaming LDAP search results while diffing is counted as LDAP
+    search time, not diff time."""
+
+    def __init__(self):
+        """Create an empty set of metrics."""
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+        self.profiler = None
+
+    def reset(self):
+        """Discard all the metrics collected so far, ready for a new sync."""
+        with self.lock:
+            self.started = time.time()
+            self.phases = {}
+            self.counters = {}
+            self.histograms = {}
+
+        if self.profiler is not None:
+            self.profiler.reset()
+
+    def get_target(self):
+        """Get the name of the target being synchronised by this thread.
+
+        Returns:
+            str: The target name, or an empty string if there is none
+        """
+        return getattr(self.local, 'target', '')
+
+    @contextlib.contextmanager
+    def target(self, name):
+        """Record metrics from this thread against a Postgres target.
+
+        Args:
+            name (str): The target name
+        """
+        self.local.target = name
+        try:
+            yield
+        finally:
+            self.local.target = ''
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the sync, and profile it if a profiler has been
+        started.
+
+        Args:
+            name (str): The phase name
+        """
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.enter(name, self.get_target())
+
+        stack = self.local.__dict__.setdefault('phases', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if len(stack) > 0:
+                stack[-1] = stack[-1] + elapsed
+            self.count(name, elapsed - nested, self.phases)
+
+            if profiler is not None:
+                profiler.exit()
+
+    def count(self, name, value=1, values=None):
+        """Add to a counter.
+
+        Args:
+            name (str): The counter name
+            value (int): The amount to add
+            values (dict): The metrics to update, the counters if None
+        """
+        if values is None:
+            values = self.counters
+
+        key = (name, self.get_target())
+        with self.lock:
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        """Record a latency in a histogram.
+
+        Args:
+            name (str): The histogram name
+            seconds (float): The latency
+        """
+        key = (name, self.get_target())
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0,
+                      'count': 0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] = histogram['buckets'][i] + 1
+            histogram['sum'] = histogram['sum'] + seconds
+            histogram['count'] = histogram['count'] + 1
+
+    def to_dict(self, completed):
+        """Get the metrics as a dictionary, suitable for JSON output. Metrics
+        recorded against a Postgres target are listed under its name.
+
+        Args:
+            completed (bool): Did the sync complete?
+        Returns:
+            dict: The metrics
+        """
+        with self.lock:
+            result = {
+                'started': self.started,
+                'duration_seconds': time.time() - self.started,
+                'completed': completed,
+                'phases': {},
+                'counters': {},
+                'histograms': {},
+                'targets': {}
+            }
+
+            for kind, values in (('phases', self.phases),
+                                 ('counters', self.counters),
+                                 ('histograms', self.histograms)):
+                for (name, target), value in sorted(values.items()):
+                    if target != '':
+                        section = result['targets'].setdefault(
+                            target, {'phases': {}, 'counters': {},
+                                     'histograms': {}})
+                    else:
+                        section = result
+
+                    if kind == 'histograms':
+                        value = {
+                            'buckets': dict(zip(LATENCY_BUCKETS,
+                                                value['buckets'])),
+                            'sum': value['sum'],
+                            'count': value['count']
+                        }
+                    section[kind][name] = value
+
+        return result
+
+    def to_prometheus(self, completed):
+        """Get the metrics in the Prometheus text exposition format, for use
+        with the node_exporter textfile collector.
+
+        Args:
+            completed (bool): Did the sync complete?
+        Returns:
+            str: The metrics
+        """
+        lines = [
+            '# HELP %ssync_completed Did the last sync complete?' %
+            METRIC_PREFIX,
+            '# TYPE %ssync_completed gauge' % METRIC_PREFIX,
+            '%ssync_completed %d' % (METRIC_PREFIX, 1 if completed else 0),
+            '# HELP %ssync_timestamp_seconds When the last sync started.' %
+            METRIC_PREFIX,
+            '# TYPE %ssync_timestamp_seconds gauge' % METRIC_PREFIX,
+            '%ssync_timestamp_seconds %f' % (METRIC_PREFIX, self.started),
+            '# HELP %ssync_duration_seconds How long the last sync took.' %
+            METRIC_PREFIX,
+            '# TYPE %ssync_duration_seconds gauge' % METRIC_PREFIX,
+            '%ssync_duration_seconds %f' % (METRIC_PREFIX,
+                                            time.time() - self.started),
+            '# HELP %sphase_seconds Time spent in each phase of the last '
+            'sync.' % METRIC_PREFIX,
+            '# TYPE %sphase_seconds gauge' % METRIC_PREFIX
+        ]
+
+        with self.lock:
+            for (name, target), value in sorted(self.phases.items()):
+                lines.append('%sphase_seconds%s %f' %
+                             (METRIC_PREFIX,
+                              get_labels(target, phase=name), value))
+
+            declared = set()
+            for (name, target), value in sorted(self.counters.items()):
+                if name not in declared:
+                    lines.append('# TYPE %s%s gauge' % (METRIC_PREFIX, name))
+                    declared.add(name)
+                lines.append('%s%s%s %s' % (METRIC_PREFIX, name,
+                                            get_labels(target), value))
+
+            for (name, target), value in sorted(self.histograms.items()):
+                if name not in declared:
+                    lines.append('# TYPE %s%s histogram' %
+                                 (METRIC_PREFIX, name))
+                    declared.add(name)
+                for bound, count in zip(LATENCY_BUCKETS, value['buckets']):
+                    lines.append('%s%s_bucket%s %d' %
+                                 (METRIC_PREFIX, name,
+                                  get_labels(target, le=str(bound)), count))
+                lines.append('%s%s_bucket%s %d' %
+                             (METRIC_PREFIX, name,
+                              get_labels(target, le='+Inf'), value['count']))
+                lines.append('%s%s_sum%s %f' % (METRIC_PREFIX, name,
+                                                get_labels(target),
+                                                value['sum']))
+                lines.append('%s%s_count%s %d' % (METRIC_PREFIX, name,
+                                                  get_labels(target),
+                                                  value['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics for the sync in progress
+METRICS = Metrics()
+
+
+def get_labels(target, **labels):
+    """Format a set of Prometheus labels.
+
+    Args:
+        target (str): The target name, omitted if empty
+        labels (dict): Any additional labels
+    Returns:
+        str: The formatted labels, or an empty string if there are none
+    """
+    if target != '':
+        labels['target'] = target
+
+    if len(labels) == 0:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+
+def write_metrics_file(file, data):
+    """Atomically write a metrics file, so that readers never see a
+    partially written file.
+
+    Args:
+        file (str): The file to write
+        data (str): The file contents
+    """
+    temp_file = '%s.tmp' % file
+
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as metrics:
+            metrics.write(data)
+        os.replace(temp_file, file)
+    except OSError as exception:
+        sys.stderr.write("Error writing metrics file %s: %s\n" %
+                         (file, exception))
+
+
+def write_metrics(config, completed):
+    """Write the metrics for the last sync to the configured files, if any,
+    and the profile reports if a profiler has been started.
+
+    Args:
+        config (ConfigParser): The application configuration
+        completed (bool): Did the sync complete?
+    """
+    json_file = config.get('general', 'metrics_json_file')
+    if json_file != '':
+        write_metrics_file(json_file,
+                           json.dumps(METRICS.to_dict(completed),
+                                      indent=2) + '\n')
+
+    prometheus_file = config.get('general', 'metrics_prometheus_file')
+    if prometheus_file != '':
+        write_metrics_file(prometheus_file,
+                           METRICS.to_prometheus(completed))
+
+    if METRICS.profiler is not None:
+        METRICS.profiler.write()
@@ -0,0 +1,204 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Compact name set functions."""
+
+import bisect
+import itertools
+
+
+# The number of names packed into each block of a NameSet
+BLOCK_SIZE = 128
+
+# The number of names sorted in memory as Python strings at a time while
+# building a NameSet. Each run is packed once sorted, and the runs are then
+# merged, reading MERGE_BLOCKS blocks of each run at a time.
+RUN_SIZE = 65536
+MERGE_BLOCKS = 8
+
+
+def pack_names(names):
+    """Pack sorted, unique names into blocks. Each block holds the UTF-8
+    encoded names, each preceded and followed by a NUL byte, which cannot
+    appear in a role name.
+
+    Args:
+        names (iterable): The names, in order
+    Returns:
+        tuple: The list of blocks, the list of the first name in each block,
+            and the number of names
+    """
+    blocks = []
+    firsts = []
+    count = 0
+    names = iter(names)
+
+    while True:
+        block = list(itertools.islice(names, BLOCK_SIZE))
+        if len(block) == 0:
+            break
+
+        blocks.append(('\0%s\0' % '\0'.join(block)).encode('utf-8'))
+        firsts.append(block[0])
+        count = count + len(block)
+
+    return blocks, firsts, count
+
+
+def unpack_block(block):
+    """Read the names from a block.
+
+    Args:
+        block (bytes): The block
+    Returns:
+        str[]: The names, in order
+    """
+    return block[1:-1].decode('utf-8').split('\0')
+
+
+def merge_runs(runs):
+    """Merge runs of packed names. The runs are consumed a few blocks at a
+    time: all the names up to the smallest last name read from each run are
+    sorted together, so the comparisons are made by sorted() rather
+    than one at a time. Blocks are released as they are read.
+
+    Args:
+        runs (list): The lists of blocks of each run, as returned by
+            pack_names()
+    Yields:
+        str[]: Batches of the unique names, in order
+    """
+    positions = [0] * len(runs)
+    current = [[] for _ in runs]
+
+    while True:
+        for index, blocks in enumerate(runs):
+            if len(current[index]) > 0:
+                continue
+
+            for position in range(positions[index],
+                                  min(positions[index] + MERGE_BLOCKS,
+                                      len(blocks))):
+                current[index].extend(unpack_block(blocks[position]))
+                blocks[position] = None
+            positions[index] = positions[index] + MERGE_BLOCKS
+
+        names = [run_names for run_names in current if len(run_names) > 0]
+        if len(names) == 0:
+            return
+
+        bound = min(run_names[-1] for run_names in names)
+        batch = set()
+        for index, run_names in enumerate(current):
+            end = bisect.bisect_right(run_names, bound)
+            batch.update(run_names[:end])
+            current[index] = run_names[end:]
+
+        yield sorted(batch)
+
+
+class NameSet:
+    """An immutable, sorted set of names, packed into blocks of UTF-8 bytes
+    rather than held as Python strings. Each name takes little more than
+    the length of its encoding, a fraction of the memory used by a str in a
+    list or set, so very large sets of user and role names can be compared
+    cheaply.
+
+    Names are kept in the order of the strings, so iterating over a NameSet
+    gives the same result as sorted(). Membership is tested by a binary
+    search for the block that could hold the name, and a search of the
+    block.
+    """
+
+    def __init__(self, names=()):
+        """Build a name set. The names are read once, so they may be
+        streamed from a search or query; duplicates are removed.
+
+        Args:
+            names (iterable): The names
+        """
+        names = iter(names)
+        runs = []
+
+        while True:
+            run = sorted(set(itertools.islice(names, RUN_SIZE)))
+            if len(run) == 0 and len(runs) > 0:
+                break
+            runs.append(pack_names(run))
+        del run
+
+        if len(runs) == 1:
+            self.blocks, self.firsts, self.length = runs[0]
+            return
+
+        self.blocks, self.firsts, self.length = pack_names(
+            itertools.chain.from_iterable(merge_runs(
+                [blocks for blocks, _, _ in runs])))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from unpack_block(block)
+
+    def __contains__(self, name):
+        index = bisect.bisect_right(self.firsts, name) - 1
+        if index < 0:
+            return False
+
+        return ('\0%s\0' % name).encode('utf-8') in self.blocks[index]
+
+    def difference(self, other):
+        """Get the names that are not in another set. Each block is compared
+        with the blocks of the other set that cover the same range of names,
+        rather than looking up each name.
+
+        Args:
+            other (NameSet): The other set
+        Yields:
+            str: The names in this set but not the other, in order
+        """
+        for block in self.blocks:
+            names = unpack_block(block)
+
+            start = max(bisect.bisect_right(other.firsts, names[0]) - 1, 0)
+            end = bisect.bisect_right(other.firsts, names[-1])
+            others = set()
+            for other_block in other.blocks[start:end]:
+                others.update(unpack_block(other_block))
+
+            for name in names:
+                if name not in others:
+                    yield name
+
+
+class AmendedNameSet:  # pylint: disable=too-few-public-methods
+    """A set of names with a few names added and removed, that tests
+    membership without copying the original set.
+    """
+
+    def __init__(self, names, added=(), removed=()):
+        """Initialise the set.
+
+        Args:
+            names (NameSet): The original set, or any container of names
+            added (iterable): Names to add
+            removed (iterable): Names to remove
+        """
+        self.names = names
+        self.added = frozenset(added)
+        self.removed = frozenset(removed).difference(self.added)
+
+    def __contains__(self, name):
+        if name in self.added:
+            return True
+
+        return name not in self.removed and name in self.names
@@ -0,0 +1,362 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Plan file functions."""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+from ..pgutils.roles import get_filtered_pg_login_roles, \
+    get_pg_group_memberships
+from .apply import PLAN_ACTIONS, SyncResult, TargetPlan, \
+    apply_target_plan, print_target_plan
+from .journal import get_journal_progress, get_plan_digest, \
+    journal_enabled
+from .metrics import METRICS
+from .state import get_config_fingerprint, read_sync_state, \
+    write_sync_state
+from .sync import get_next_sync_state, plan_target, print_ldap_throttle, \
+    read_ldap_sync, run_targets
+from .targets import get_targets
+
+
+PLAN_VERSION = 1
+
+
+def get_postgres_fingerprint(config, pg_conn, plan):
+    """Get a fingerprint of the Postgres roles (and their attributes, if they
+    are reconciled) and group memberships that a plan was made from, so it
+    can be cheaply checked that they have not changed before the plan is
+    applied.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        pg_conn (connection): The Postgres connection object
+        plan (TargetPlan): The plan
+    Returns:
+        str: The fingerprint
+    """
+    reconcile = config.getboolean('general', 'reconcile_role_attributes')
+    with METRICS.phase('pg_fetch_roles'):
+        pg_login_roles = get_filtered_pg_login_roles(config, pg_conn,
+                                                     plan.names, reconcile)
+    if pg_login_roles is None:
+        sys.exit(1)
+
+    # Without attributes, the roles are a NameSet, which is already sorted
+    digest = hashlib.sha256()
+    for role in sorted(pg_login_roles) if reconcile else pg_login_roles:
+        digest.update(role.encode('utf-8'))
+        digest.update(b'\0')
+
+        # The plan may alter the role, so its attributes must not have
+        # changed either.
+        if reconcile:
+            attributes = pg_login_roles[role]
+            digest.update(repr(attributes._replace(
+                settings=sorted(attributes.settings))).encode('utf-8'))
+            digest.update(b'\0')
+
+    if plan.groups is not None:
+        with METRICS.phase('pg_fetch_groups'):
+            result = get_pg_group_memberships(pg_conn, plan.groups)
+        if result is None:
+            sys.exit(1)
+
+        digest.update(b'\1')
+        for group in sorted(result[0]):
+            digest.update(group.encode('utf-8'))
+            digest.update(b'\0')
+
+        digest.update(b'\1')
+        for group, member in sorted(result[1]):
+            digest.update(group.encode('utf-8'))
+            digest.update(b'\0')
+            digest.update(member.encode('utf-8'))
+            digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+def encode_target_plan(plan, fingerprint):
+    """Convert a plan for a target to a form that can be saved as JSON.
+
+    Args:
+        plan (TargetPlan): The plan
+        fingerprint (str): The fingerprint of the Postgres roles
+    Returns:
+        dict: The plan
+    """
+    return {
+        'fingerprint': fingerprint,
+        'names': plan.names,
+        'groups': plan.groups,
+        'steps': {action: [list(operation)
+                           for operation in plan.steps[action]]
+                  for action in PLAN_ACTIONS
+                  if len(plan.steps[action]) > 0}
+    }
+
+
+def decode_target_plan(data):
+    """Convert a plan for a target read from a plan file.
+
+    Args:
+        data (dict): The plan
+    Returns:
+        tuple: The fingerprint of the Postgres roles and the TargetPlan, or
+            None if the plan is invalid
+    """
+    try:
+        steps = {action: [(role, role_sql, list(members))
+                          for role, role_sql, members in
+                          data['steps'].get(action, [])]
+                 for action in PLAN_ACTIONS}
+
+        return data['fingerprint'], TargetPlan(steps, data['names'],
+                                               data['groups'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def write_plan_file(config, file, plans, ldap_sync):
+    """Write a plan file. The file is written to a temporary name and renamed
+    into place, so it is never left partially written.
+
+    Args:
+        config (ConfigParser): The application configuration
+        file (str): The plan file to write
+        plans (dict): The encoded plan for each target name
+        ldap_sync (LdapSync): The LDAP users the plans were made from
+    Returns:
+        bool: True if the plan was written
+    """
+    temp_file = '%s.%d.tmp' % (file, os.getpid())
+
+    data = {
+        'version': PLAN_VERSION,
+        'created': time.time(),
+        'fingerprint': get_config_fingerprint(config),
+        'since': ldap_sync.since,
+        'sync_state': get_next_sync_state(ldap_sync),
+        'targets': plans
+    }
+
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as plan_file:
+            json.dump(data, plan_file, indent=1, sort_keys=True)
+            plan_file.write('\n')
+            plan_file.flush()
+            os.fsync(plan_file.fileno())
+        os.replace(temp_file, file)
+    except OSError as exception:
+        sys.stderr.write("Error writing the plan file (%s): %s\n" %
+                         (file, exception))
+        return False
+
+    return True
+
+
+def read_plan_file(config, file):
+    """Read a plan file, and check that it was made with the same
+    configuration.
+
+    Args:
+        config (ConfigParser): The application configuration
+        file (str): The plan file to read
+    Returns:
+        dict: The plan file, with the encoded plan for each target name in
+            targets
+    """
+    try:
+        with open(file, 'r', encoding='utf-8') as plan_file:
+            data = json.load(plan_file)
+    except (OSError, ValueError) as exception:
+        sys.stderr.write("Error reading the plan file (%s): %s\n" %
+                         (file, exception))
+        sys.exit(1)
+
+    if not isinstance(data, dict) or data.get('version') != PLAN_VERSION or \
+            not isinstance(data.get('targets'), dict):
+        sys.stderr.write("Error reading the plan file (%s): not a "
+                         "pgldapsync plan\n" % file)
+        sys.exit(1)
+
+    if data.get('fingerprint') != get_config_fingerprint(config):
+        sys.stderr.write("The plan file (%s) was made with a different "
+                         "configuration.\n" % file)
+        sys.exit(1)
+
+    return data
+
+
+def record_plan_sync_state(config, data):
+    """Record the incremental sync state of a plan once it has been applied,
+    so the next sync searches for changes from where the plan's search
+    stopped. The state isn't recorded if an incremental plan's watermark has
+    since been moved by another sync, as it may then go backwards.
+
+    Args:
+        config (ConfigParser): The application configuration
+        data (dict): The plan file
+    """
+    state = data.get('sync_state')
+    if not isinstance(state, dict):
+        return
+
+    since = data.get('since')
+    if since is not None and \
+            (read_sync_state(config) or {}).get('watermark') != since:
+        sys.stderr.write("The incremental sync state has changed since the "
+                         "plan was made, so it was not updated.\n")
+        return
+
+    write_sync_state(config, state)
+
+
+def plan_roles(config, ldap_conn, pg_conns, file):
+    """Work out the changes required to synchronise the Postgres login roles
+    with the LDAP users on each of the configured Postgres targets, and
+    write them to a plan file to be applied later. The SQL is also printed
+    for review.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+        pg_conns (dict): Postgres connections to reuse, keyed by target
+            name. Updated with any connections that are made.
+        file (str): The plan file to write
+    Returns:
+        bool: True if a plan was made for every target and written
+    """
+    targets = get_targets(config)
+
+    ldap_sync, record_usage = read_ldap_sync(config, ldap_conn,
+                                             len(targets) > 1)
+
+    plans = {}
+
+    def plan_work(target, pg_conn, output):
+        name, target_config = target
+
+        # Read the roles and memberships from a single snapshot, so the
+        # fingerprint matches the roles the plan was made from.
+        pg_conn.rollback()
+        cur = pg_conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+        cur.close()
+
+        plan = plan_target(target_config, ldap_sync, pg_conn)
+        fingerprint = get_postgres_fingerprint(target_config, pg_conn, plan)
+        pg_conn.rollback()
+
+        print("-- This is an LDAP sync plan, to be applied with --apply %s" %
+              file, file=output)
+        if ldap_sync.incremental:
+            print("-- Only LDAP users changed since %s are included." %
+                  ldap_sync.since, file=output)
+        print_target_plan(plan, output, pg_conn.info.dbname)
+
+        plans[name] = encode_target_plan(plan, fingerprint)
+
+        return SyncResult(0, 0, 0, 0, [])
+
+    results = run_targets(config, targets, plan_work, pg_conns, '--')
+
+    record_usage()
+    print_ldap_throttle('--')
+
+    if any(result is None for result in results.values()):
+        sys.stderr.write("The plan was not written as planning failed for "
+                         "one or more Postgres targets.\n")
+        return False
+
+    return write_plan_file(config, file, plans, ldap_sync)
+
+
+def apply_roles(config, pg_conns, file, dry_run):
+    """Apply the changes in a plan file to each of the configured Postgres
+    targets. The LDAP server is not searched; instead, each target is checked
+    to ensure its roles have not changed since the plan was made.
+
+    Args:
+        config (ConfigParser): The application configuration
+        pg_conns (dict): Postgres connections to reuse, keyed by target
+            name. Updated with any connections that are made.
+        file (str): The plan file to read
+        dry_run (bool): Print the SQL to stdout rather than executing it
+    Returns:
+        bool: True if the plan was applied to every target, even if
+            individual roles could not be created or dropped
+    """
+    data = read_plan_file(config, file)
+    plans = data['targets']
+    targets = get_targets(config)
+
+    if sorted(plans.keys()) != sorted(name for name, _ in targets):
+        sys.stderr.write("The plan file (%s) was made for different Postgres "
+                         "targets.\n" % file)
+        sys.exit(1)
+
+    def apply_work(target, pg_conn, output):
+        name, target_config = target
+
+        decoded = decode_target_plan(plans[name])
+        if decoded is None:
+            sys.stderr.write("Error reading the plan file (%s): invalid plan "
+                             "for Postgres target %s\n" % (file, name))
+            sys.exit(1)
+        fingerprint, plan = decoded
+
+        # A plan that was partly applied by an interrupted run has changed
+        # the roles, so can't be checked against the fingerprint; the
+        # journal shows it was checked before it was started.
+        resuming = not dry_run and journal_enabled(target_config) and \
+            len(get_journal_progress(target_config,
+                                     get_plan_digest(pg_conn, plan))[0]) > 0
+
+        if not resuming and get_postgres_fingerprint(
+                target_config, pg_conn, plan) != fingerprint:
+            sys.stderr.write("The roles on Postgres target %s have changed "
+                             "since the plan was made, so it cannot be "
+                             "applied.\n" % name)
+            pg_conn.rollback()
+            sys.exit(1)
+
+        if not dry_run:
+            return apply_target_plan(target_config, plan, pg_conn, output)
+
+        print("-- This is an LDAP sync dry run of the plan in %s" % file,
+              file=output)
+        print("-- The commands below can be manually executed if required.",
+              file=output)
+        print_target_plan(plan, output, pg_conn.info.dbname)
+        pg_conn.rollback()
+
+        return SyncResult(0, 0, 0, 0, [])
+
+    results = run_targets(config, targets, apply_work, pg_conns,
+                          '--' if dry_run else '==')
+
+    completed = all(result is not None for result in results.values())
+    success = completed and all(result.add_errors == 0 and
+                                result.drop_errors == 0
+                                for result in results.values())
+
+    # Record how far the plan's search got for the next incremental sync.
+    # If anything failed, keep the old watermark so the failed roles are
+    # retried.
+    if not dry_run and success:
+        record_plan_sync_state(config, data)
+
+    return completed
@@ -0,0 +1,475 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Sync profiling functions."""
+
+import collections
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from .metrics import METRICS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+PROFILE_MODES = ('full', 'sample')
+
+# The number of frames recorded for each allocation in full mode. The
+# reports group allocations by line, which only needs the innermost frame,
+# and tracing is several times slower with more.
+TRACEMALLOC_FRAMES = 1
+
+# The interval between samples, and the number of frames kept from each, in
+# sample mode
+SAMPLE_INTERVAL = 0.01
+SAMPLE_DEPTH = 64
+
+# The number of functions and allocation sites listed in each report
+REPORT_LINES = 30
+
+
+def get_report_name(key):
+    """Get the file name prefix for the reports on a phase.
+
+    Args:
+        key (tuple): The target name, empty if there is none, and the phase
+            name
+    Returns:
+        str: The file name prefix
+    """
+    target, name = key
+    prefix = name if target == '' else '%s.%s' % (target, name)
+
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', prefix)
+
+
+def write_report(file, data):
+    """Atomically write a text report file.
+
+    Args:
+        file (str): The file to write
+        data (str): The report
+    """
+    temp_file = '%s.tmp' % file
+
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as report:
+            report.write(data)
+        os.replace(temp_file, file)
+    except OSError as exception:
+        sys.stderr.write("Error writing profile report %s: %s\n" %
+                         (file, exception))
+
+
+class PhaseProfiler:
+    """Profiles each phase of the sync with cProfile, and records the peak
+    memory allocated during it with tracemalloc. As with the phase timings,
+    each phase is profiled exclusive of any phases nested within it. Peak
+    memory is measured for the whole process, so it is only attributed
+    accurately to a phase if no other phase is running concurrently in
+    another thread."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, directory):
+        """Create a profiler.
+
+        Args:
+            directory (str): The directory to write the reports to
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = {}
+        self.occurrences = {}
+        self.peaks = {}
+        self.snapshots = {}
+        self.warned = False
+
+    def start(self):
+        """Start tracing memory allocations."""
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def reset(self):
+        """Discard the profiles collected so far, ready for a new sync."""
+        with self.lock:
+            self.profiles = {}
+            self.occurrences = {}
+            self.peaks = {}
+            self.snapshots = {}
+
+    @staticmethod
+    def reset_peak():
+        """Reset the peak memory traced, where Python supports it (3.9 and
+        later). Otherwise peaks include the memory allocated before the
+        phase began."""
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def enable(self, profile):
+        """Enable a profile, unless another profiler is already active (as
+        Python 3.12 and later allow only one at a time).
+
+        Args:
+            profile (cProfile.Profile): The profile
+        """
+        try:
+            profile.enable()
+        except ValueError as exception:
+            with self.lock:
+                warned, self.warned = self.warned, True
+            if not warned:
+                sys.stderr.write("Error enabling the profiler: %s\n" %
+                                 exception)
+
+    def enter(self, name, target):
+        """Start profiling a phase in this thread, pausing the profile of
+        the phase it is nested within, if any.
+
+        Args:
+            name (str): The phase name
+            target (str): The target name, or an empty string if there is
+                none
+        """
+        stack = self.local.__dict__.setdefault('phases', [])
+        if len(stack) > 0:
+            stack[-1][1].disable()
+            stack[-1][2] = max(stack[-1][2],
+                               tracemalloc.get_traced_memory()[1])
+        self.reset_peak()
+
+        # Threads have separate profiles, which are merged in the reports
+        key = (target, name)
+        with self.lock:
+            profile = self.profiles.setdefault(
+                (key, threading.get_ident()), cProfile.Profile())
+            self.occurrences[key] = self.occurrences.get(key, 0) + 1
+
+        # Each entry holds the phase key, its profile and its peak memory
+        stack.append([key, profile, 0])
+        self.enable(profile)
+
+    def exit(self):
+        """Stop profiling the current phase in this thread, resuming the
+        profile of the phase it is nested within, if any. The peak memory of
+        each phase is the highest of any of its occurrences. Snapshots are
+        slow, so the allocations are only snapshotted at the end of the
+        first occurrence of each phase; the LDAP search phase, for example,
+        occurs once for each page of results."""
+        stack = self.local.__dict__.setdefault('phases', [])
+        key, profile, peak = stack.pop()
+        profile.disable()
+
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        with self.lock:
+            self.peaks[key] = max(self.peaks.get(key, 0), peak)
+            first = key not in self.snapshots
+            if first:
+                self.snapshots[key] = None
+
+        if first:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__)])
+            with self.lock:
+                self.snapshots[key] = snapshot
+
+        if len(stack) > 0:
+            self.enable(stack[-1][1])
+
+    def get_stats(self, key):
+        """Merge the profiles of a phase from each thread.
+
+        Args:
+            key (tuple): The target and phase names
+        Returns:
+            pstats.Stats: The merged statistics, or None if no calls were
+                profiled
+        """
+        stats = None
+        for (profile_key, _), profile in self.profiles.items():
+            if profile_key != key:
+                continue
+
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile, stream=io.StringIO())
+                else:
+                    stats.add(profile)
+            except TypeError:
+                # Nothing was profiled
+                continue
+
+        return stats
+
+    def write(self):
+        """Write the reports for each phase profiled. For each, a pstats
+        file and a table of the functions taking the most time are written,
+        together with a tracemalloc snapshot and a table of the lines
+        allocating the most memory. A summary of the phases is written to
+        summary.txt."""
+        with self.lock:
+            keys = sorted(self.occurrences)
+            summary = ['%-40s %11s %12s %12s' % ('Phase', 'Occurrences',
+                                                 'Seconds', 'Peak KiB')]
+
+            for key in keys:
+                prefix = os.path.join(self.directory, get_report_name(key))
+                stats = self.get_stats(key)
+                cpu = 0.0
+
+                if stats is not None:
+                    cpu = stats.total_tt
+                    try:
+                        stats.dump_stats(prefix + '.prof')
+                    except OSError as exception:
+                        sys.stderr.write("Error writing profile report "
+                                         "%s: %s\n" %
+                                         (prefix + '.prof', exception))
+
+                    stats.stream = io.StringIO()
+                    stats.sort_stats('tottime').print_stats(REPORT_LINES)
+                    stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+                    write_report(prefix + '.txt', stats.stream.getvalue())
+
+                snapshot = self.snapshots.get(key)
+                if snapshot is not None:
+                    self.write_snapshot(prefix, self.peaks[key], snapshot)
+
+                summary.append('%-40s %11d %12.3f %12d' %
+                               ('.'.join(name for name in key if name != ''),
+                                self.occurrences[key], cpu,
+                                self.peaks.get(key, 0) // 1024))
+
+        write_report(os.path.join(self.directory, 'summary.txt'),
+                     '\n'.join(summary) + '\n')
+
+    @staticmethod
+    def write_snapshot(prefix, peak, snapshot):
+        """Write the allocation reports for a phase.
+
+        Args:
+            prefix (str): The report file name prefix
+            peak (int): The peak memory traced during the phase, in bytes
+            snapshot (tracemalloc.Snapshot): The allocations at the end of
+                the first occurrence of the phase
+        """
+        try:
+            snapshot.dump(prefix + '.snapshot')
+        except OSError as exception:
+            sys.stderr.write("Error writing profile report %s: %s\n" %
+                             (prefix + '.snapshot', exception))
+
+        lines = ['Peak traced memory: %d KiB' % (peak // 1024), '',
+                 'Largest allocations at the end of the first occurrence of '
+                 'the phase, by line:']
+        for statistic in snapshot.statistics('lineno')[:REPORT_LINES]:
+            lines.append(str(statistic))
+
+        write_report(prefix + '.memory.txt', '\n'.join(lines) + '\n')
+
+
+class PhaseSampler:
+    """Profiles each phase of the sync by sampling the stacks of the threads
+    running phases at a fixed interval, from a background thread. Unlike
+    PhaseProfiler, the code being profiled is not slowed down, so it may be
+    left enabled in production. Memory allocations are not traced, but the
+    peak RSS of the process at the end of each phase is recorded where the
+    platform reports it."""
+
+    def __init__(self, directory):
+        """Create a sampler.
+
+        Args:
+            directory (str): The directory to write the reports to
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.current = {}
+        self.samples = {}
+        self.rss = {}
+        self.thread = threading.Thread(target=self.run,
+                                       name='pgldapsync-profiler',
+                                       daemon=True)
+
+    def start(self):
+        """Start sampling."""
+        self.thread.start()
+
+    def reset(self):
+        """Discard the samples collected so far, ready for a new sync."""
+        with self.lock:
+            self.samples = {}
+            self.rss = {}
+
+    def enter(self, name, target):
+        """Attribute samples of this thread to a phase.
+
+        Args:
+            name (str): The phase name
+            target (str): The target name, or an empty string if there is
+                none
+        """
+        stack = self.local.__dict__.setdefault('phases', [])
+        stack.append((target, name))
+
+        with self.lock:
+            self.current[threading.get_ident()] = stack[-1]
+
+    def exit(self):
+        """Attribute samples of this thread to the phase the current phase
+        is nested within, if any."""
+        stack = self.local.__dict__.setdefault('phases', [])
+        key = stack.pop()
+
+        rss = 0
+        if resource is not None:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        with self.lock:
+            self.rss[key] = max(self.rss.get(key, 0), rss)
+            if len(stack) > 0:
+                self.current[threading.get_ident()] = stack[-1]
+            else:
+                self.current.pop(threading.get_ident(), None)
+
+    def run(self):
+        """Take samples until the process exits."""
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            self.sample()
+
+    def sample(self):
+        """Record the stack of each thread that is running a phase. Each
+        frame is identified by the function it is running, rather than the
+        line, so samples from the same call path are counted together."""
+        with self.lock:
+            current = dict(self.current)
+        if len(current) == 0:
+            return
+
+        # pylint: disable=protected-access
+        frames = sys._current_frames()
+
+        for ident, key in current.items():
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None and len(stack) < SAMPLE_DEPTH:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno,
+                              code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+
+            with self.lock:
+                samples = self.samples.setdefault(key, collections.Counter())
+                samples[tuple(stack)] += 1
+
+    def write(self):
+        """Write the reports for each phase sampled. For each, a table of
+        the functions found most often, and the stacks in the collapsed
+        format used by flame graph tools, are written. A summary of the
+        phases is written to summary.txt."""
+        with self.lock:
+            samples = dict(self.samples)
+            rss = dict(self.rss)
+
+        summary = ['%-40s %11s %12s %12s' % ('Phase', 'Samples',
+                                             'Est. seconds', 'Max RSS KiB')]
+
+        for key in sorted(set(samples) | set(rss)):
+            prefix = os.path.join(self.directory, get_report_name(key))
+            stacks = samples.get(key, collections.Counter())
+            total = sum(stacks.values())
+
+            if total > 0:
+                write_report(prefix + '.txt', self.get_table(stacks, total))
+                write_report(prefix + '.collapsed', ''.join(
+                    '%s %d\n' % (';'.join('%s (%s:%d)' %
+                                          (function, filename, line)
+                                          for filename, line, function
+                                          in stack), count)
+                    for stack, count in sorted(stacks.items())))
+
+            summary.append('%-40s %11d %12.2f %12d' %
+                           ('.'.join(name for name in key if name != ''),
+                            total, total * SAMPLE_INTERVAL, rss.get(key, 0)))
+
+        write_report(os.path.join(self.directory, 'summary.txt'),
+                     '\n'.join(summary) + '\n')
+
+    @staticmethod
+    def get_table(stacks, total):
+        """Format a table of the functions sampled most often, by the
+        samples in which they were running, and in which they were on the
+        stack.
+
+        Args:
+            stacks (Counter): The number of samples of each stack
+            total (int): The total number of samples
+        Returns:
+            str: The table
+        """
+        own = collections.Counter()
+        on_stack = collections.Counter()
+        for stack, count in stacks.items():
+            if len(stack) > 0:
+                own[stack[-1]] += count
+            for frame in set(stack):
+                on_stack[frame] += count
+
+        lines = ['Samples: %d (about %.2f seconds)' %
+                 (total, total * SAMPLE_INTERVAL), '',
+                 '%7s %7s  %s' % ('Own %', 'Total %', 'Function')]
+        for frame, count in own.most_common(REPORT_LINES):
+            filename, line, function = frame
+            lines.append('%7.1f %7.1f  %s (%s:%d)' %
+                         (100.0 * count / total,
+                          100.0 * on_stack[frame] / total, function,
+                          filename, line))
+
+        return '\n'.join(lines) + '\n'
+
+
+def start_profiling(directory, mode):
+    """Start profiling each phase of the sync. The reports are written to
+    the directory whenever the metrics are, replacing those from any
+    earlier sync.
+
+    Args:
+        directory (str): The directory to write the reports to
+        mode (str): 'full' to profile with cProfile and tracemalloc, or
+            'sample' to sample the stacks of the running threads
+    """
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as exception:
+        sys.stderr.write("Error creating profile directory %s: %s\n" %
+                         (directory, exception))
+        sys.exit(1)
+
+    if mode == 'sample':
+        profiler = PhaseSampler(directory)
+    else:
+        profiler = PhaseProfiler(directory)
+
+    METRICS.profiler = profiler
+    profiler.start()
@@ -0,0 +1,136 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Incremental sync state functions."""
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+
+# Settings which, if changed, invalidate the stored watermark and force a
+# full sync.
+FINGERPRINT_SETTINGS = [
+    ('ldap', 'server_uri'),
+    ('ldap', 'base_dn'),
+    ('ldap', 'filter_string'),
+    ('ldap', 'search_scope'),
+    ('ldap', 'search_partitions'),
+    ('ldap', 'username_attribute'),
+    ('ldap', 'change_attribute'),
+    ('ldap', 'ignore_users'),
+    ('ldap', 'user_group_dn'),
+    ('ldap', 'group_nested'),
+    ('ldap', 'setting_attributes'),
+    ('ldap', 'connection_limit_attribute'),
+    ('postgres', 'server_connstr'),
+    ('general', 'role_name_case'),
+    ('general', 'role_name_regex'),
+    ('general', 'role_name_replacement'),
+]
+
+
+def get_config_fingerprint(config):
+    """Get a fingerprint of the configuration settings that determine which
+    users are synchronised.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        str: The fingerprint
+    """
+    digest = hashlib.sha256()
+
+    for section, option in FINGERPRINT_SETTINGS:
+        digest.update(config.get(section, option,
+                                 fallback='').encode('utf-8'))
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+def read_sync_state(config):
+    """Read the incremental sync state file.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        dict: The sync state, or None if there is no usable state
+    """
+    state_file = config.get('general', 'state_file')
+
+    try:
+        with open(state_file, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exception:
+        sys.stderr.write("Error reading the sync state file (%s), performing "
+                         "a full sync: %s\n" % (state_file, exception))
+        return None
+
+    if not isinstance(state, dict) or \
+            state.get('fingerprint') != get_config_fingerprint(config):
+        return None
+
+    return state
+
+
+def write_sync_state(config, state):
+    """Write the incremental sync state file. The file is written to a
+    temporary name and renamed into place, so it is never left partially
+    written.
+
+    Args:
+        config (ConfigParser): The application configuration
+        state (dict): The sync state
+    Returns:
+        bool: True if the state was written
+    """
+    state_file = config.get('general', 'state_file')
+    temp_file = '%s.%d.tmp' % (state_file, os.getpid())
+
+    state = dict(state, fingerprint=get_config_fingerprint(config))
+
+    try:
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump(state, file, indent=4, sort_keys=True)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, state_file)
+    except OSError as exception:
+        sys.stderr.write("Error writing the sync state file (%s): %s\n" %
+                         (state_file, exception))
+        return False
+
+    return True
+
+
+def need_full_sync(config, state):
+    """Determine whether a full sync is required rather than an incremental
+    one. Full syncs are needed when there is no watermark, and periodically
+    to catch deletions which cannot be detected incrementally.
+
+    Args:
+        config (ConfigParser): The application configuration
+        state (dict): The sync state, or None
+    Returns:
+        bool: True if a full sync is required
+    """
+    if state is None or state.get('watermark') is None:
+        return True
+
+    interval = config.getint('general', 'full_sync_interval')
+    if interval <= 0:
+        return False
+
+    return time.time() - state.get('last_full_sync', 0) >= interval
@@ -0,0 +1,876 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Role synchronisation functions."""
+
+import collections
+import concurrent.futures
+import io
+import sys
+import time
+
+import psycopg2
+
+from ..ldaputils.settings import UserSettingsIndex, user_settings_enabled
+from ..ldaputils.groups import UserDnIndex, get_group_filter, \
+    get_group_members, get_ldap_groups, group_filters_enabled, \
+    groups_enabled
+from ..ldaputils.users import ChangeTracker, get_ldap_users, \
+    get_filtered_ldap_users
+from ..pgutils.connection import connect_pg_server
+from ..pgutils.policy import RolePolicy
+from ..pgutils.roles import get_filtered_pg_login_roles, \
+    get_login_role_filter, get_pg_login_roles, get_pg_role_dependencies, \
+    get_pg_roles, managed_role_markers_enabled
+from ..pgutils.staging import diff_staged_login_roles, stage_ldap_users
+from .apply import PLAN_ACTIONS, SyncResult, TargetPlan, \
+    apply_target_plan, print_target_plan
+from .metrics import METRICS
+from .members import get_membership_diff, get_membership_operations
+from .diff import RoleDiff, diff_login_roles, diff_role_names, \
+    get_role_name_normaliser, get_role_names, normalise_users
+from .names import AmendedNameSet, NameSet
+from .state import need_full_sync, read_sync_state, write_sync_state
+from .targets import get_targets
+from .throttle import get_rate_limiter, start_rate_limiter
+
+
+LdapSync = collections.namedtuple('LdapSync', ['users', 'admin_users',
+                                               'groups', 'settings',
+                                               'incremental', 'since',
+                                               'tracker', 'state'])
+LdapSync.__doc__ = """The LDAP users to synchronise to the Postgres targets.
+
+    users (iterable): The filtered LDAP user names
+    admin_users (iterable): The LDAP user names that should be superusers
+    groups (dict): The set of member user names for each LDAP group, or None
+        if group memberships are not being synchronised
+    settings (dict): The UserSettings for each user that has settings in
+        LDAP, or None if no settings are taken from LDAP. It is filled in as
+        the users are read.
+    incremental (bool): Are the users only those changed since the last sync?
+    since (str): The change attribute watermark searched from, if incremental
+    tracker (ChangeTracker): The change tracker, if incremental sync is on
+    state (dict): The previous incremental sync state, if any
+"""
+
+TargetRoles = collections.namedtuple('TargetRoles', ['diff', 'login_roles',
+                                                     'current', 'names'])
+TargetRoles.__doc__ = """The result of comparing the LDAP users with the login
+    roles on a Postgres target.
+
+    diff (RoleDiff): The roles to create and drop, and the admin roles
+    login_roles (container): The login roles that exist, among those that
+        were compared
+    current (dict): The current attributes of each existing login role, if
+        role attributes are reconciled
+    names (str[]): The login roles that were compared, if only some were
+        (during an incremental sync), otherwise None
+"""
+
+# The ways in which the LDAP users may be compared with the Postgres roles:
+# by the client, or by the server after copying the LDAP users to it.
+DIFF_ENGINES = ('client', 'server')
+
+
+def read_incremental_state(config):
+    """If incremental sync is enabled, find out where we got to last time,
+    and whether it's time for a full sync.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        tuple: Whether the sync is incremental, the watermark to search from
+            if it is, the ChangeTracker (or None if incremental sync is
+            disabled) and the previous sync state, if any
+    """
+    if not config.getboolean('general', 'incremental_sync'):
+        return False, None, None, None
+
+    if config.get('general', 'state_file') == '':
+        sys.stderr.write("A state_file must be configured to use "
+                         "incremental_sync.\n")
+        sys.exit(1)
+
+    state = read_sync_state(config)
+    incremental = not need_full_sync(config, state)
+    since = state['watermark'] if incremental else None
+
+    return incremental, since, \
+        ChangeTracker(config.get('ldap', 'change_attribute'), since), state
+
+
+def get_ldap_admin_users(config, ldap_conn, since):
+    """Get the LDAP admin users, if the base DN and filter are configured,
+    and they are not selected by group membership.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+        since (str): Only return users changed since this change attribute
+            value, if specified
+    Returns:
+        iterable: The LDAP admin user names
+    """
+    if config.get('ldap', 'admin_group_dn') != '' or \
+            config.get('ldap', 'admin_base_dn') == '' or \
+            config.get('ldap', 'admin_filter_string') == '':
+        return []
+
+    ldap_admin_users = get_ldap_users(config, ldap_conn, True, since)
+    if ldap_admin_users is None:
+        sys.exit(1)
+
+    return ldap_admin_users
+
+
+def select_group_users(config, ldap_groups, ldap_users, ldap_admin_users):
+    """Select the users and admin users that are members of the configured
+    groups.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_groups (dict): The LDAP groups
+        ldap_users (iterable): The LDAP user names
+        ldap_admin_users (iterable): The LDAP admin user names
+    Returns:
+        tuple: The selected users and admin users
+    """
+    if config.get('ldap', 'user_group_dn') != '':
+        members = get_group_filter(ldap_groups,
+                                   config.get('ldap', 'user_group_dn'))
+        if members is None:
+            sys.exit(1)
+        ldap_users = [user for user in ldap_users if user in members]
+
+    if config.get('ldap', 'admin_group_dn') != '':
+        members = get_group_filter(ldap_groups,
+                                   config.get('ldap', 'admin_group_dn'))
+        if members is None:
+            sys.exit(1)
+        ldap_admin_users = [user for user in ldap_users if user in members]
+
+    return ldap_users, ldap_admin_users
+
+
+def get_ldap_sync(config, ldap_conn, materialise=False):
+    """Get the users to synchronise from the LDAP server. If incremental sync
+    is enabled, only users changed since the last sync are returned unless a
+    full sync is required.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+        materialise (bool): Return name sets that can be read more than once,
+            rather than streaming the users from the server?
+    Returns:
+        LdapSync: The LDAP users to synchronise
+    """
+    incremental, since, tracker, state = read_incremental_state(config)
+    observers = [tracker] if tracker is not None else []
+
+    # Group memberships are only synchronised during full syncs, but users
+    # may be selected by group membership in any sync. As the group search
+    # must be run after the user search on the same connection, the users
+    # are always materialised.
+    sync_memberships = groups_enabled(config) and not incremental and \
+        config.getboolean('general', 'sync_group_memberships')
+    if group_filters_enabled(config) and not groups_enabled(config):
+        sys.stderr.write("The group_base_dn and group_filter_string must be "
+                         "configured to use user_group_dn or "
+                         "admin_group_dn.\n")
+        sys.exit(1)
+
+    # If role settings are taken from LDAP attributes, they are collected
+    # from the same search as the users.
+    user_settings = None
+    if user_settings_enabled(config):
+        user_settings = UserSettingsIndex(config)
+        observers.append(user_settings)
+
+    user_dns = None
+    if sync_memberships or group_filters_enabled(config):
+        user_dns = UserDnIndex()
+        observers.append(user_dns)
+        materialise = True
+
+    ldap_users = get_filtered_ldap_users(config, ldap_conn, False, since,
+                                         observers)
+    if ldap_users is None:
+        sys.exit(1)
+
+    # The admin user search is started before the users are read, so with
+    # an asynchronous strategy the two run side by side.
+    ldap_admin_users = get_ldap_admin_users(config, ldap_conn, since)
+
+    if materialise:
+        ldap_users = NameSet(ldap_users)
+        ldap_admin_users = NameSet(ldap_admin_users)
+
+    # Get the LDAP groups and their members, if required, and select the
+    # users and admin users that are members of the configured groups.
+    groups = None
+    if user_dns is not None:
+        ldap_groups = get_ldap_groups(config, ldap_conn, user_dns)
+        ldap_users, ldap_admin_users = select_group_users(config,
+                                                          ldap_groups,
+                                                          ldap_users,
+                                                          ldap_admin_users)
+
+        if sync_memberships:
+            groups = get_group_members(ldap_groups)
+
+        # Don't keep the settings of users that were not selected
+        if user_settings is not None and \
+                config.get('ldap', 'user_group_dn') != '':
+            user_settings.users = {user: user_settings.users[user]
+                                   for user in ldap_users
+                                   if user in user_settings.users}
+
+    return LdapSync(ldap_users, ldap_admin_users, groups,
+                    user_settings.users if user_settings is not None
+                    else None, incremental, since, tracker, state)
+
+
+def get_role_overrides(config, ldap_sync):
+    """Get the settings taken from LDAP for each role.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        ldap_sync (LdapSync): The LDAP users to synchronise
+    Returns:
+        dict: The UserSettings for each normalised role name
+    """
+    if ldap_sync.settings is None:
+        return {}
+
+    normaliser = get_role_name_normaliser(config)
+    ignored = frozenset(config.get('ldap', 'ignore_users').split(','))
+
+    overrides = {}
+    for user, settings in ldap_sync.settings.items():
+        name = normaliser(user)
+        if name != '' and user not in ignored:
+            overrides[name] = settings
+
+    return overrides
+
+
+def get_unmanaged_roles(config, pg_conn, roles):
+    """Find which of the roles that are to be created already exist as login
+    roles, but were not read as they are not marked as managed by
+    pgldapsync.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        pg_conn (connection): The Postgres connection object
+        roles (str[]): The roles to be created
+    Returns:
+        tuple: NameSets of the roles that exist, and of those that may be
+            adopted (marked as managed) as they are not ignored
+    """
+    group = config.get('postgres', 'managed_role_group')
+    if group != '':
+        result = get_pg_roles(pg_conn, [group])
+        if result is None:
+            sys.exit(1)
+        if group not in result:
+            sys.stderr.write("The managed_role_group role %s does not "
+                             "exist.\n" % group)
+            sys.exit(1)
+
+    with METRICS.phase('pg_fetch_roles'):
+        existing = get_pg_login_roles(pg_conn, roles)
+        adoptable = None
+        if existing is not None and len(existing) > 0:
+            adoptable = get_pg_login_roles(pg_conn, existing, False,
+                                           get_login_role_filter(config,
+                                                                 False))
+    if existing is None or (len(existing) > 0 and adoptable is None):
+        sys.exit(1)
+
+    return existing, adoptable or NameSet()
+
+
+def get_drop_owned_operations(policy, pg_conn, roles):
+    """Find the roles to be dropped that own objects or hold privileges in
+    any database, and get the operations that deal with them according to
+    the drop_owned_policy: one for each database, covering all the roles.
+
+    Args:
+        policy (RolePolicy): The role policy
+        pg_conn (connection): The Postgres connection object
+        roles (str[]): The roles to be dropped
+    Returns:
+        tuple: The roles that can be dropped, and a list of (database, sql,
+            roles) tuples for the objects to be dealt with first
+    """
+    with METRICS.phase('pg_fetch_roles'):
+        dependencies = get_pg_role_dependencies(pg_conn, roles)
+    if dependencies is None:
+        sys.exit(1)
+
+    if policy.drop_owned == 'skip':
+        dependent = set(role for members in dependencies.values()
+                        for role in members)
+        if len(dependent) > 0:
+            sys.stderr.write("%d login roles were not dropped as they own "
+                             "objects or hold privileges.\n" %
+                             len(dependent))
+        return [role for role in roles if role not in dependent], []
+
+    return roles, [(database, policy.get_drop_owned_sql(members), members)
+                   for database, members in sorted(dependencies.items())]
+
+
+def diff_changed_users(config, ldap_sync, pg_conn):
+    """Compare the LDAP users that changed since the last sync with their
+    login roles. Deleted users can't be seen, so nothing is dropped; that's
+    left to the next full sync.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        ldap_sync (LdapSync): The LDAP users to synchronise
+        pg_conn (connection): The Postgres connection object
+    Returns:
+        TargetRoles: The roles to change
+    """
+    reconcile = config.getboolean('general', 'reconcile_role_attributes')
+
+    # Only the users that changed in LDAP need to be looked up in Postgres
+    normaliser = get_role_name_normaliser(config)
+    names = normalise_users(normaliser, ldap_sync.users)
+    admins = frozenset(normalise_users(normaliser, ldap_sync.admin_users))
+
+    with METRICS.phase('pg_fetch_roles'):
+        pg_login_roles = get_filtered_pg_login_roles(config, pg_conn, names,
+                                                     reconcile)
+    if pg_login_roles is None:
+        sys.exit(1)
+
+    with METRICS.phase('diff'):
+        role_diff = diff_role_names(names, pg_login_roles, admins)
+
+    return TargetRoles(role_diff._replace(drop=[]), pg_login_roles,
+                       pg_login_roles, names)
+
+
+def diff_staged_users(config, ldap_sync, pg_conn, policy):
+    """Copy the LDAP users to the server, and have it compare them with the
+    login roles, so that only the differences are sent back.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        ldap_sync (LdapSync): The LDAP users to synchronise
+        pg_conn (connection): The Postgres connection object
+        policy (RolePolicy): The role policy
+    Returns:
+        TargetRoles: The roles to change
+    """
+    reconcile = config.getboolean('general', 'reconcile_role_attributes')
+
+    normaliser = get_role_name_normaliser(config)
+    with METRICS.phase('pg_stage_users'):
+        staged = stage_ldap_users(
+            pg_conn,
+            (name for name in map(normaliser, ldap_sync.users)
+             if name != ''),
+            (name for name in map(normaliser, ldap_sync.admin_users)
+             if name != ''))
+    if staged is None:
+        sys.exit(1)
+    METRICS.count('pg_staged_names', staged)
+
+    with METRICS.phase('diff'):
+        result = diff_staged_login_roles(
+            config, pg_conn, policy.attributes[False] if reconcile else None)
+    if result is None:
+        sys.exit(1)
+    create, drop, admins, current = result
+
+    # The roles aren't read, but group members are only looked up among the
+    # LDAP users, and those that exist are the ones that needn't be created.
+    pg_login_roles = NameSet()
+    if ldap_sync.groups is not None:
+        pg_login_roles = AmendedNameSet(
+            get_role_names(normaliser, ldap_sync.users), (), create)
+
+    return TargetRoles(RoleDiff(create, drop, NameSet(admins)),
+                       pg_login_roles, current, None)
+
+
+def diff_target_roles(config, ldap_sync, pg_conn, policy):
+    """Compare the LDAP users with the login roles on a Postgres target,
+    using the configured diff engine.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        ldap_sync (LdapSync): The LDAP users to synchronise
+        pg_conn (connection): The Postgres connection object
+        policy (RolePolicy): The role policy
+    Returns:
+        TargetRoles: The roles to change
+    """
+    engine = config.get('postgres', 'diff_engine').lower()
+    if engine not in DIFF_ENGINES:
+        sys.stderr.write("Invalid diff_engine value: %s\n" % engine)
+        sys.exit(1)
+
+    if ldap_sync.incremental:
+        return diff_changed_users(config, ldap_sync, pg_conn)
+
+    if engine == 'server':
+        return diff_staged_users(config, ldap_sync, pg_conn, policy)
+
+    # Get the roles we care about
+    with METRICS.phase('pg_fetch_roles'):
+        pg_login_roles = get_filtered_pg_login_roles(
+            config, pg_conn, None,
+            config.getboolean('general', 'reconcile_role_attributes'))
+    if pg_login_roles is None:
+        sys.exit(1)
+
+    # Compare the LDAP users and Postgres roles and get the lists of roles
+    # to add and drop.
+    with METRICS.phase('diff'):
+        role_diff = diff_login_roles(config, ldap_sync.users, pg_login_roles,
+                                     ldap_sync.admin_users)
+
+    return TargetRoles(role_diff, pg_login_roles, pg_login_roles, None)
+
+
+def get_adopted_roles(config, pg_conn, roles):
+    """If managed roles are marked, LDAP users may have existing login roles
+    that were not read as they are not marked. Don't try to create them,
+    but adopt them if configured to, so they are marked as managed.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        pg_conn (connection): The Postgres connection object
+        roles (TargetRoles): The roles to change
+    Returns:
+        tuple: The roles to change, without the existing roles to be
+            created, and a list of the roles to adopt
+    """
+    if not managed_role_markers_enabled(config) or \
+            len(roles.diff.create) == 0:
+        return roles, []
+
+    unmanaged, adoptable = get_unmanaged_roles(config, pg_conn,
+                                               roles.diff.create)
+    roles = roles._replace(diff=roles.diff._replace(
+        create=[role for role in roles.diff.create
+                if role not in unmanaged]))
+
+    if not config.getboolean('general', 'adopt_unmanaged_roles'):
+        return roles, []
+
+    return roles, list(adoptable)
+
+
+def get_alter_operations(config, pg_conn, policy, roles, overrides):
+    """Get the operations that alter existing login roles: those whose
+    attributes differ from the policy, if they are reconciled, and those
+    with settings from LDAP that differ from their current settings.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        pg_conn (connection): The Postgres connection object
+        policy (RolePolicy): The role policy
+        roles (TargetRoles): The roles to change
+        overrides (dict): The UserSettings from LDAP for each role
+    Returns:
+        list: (role, sql, members) tuples, sorted by role
+    """
+    reconcile = config.getboolean('general', 'reconcile_role_attributes')
+    admins = roles.diff.admins
+    dropped = set(roles.diff.drop)
+    operations = []
+
+    # If we need to reconcile the attributes of the existing roles, ALTER
+    # only those that differ from the policy
+    if reconcile:
+        for role in sorted(roles.current):
+            if role in dropped:
+                continue
+            role_sql = policy.get_alter_sql(role, roles.current[role],
+                                            role in admins,
+                                            overrides.get(role))
+            if role_sql is not None:
+                operations.append((role, role_sql, []))
+
+    # Apply the settings from LDAP to the other existing roles that have
+    # them, reading the current settings of all of them in one query
+    created = set(roles.diff.create)
+    pending = [role for role in sorted(overrides)
+               if role not in created and role not in dropped and
+               (not reconcile or role not in roles.current)]
+    if len(pending) == 0:
+        return operations
+
+    with METRICS.phase('pg_fetch_roles'):
+        pending_roles = get_filtered_pg_login_roles(config, pg_conn, pending,
+                                                    True)
+    if pending_roles is None:
+        sys.exit(1)
+
+    for role in sorted(pending_roles):
+        if reconcile:
+            role_sql = policy.get_alter_sql(role, pending_roles[role],
+                                            role in admins, overrides[role])
+        else:
+            role_sql = policy.get_override_sql(role, pending_roles[role],
+                                               overrides[role])
+        if role_sql is not None:
+            operations.append((role, role_sql, []))
+
+    return sorted(operations)
+
+
+def plan_target(config, ldap_sync, pg_conn):
+    """Work out the changes required to synchronise the roles on a Postgres
+    server with the LDAP users.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        ldap_sync (LdapSync): The LDAP users to synchronise
+        pg_conn (connection): The Postgres connection object
+    Returns:
+        TargetPlan: The changes to make
+    """
+    policy = RolePolicy(config, pg_conn)
+    roles = diff_target_roles(config, ldap_sync, pg_conn, policy)
+
+    # Get the settings taken from the LDAP user of each role, which have
+    # been collected now the users have been read
+    overrides = get_role_overrides(config, ldap_sync)
+
+    steps = {action: [] for action in PLAN_ACTIONS}
+
+    roles, adopted = get_adopted_roles(config, pg_conn, roles)
+    steps['mark'] = [(role, policy.get_mark_sql(role), [])
+                     for role in adopted]
+
+    # If we need to add roles to Postgres, render the SQL for each role from
+    # the compiled policy
+    existing = AmendedNameSet(roles.login_roles, adopted)
+    if config.getboolean('general', 'add_ldap_users_to_postgres'):
+        existing = AmendedNameSet(roles.login_roles,
+                                  roles.diff.create + adopted)
+        steps['create'] = [(role,
+                            policy.get_create_sql(role,
+                                                  role in roles.diff.admins,
+                                                  overrides.get(role)),
+                            [])
+                           for role in roles.diff.create]
+
+    steps['alter'] = get_alter_operations(config, pg_conn, policy, roles,
+                                          overrides)
+
+    # If we need to drop roles from Postgres, deal with any objects they own
+    # or privileges they hold according to the drop_owned_policy, and then
+    # run the DROP statement
+    if config.getboolean('general', 'remove_login_roles_from_postgres'):
+        drop = roles.diff.drop
+        if policy.drop_owned != 'none' and len(drop) > 0:
+            drop, steps['drop_owned'] = get_drop_owned_operations(policy,
+                                                                  pg_conn,
+                                                                  drop)
+        steps['drop'] = [(role, policy.get_drop_sql(role), [])
+                         for role in drop]
+
+    # Compare the LDAP group memberships with the Postgres group roles, for
+    # the login roles that are synchronised from LDAP. Memberships are
+    # revoked before any are granted, and each group is changed by a single
+    # statement.
+    groups = None
+    if ldap_sync.groups is not None:
+        managed = AmendedNameSet(roles.login_roles,
+                                 roles.diff.create + adopted,
+                                 roles.diff.drop)
+        with METRICS.phase('diff'):
+            membership_diff = get_membership_diff(config, ldap_sync.groups,
+                                                  pg_conn, managed)
+
+        groups = membership_diff.groups
+        steps['create_group'], steps['revoke'], steps['grant'] = \
+            get_membership_operations(policy, membership_diff, existing)
+
+    return TargetPlan(steps, roles.names, groups)
+
+
+def sync_target(config, ldap_sync, pg_conn, dry_run, output=None):
+    """Synchronise the login roles on a Postgres server with the LDAP users.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        ldap_sync (LdapSync): The LDAP users to synchronise
+        pg_conn (connection): The Postgres connection object
+        dry_run (bool): Print the SQL rather than executing it
+        output (file): Where to write SQL and the summary, sys.stdout if None
+    Returns:
+        SyncResult: The counts of operations/errors
+    """
+    if output is None:
+        output = sys.stdout
+
+    plan = plan_target(config, ldap_sync, pg_conn)
+
+    if not dry_run:
+        return apply_target_plan(config, plan, pg_conn, output)
+
+    # Warn the user we're in dry run mode
+    print("-- This is an LDAP sync dry run.", file=output)
+    print("-- The commands below can be manually executed if required.",
+          file=output)
+    if ldap_sync.incremental:
+        print("-- Only LDAP users changed since %s are included." %
+              ldap_sync.since, file=output)
+
+    print_target_plan(plan, output, pg_conn.info.dbname)
+    pg_conn.rollback()
+
+    return SyncResult(0, 0, 0, 0, [])
+
+
+def get_target_connection(config, name, pg_conns):
+    """Get a connection to a Postgres target, reusing an existing one if
+    it is still open.
+
+    Args:
+        config (ConfigParser): The configuration for the target
+        name (str): The target name
+        pg_conns (dict): Open connections, keyed by target name. Updated
+            with the new connection, if one is made.
+    Returns:
+        connection: The Postgres connection object, or None on error
+    """
+    pg_conn = pg_conns.get(name)
+
+    if pg_conn is None or pg_conn.closed:
+        with METRICS.phase('pg_connect'):
+            pg_conn = connect_pg_server(config.get('postgres',
+                                                   'server_connstr'))
+        if pg_conn is None:
+            pg_conns.pop(name, None)
+            return None
+        pg_conns[name] = pg_conn
+
+    return pg_conn
+
+
+def run_target(target, work, pg_conns, output):
+    """Run some work against a single Postgres target, isolating any
+    failure.
+
+    Args:
+        target (tuple): The target name and configuration
+        work (callable): Called with the target, connection and output to
+            do the work, returning a SyncResult
+        pg_conns (dict): Open connections, keyed by target name
+        output (file): Where to write SQL and the summary. If this is not
+            stdout, error messages are prefixed with the target name.
+    Returns:
+        SyncResult: The counts of operations/errors, or None on failure
+    """
+    name, config = target
+    prefix = '' if output is sys.stdout else '[%s] ' % name
+
+    with METRICS.target(name):
+        pg_conn = get_target_connection(config, name, pg_conns)
+        if pg_conn is None:
+            return None
+
+        try:
+            result = work(target, pg_conn, output)
+            for error in result.errors:
+                sys.stderr.write("%s%s\n" % (prefix, error))
+            return result
+        except SystemExit:
+            # Errors have already been reported.
+            pass
+        except psycopg2.Error as exception:
+            sys.stderr.write("%sError communicating with the Postgres "
+                             "server: %s\n" % (prefix, exception))
+
+        # The connection may be unusable, so don't reuse it.
+        pg_conns.pop(name, None)
+        try:
+            pg_conn.close()
+        except psycopg2.Error:
+            pass
+
+        return None
+
+
+def run_targets(config, targets, work, pg_conns, comment):
+    """Run some work against each Postgres target, concurrently if there is
+    more than one.
+
+    Args:
+        config (ConfigParser): The application configuration
+        targets (list): The (name, configuration) tuples of the targets
+        work (callable): Called with the target, connection and output to
+            do the work, returning a SyncResult
+        pg_conns (dict): Postgres connections to reuse, keyed by target
+            name. Updated with any connections that are made.
+        comment (str): The prefix for the headings printed for each target
+    Returns:
+        dict: The SyncResult for each target name, or None on failure
+    """
+    results = {}
+    if len(targets) == 1:
+        results[targets[0][0]] = run_target(targets[0], work, pg_conns,
+                                            sys.stdout)
+    else:
+        workers = max(config.getint('general', 'max_concurrent_targets'), 1)
+        outputs = {name: io.StringIO() for name, _ in targets}
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = {target[0]: executor.submit(run_target, target, work,
+                                                  pg_conns,
+                                                  outputs[target[0]])
+                       for target in targets}
+
+            for name, _ in targets:
+                results[name] = futures[name].result()
+
+        # Print the output for each target in turn, followed by a summary
+        for name, _ in targets:
+            print("%s Postgres target: %s" % (comment, name))
+            sys.stdout.write(outputs[name].getvalue())
+            if results[name] is None:
+                print("%s Synchronisation failed." % comment)
+
+        print("%s Postgres targets synchronised: %d, failed: %d" %
+              (comment,
+               len([result for result in results.values()
+                    if result is not None]),
+               len([result for result in results.values()
+                    if result is None])))
+
+    for name, result in results.items():
+        with METRICS.target(name):
+            METRICS.count('target_completed', 0 if result is None else 1)
+
+    return results
+
+
+def read_ldap_sync(config, ldap_conn, materialise):
+    """Get the users to synchronise from the LDAP server, recording the
+    amount of data received.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+        materialise (bool): Return name sets that can be read more than once,
+            rather than streaming the users from the server?
+    Returns:
+        tuple: The LdapSync, and a function to call once the users have
+            been read to record the metrics
+    """
+    # Limit the rate of LDAP search requests, if required
+    start_rate_limiter('ldap_pages',
+                       config.getfloat('ldap', 'max_pages_per_second'))
+
+    # The LDAP connection usage statistics are cumulative, so record the
+    # change during this sync.
+    usage = getattr(ldap_conn, 'usage', None)
+    if usage is None:
+        return get_ldap_sync(config, ldap_conn, materialise), lambda: None
+
+    bytes_received = usage.bytes_received
+    messages_received = usage.messages_received
+
+    def record_usage():
+        METRICS.count('ldap_bytes_received',
+                      usage.bytes_received - bytes_received)
+        METRICS.count('ldap_messages_received',
+                      usage.messages_received - messages_received)
+
+    return get_ldap_sync(config, ldap_conn, materialise), record_usage
+
+
+def print_ldap_throttle(comment):
+    """Report the rate of LDAP search requests, if it was limited.
+
+    Args:
+        comment (str): The prefix for the report
+    """
+    limiter = get_rate_limiter('ldap_pages')
+    if limiter is None or limiter.rate <= 0:
+        return
+
+    print("%s LDAP search pages per second: %.1f (limit %g), throttled for "
+          "%.1f seconds" % (comment, limiter.get_rate(), limiter.rate,
+                            limiter.waited))
+
+
+def get_next_sync_state(ldap_sync):
+    """Get the incremental sync state to record once the changes to the
+    LDAP users have been applied.
+
+    Args:
+        ldap_sync (LdapSync): The LDAP users that were synchronised
+    Returns:
+        dict: The sync state, or None if incremental sync is disabled
+    """
+    if ldap_sync.tracker is None:
+        return None
+
+    return {
+        'watermark': ldap_sync.tracker.watermark,
+        'last_full_sync': (ldap_sync.state or {}).get('last_full_sync', 0)
+                          if ldap_sync.incremental else time.time()
+    }
+
+
+def sync_roles(config, ldap_conn, pg_conns, dry_run):
+    """Synchronise the Postgres login roles with the LDAP users, on each of
+    the configured Postgres targets. The LDAP users are read once, and the
+    targets are synchronised concurrently if there is more than one.
+
+    Args:
+        config (ConfigParser): The application configuration
+        ldap_conn (ldap3.core.connection.Connection): The LDAP connection
+        pg_conns (dict): Postgres connections to reuse, keyed by target
+            name. Updated with any connections that are made.
+        dry_run (bool): Print the SQL to stdout rather than executing it
+    Returns:
+        bool: True if every target was synchronised, even if individual
+            roles could not be created or dropped
+    """
+    targets = get_targets(config)
+
+    ldap_sync, record_usage = read_ldap_sync(config, ldap_conn,
+                                             len(targets) > 1)
+
+    results = run_targets(
+        config, targets,
+        lambda target, pg_conn, output: sync_target(target[1], ldap_sync,
+                                                    pg_conn, dry_run,
+                                                    output),
+        pg_conns, '--' if dry_run else '==')
+
+    record_usage()
+    print_ldap_throttle('--' if dry_run else '==')
+
+    completed = all(result is not None for result in results.values())
+    success = completed and all(result.add_errors == 0 and
+                                result.drop_errors == 0
+                                for result in results.values())
+
+    # Record how far we got for the next incremental sync. If anything
+    # failed, keep the old watermark so the failed roles are retried.
+    state = get_next_sync_state(ldap_sync)
+    if state is not None and not dry_run and success:
+        write_sync_state(config, state)
+
+    return completed
@@ -0,0 +1,63 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Postgres sync target functions."""
+
+import configparser
+
+TARGET_SECTION_PREFIX = 'postgres:'
+
+
+def get_target_config(config, section):
+    """Get the configuration for a single Postgres target. Settings in the
+    target section override those in the [postgres] section, or in the
+    [general] section if they are general settings, such as role attributes.
+
+    Args:
+        config (ConfigParser): The application configuration
+        section (str): The name of the target section
+    Returns:
+        ConfigParser: The configuration to use for the target
+    """
+    # Values are copied once interpolated, so they are used as they are.
+    target_config = configparser.ConfigParser(interpolation=None)
+    target_config.read_dict({name: dict(config.items(name))
+                             for name in config.sections()})
+
+    for option, value in config.items(section):
+        if config.has_option('general', option):
+            target_config.set('general', option, value)
+        else:
+            target_config.set('postgres', option, value)
+
+    return target_config
+
+
+def get_targets(config):
+    """Get the list of Postgres servers to synchronise. If any [postgres:NAME]
+    sections are present, each one is a target, using the [postgres] section
+    for defaults. Otherwise, the [postgres] section is the only target.
+
+    Args:
+        config (ConfigParser): The application configuration
+    Returns:
+        list: A list of (name, ConfigParser) tuples
+    """
+    targets = []
+
+    for section in config.sections():
+        if section.startswith(TARGET_SECTION_PREFIX):
+            targets.append((section[len(TARGET_SECTION_PREFIX):],
+                            get_target_config(config, section)))
+
+    if len(targets) == 0:
+        targets.append(('postgres', config))
+
+    return targets
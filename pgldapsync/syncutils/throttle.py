@@ -0,0 +1,188 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Throttling functions."""
+
+import threading
+import time
+
+from .metrics import METRICS
+
+
+# The rate limiters for the sync in progress, by name
+RATE_LIMITERS = {}
+
+
+class RateLimiter:
+    """A token bucket, limiting the rate of requests to a server. Tokens are
+    added at a fixed rate, up to one second's worth; a request that takes
+    more tokens than are available waits until they would have been added.
+    The limiter may be shared by several threads."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, rate):
+        """Create a rate limiter, with a full bucket.
+
+        Args:
+            rate (float): The number of tokens added per second, or 0 for
+                no limit
+        """
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self.tokens = self.capacity
+        self.lock = threading.Lock()
+        self.updated = time.monotonic()
+        self.started = self.updated
+        self.last = self.updated
+        self.acquired = 0
+        self.waited = 0.0
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, waiting until they are available.
+        Tokens that are not available are borrowed from the future, so
+        later requests wait for them too.
+
+        Args:
+            tokens (int): The number of tokens, e.g. statements, to take
+        Returns:
+            float: The time spent waiting, in seconds
+        """
+        wait = 0.0
+
+        with self.lock:
+            self.acquired = self.acquired + tokens
+            if self.rate <= 0:
+                self.last = time.monotonic()
+                return wait
+
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated) * self.rate) - tokens
+            self.updated = now
+
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+                self.waited = self.waited + wait
+
+        time.sleep(wait)
+        self.last = time.monotonic()
+
+        return wait
+
+    def get_rate(self):
+        """Get the average rate at which tokens have been taken, up to the
+        last time any were.
+
+        Returns:
+            float: The number of tokens taken per second
+        """
+        elapsed = self.last - self.started
+
+        return self.acquired / elapsed if elapsed > 0 else 0.0
+
+
+def start_rate_limiter(name, rate):
+    """Create a new rate limiter for the sync in progress, replacing any
+    left from an earlier sync.
+
+    Args:
+        name (str): The limiter name
+        rate (float): The number of tokens added per second, or 0 for no
+            limit
+    Returns:
+        RateLimiter: The rate limiter
+    """
+    RATE_LIMITERS[name] = RateLimiter(rate)
+
+    return RATE_LIMITERS[name]
+
+
+def get_rate_limiter(name):
+    """Get a rate limiter started for the sync in progress.
+
+    Args:
+        name (str): The limiter name
+    Returns:
+        RateLimiter: The rate limiter, or None if it hasn't been started
+    """
+    return RATE_LIMITERS.get(name)
+
+
+class BatchThrottle:
+    """Limits the rate at which role statements are sent to a Postgres
+    server, and adapts the number of statements sent in each batch to the
+    load on the server. The batch size is halved, and the next batch
+    delayed, whenever a batch takes longer than the target latency or too
+    many sessions are waiting for locks. It grows by a quarter while the
+    server keeps up easily, up to the configured batch_size."""
+
+    def __init__(self, config):
+        """Create a throttle.
+
+        Args:
+            config (ConfigParser): The configuration for the target
+        """
+        self.limiter = RateLimiter(config.getfloat(
+            'postgres', 'max_statements_per_second'))
+        self.maximum = max(config.getint('postgres', 'batch_size'), 1)
+        self.batch_size = self.maximum
+        self.target_latency = config.getfloat('postgres',
+                                              'target_batch_latency')
+        self.lock_waiters = config.getint('postgres', 'backoff_lock_waiters')
+        self.backoffs = 0
+
+    def wait(self, statements):
+        """Wait until a batch of statements may be sent.
+
+        Args:
+            statements (int): The number of statements in the batch
+        """
+        waited = self.limiter.acquire(statements)
+        if waited > 0:
+            METRICS.count('pg_throttle_wait_seconds', waited)
+
+    def observe(self, latency, waiters=0):
+        """Adapt the batch size to the time a batch took, and the number of
+        sessions found waiting for locks after it.
+
+        Args:
+            latency (float): The round-trip time of the batch, in seconds
+            waiters (int): The number of sessions waiting for locks
+        """
+        slow = 0 < self.target_latency < latency
+        contended = 0 < self.lock_waiters <= waiters
+
+        if slow or contended:
+            if self.batch_size > 1:
+                self.batch_size = max(self.batch_size // 2, 1)
+            self.backoffs = self.backoffs + 1
+            METRICS.count('pg_batch_backoffs')
+
+            # Give the server as long again to recover
+            time.sleep(latency)
+            METRICS.count('pg_throttle_wait_seconds', latency)
+        elif self.target_latency <= 0 or latency < self.target_latency / 2:
+            self.batch_size = min(self.batch_size +
+                                  max(self.batch_size // 4, 1),
+                                  self.maximum)
+
+
+def throttling_enabled(config):
+    """Is the rate of role statements limited, or the batch size adapted?
+
+    Args:
+        config (ConfigParser): The configuration for the target
+    Returns:
+        bool: True if any of the throttling settings are enabled
+    """
+    return config.getfloat('postgres', 'max_statements_per_second') > 0 or \
+        config.getfloat('postgres', 'target_batch_latency') > 0 or \
+        config.getint('postgres', 'backoff_lock_waiters') > 0
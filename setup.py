@@ -29,7 +29,8 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://github.com/enterprisedb/pgldapsync",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(exclude=['benchmarks', 'benchmarks.*',
+                                               'tests', 'tests.*']),
     install_requires=required,
     python_requires='>=3.7',
     classifiers=[
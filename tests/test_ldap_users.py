@@ -0,0 +1,124 @@
+###############################################################################
+#
+# pgldapsync
+#
+# Synchronise Postgres roles with users in an LDAP directory.
+#
+# Copyright 2018 - 2023, EnterpriseDB Corporation
+#
+###############################################################################
+
+"""Tests for the LDAP user search, against an in-process mock server.
+
+Run from the top level of the source tree:
+
+    python3 -m unittest discover -s tests -t .
+"""
+
+# pylint resolves pgldapsync to pgldapsync.py rather than the package.
+# pylint: disable=no-name-in-module,import-error
+
+import os
+import unittest
+from unittest import mock
+
+import configparser
+
+from ldap3 import Connection, MOCK_SYNC, OFFLINE_SLAPD_2_4, Server
+
+from pgldapsync.ldaputils.users import get_ldap_users
+
+
+BASE_DN = 'ou=people,dc=example,dc=com'
+BIND_DN = 'cn=admin,dc=example,dc=com'
+BIND_PASSWORD = 'secret'
+
+
+def mock_directory(count):
+    """Create an in-process mock LDAP server with synthetic users, and a
+    configuration to search it.
+
+    Args:
+        count (int): The number of users to create
+    Returns:
+        tuple: The config object, a bound connection to the server, and the
+            user names
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'pgldapsync', 'config_default.ini'))
+    config.set('ldap', 'base_dn', BASE_DN)
+    config.set('ldap', 'filter_string', '(objectClass=inetOrgPerson)')
+    config.set('ldap', 'username_attribute', 'uid')
+
+    server = Server('mock_ldap', get_info=OFFLINE_SLAPD_2_4)
+    conn = Connection(server, BIND_DN, BIND_PASSWORD,
+                      client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(BIND_DN, {'userPassword': BIND_PASSWORD,
+                                      'sn': 'admin'})
+
+    names = ['user%04d' % i for i in range(count)]
+    for name in names:
+        conn.strategy.add_entry('uid=%s,%s' % (name, BASE_DN),
+                                {'uid': name,
+                                 'objectClass': ['inetOrgPerson'],
+                                 'cn': name,
+                                 'sn': name})
+    conn.bind()
+
+    return config, conn, names
+
+
+class PagedSearchTestCase(unittest.TestCase):
+    """Paged searches return every user, whichever page they are on."""
+
+    def search(self, count, page_size):
+        """Search a mock directory, counting the requests made.
+
+        Args:
+            count (int): The number of users in the directory
+            page_size (int): The page size to search with
+        Returns:
+            tuple: The user names expected and found, and the number of
+                search requests
+        """
+        config, conn, names = mock_directory(count)
+        config.set('ldap', 'page_size', str(page_size))
+
+        with mock.patch.object(conn, 'search',
+                               wraps=conn.search) as search:
+            users = list(get_ldap_users(config, conn, False))
+
+        return names, users, search.call_count
+
+    def test_partial_last_page(self):
+        """The users on a final, partly filled page are returned."""
+        names, users, requests = self.search(25, 10)
+
+        self.assertEqual(sorted(users), names)
+        self.assertEqual(requests, 3)
+
+    def test_full_last_page(self):
+        """Users aren't lost or repeated when the last page is full."""
+        names, users, requests = self.search(30, 10)
+
+        self.assertEqual(sorted(users), names)
+        self.assertGreaterEqual(requests, 3)
+
+    def test_single_entry_pages(self):
+        """Each page may hold a single user."""
+        names, users, requests = self.search(5, 1)
+
+        self.assertEqual(sorted(users), names)
+        self.assertGreaterEqual(requests, 5)
+
+    def test_unpaged(self):
+        """A page size of 0 searches without paging."""
+        names, users, requests = self.search(25, 0)
+
+        self.assertEqual(sorted(users), names)
+        self.assertEqual(requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()